@@ -12,6 +12,9 @@ https://github.com/ocanbascil/Performance-AppEngine
     
     You can also retrieve results in different formats (list,key-model dict,
     key_name-model dict)
+    
+    Models are encoded for memcache with a pluggable codec, see codec.py
+    Transient datastore errors are retried with a bounded policy, see retry.py
 
 Requirements
 ------------
@@ -26,11 +29,12 @@ from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.api import datastore
 from google.appengine.ext import deferred
-from google.appengine.datastore import entity_pb
 from google.appengine.runtime import apiproxy_errors
 
 import cachepy
+import codec
 import logging
+from retry import RetryPolicy
 
 from datetime import datetime,date
 
@@ -50,6 +54,18 @@ LOCAL_EXPIRATION = 300
 MEMCACHE_EXPIRATION = 0
 QUERY_EXPIRATION = 300
 
+'''Keys missing in all layers are read from datastore in parallel
+with memcache for this many seconds, see pdb.get_async'''
+MISS_HINT_EXPIRATION = 60
+MISS_HINT_PREFIX = 'pdb_miss|'
+
+'''Negative caching, see _negative_ttl parameter of pdb.get
+Tombstones are kept in memcache only, so a put on any instance clears them'''
+NEGATIVE_PREFIX = 'pdb_none|'
+_negative_stats = {'hits':0,'misses':0,'datastore_reads_avoided':0}
+
+_memcache_client = memcache.Client()
+
 none_filter  = lambda dict : [k for k,v in dict.iteritems() if v is None]
 
 def _dict_multi_get(keys,dict):
@@ -76,6 +92,8 @@ def _validate_cache(cache_list):
 
 def _key_str(param):
   '''Utility function that extracts a string key from a model or key instance'''
+  if isinstance(param,pdb.Model):
+    return param._key_str()
   try:
     return str(db._coerce_to_key(param))
   except db.BadArgumentError:
@@ -100,26 +118,19 @@ def _to_dict(models):
     result[_key_str(model)] = model
   return result
 
+def _model_key(model):
+  '''Key of a model, memoized for pdb.Model instances'''
+  if isinstance(model,pdb.Model):
+    return model._memo_key()
+  return model.key()
+
 def _serialize(models):
-  '''Improve memcache performance converting to protobuf'''
-  if models is None:
-    return None
-  elif isinstance(models, db.Model):
-    # Just one instance
-    return db.model_to_protobuf(models).Encode()
-  else:
-    # A list
-    return [db.model_to_protobuf(x).Encode() for x in models]
+  '''Improve memcache performance by encoding with the selected codec'''
+  return codec.encode(models)
 
 def _deserialize(data):
-  '''Improve memcache performance by converting from protobuf'''
-  if data is None:
-    return None
-  elif isinstance(data, str):
-    # Just one instance
-    return db.model_from_protobuf(entity_pb.EntityProto(data))
-  else:
-    return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
+  '''Decode values written by any of the codecs'''
+  return codec.decode(data)
 
 def _cachepy_get(keys):
   '''Get items with given keys from local cache'''
@@ -128,63 +139,67 @@ def _cachepy_get(keys):
     result[key] = cachepy.get(key)
   return result
 
-def _cachepy_put(models,time = 0):
-  '''Put given models to local cache in serialized form
-   with expiration in seconds
+def _cachepy_put(to_put,time = 0):
+  '''Put given models to local cache with expiration in seconds
   
   Args:
-    models: List of models to be saved to local cache
+    to_put: Key string - model dictionary, see _to_dict
     time: Expiration time in seconds for each model instance
-  
-  Returns:
-    List of  of db.Keys of the models that were put
   '''
-  to_put = _to_dict(models)
   if time == 0: #cachepy uses None as unlimited caching flag
     time = None
   
   for key, model in to_put.iteritems():
     cachepy.set(key,model,time)
-  return [model.key() for model in models]
 
 def _cachepy_delete(keys):
   '''Delete models with given keys from local cache'''
   for key in keys: 
       cachepy.delete(key)
 
-def _memcache_get(keys):
-  '''Get items with given keys from memcache
-    If no model is found for given key, value for that key
-    in result is set to None
-  '''
-  cache_results = memcache.get_multi(keys)
-  result = {}
-  for key in keys:
-    try:
-      result[key] = _deserialize(cache_results[key])
-    except KeyError:
-      result[key] = None
-  return result
-    
-def _memcache_put(models,time = 0):
+def _memcache_put(to_put,time = 0):
   '''Put given models to memcache in serialized form
    with expiration in seconds
-     
-  Returns:
-    List of  db.Keys of the models that were put
-  '''         
-  to_put = _to_dict(models)
-        
+  
+  Args:
+    to_put: Key string - model dictionary, see _to_dict
+  '''
+  serialized = {}
   for key,model in to_put.iteritems():
-      to_put[key] = _serialize(model)
-          
-  memcache.set_multi(to_put,time)
-  return [model.key() for model in models]
+    serialized[key] = _serialize(model)
+  memcache.set_multi(serialized,time)
 
 def _memcache_delete(keys):
   '''Delete models with given keys from memcache'''
   memcache.delete_multi(keys)
+
+def _memcache_put_async(models,time = 0):
+  '''Fire and forget version of _memcache_put, used for cache refresh'''
+  to_put = _to_dict(models)
+  for key,model in to_put.iteritems():
+    to_put[key] = _serialize(model)
+  return _memcache_client.set_multi_async(to_put,time)
+
+def _is_likely_miss(key):
+  '''True if key could not be found in any layer recently on this instance'''
+  return cachepy.get(MISS_HINT_PREFIX+key) is not None
+
+def _set_miss_hints(keys):
+  for key in keys:
+    cachepy.set(MISS_HINT_PREFIX+key,True,MISS_HINT_EXPIRATION)
+    
+def _clear_miss_hints(keys):
+  for key in keys:
+    cachepy.delete(MISS_HINT_PREFIX+key)
   
+'''Retries datastore puts failing with transient errors'''
+PUT_RETRY = RetryPolicy('pdb.put',
+                        retry_on = (db.Timeout,db.InternalError),
+                        max_attempts = 3,
+                        initial_delay = 0.1,
+                        max_delay = 1.0,
+                        time_budget = 5)
+
 def _put(models,countdown=0):
   batch_size = 50
   to_put = []
@@ -195,9 +210,9 @@ def _put(models,countdown=0):
       to_put.append(model)
       last_index = i
       if (i+1) % batch_size == 0:
-        keys.extend(db.put(to_put))
+        keys.extend(PUT_RETRY.run(db.put,to_put))
         to_put = []
-    keys.extend(db.put(to_put))
+    keys.extend(PUT_RETRY.run(db.put,to_put))
     return keys
     
   except apiproxy_errors.DeadlineExceededError:
@@ -213,6 +228,132 @@ def _put(models,countdown=0):
     deferred.defer(_put,models,countdown,_countdown=countdown)
       
   
+class _GetFuture(object):
+  '''Pending result of pdb.get_async'''
+  
+  def __init__(self,keys,_storage,_local_expiration,
+               _memcache_expiration,_result_type,_negative_ttl,kwds):
+    self.keys = keys
+    self.storage = _storage
+    self.local_expiration = _local_expiration
+    self.memcache_expiration = _memcache_expiration
+    self.result_type = _result_type
+    self.negative_ttl = _negative_ttl
+    self.kwds = kwds
+    self.local_flag = LOCAL in _storage
+    self.memcache_flag = MEMCACHE in _storage
+    self.models = {}
+    self.local_not_found = []
+    self.memcache_not_found = []
+    self.pending_keys = keys
+    self.tombstoned = []
+    self.memcache_keys = []
+    self.memcache_rpc = None
+    self.db_rpcs = [] #(keys,rpc) tuples
+    self._done = False
+    self._result = None
+    
+  def get_result(self):
+    '''Waits for pending RPCs and returns the result, see pdb.get'''
+    if not self._done:
+      self._result = self._format(self._resolve())
+      self._done = True
+    return self._result
+  
+  def _resolve(self):
+    models = self.models
+    keys = self.pending_keys
+    
+    if self.memcache_rpc is not None:
+      cache_results = self.memcache_rpc.get_result()
+      keys = []
+      for key in self.memcache_keys:
+        models[key] = None
+        try:
+          data = cache_results[key]
+        except KeyError:
+          if NEGATIVE_PREFIX+key in cache_results:
+            self.tombstoned.append(key)
+          else:
+            keys.append(key)
+          continue
+        try:
+          models[key] = _deserialize(data)
+        except Exception, e:
+          #Written by an older schema or codec, read again and overwritten
+          logging.warning('Could not decode cached %s: %r' %(key,e))
+          keys.append(key)
+      self.memcache_not_found = keys
+    
+    if DATASTORE in self.storage and len(keys):
+      requested = set()
+      for rpc_keys,rpc in self.db_rpcs:
+        requested.update(rpc_keys)
+      remaining = [key for key in keys if key not in requested]
+      if len(remaining):
+        self.db_rpcs.append((remaining,db.get_async(remaining)))
+        
+      missing = set(keys)
+      for rpc_keys,rpc in self.db_rpcs:
+        for key,model in zip(rpc_keys,rpc.get_result()):
+          #Prefetched models may have been found in memcache already
+          if model is not None and key in missing:
+            models[key] = model
+      keys = [key for key in keys if models.get(key) is None]
+      if self.memcache_flag and not self.negative_ttl:
+        _set_miss_hints(keys)
+    
+    if self.negative_ttl:
+      self._update_negative_cache(keys)
+        
+    if self.local_flag:
+      targets = _dict_multi_get(self.local_not_found, models)
+      if len(targets):
+        pdb.put(targets,_storage = LOCAL,
+                _local_expiration = self.local_expiration,**self.kwds)  
+    
+    if self.memcache_flag:
+      targets = _dict_multi_get(self.memcache_not_found,models)
+      if len(targets):
+        _memcache_put_async(targets,self.memcache_expiration)
+    return models
+  
+  def _update_negative_cache(self,missing_keys):
+    '''Stores tombstones for keys missing in every layer and updates stats'''
+    _negative_stats['hits'] += len(self.tombstoned)
+    _negative_stats['misses'] += len(missing_keys)
+    if DATASTORE in self.storage:
+      requested = set()
+      for rpc_keys,rpc in self.db_rpcs:
+        requested.update(rpc_keys)
+      avoided = [key for key in self.tombstoned if key not in requested]
+      _negative_stats['datastore_reads_avoided'] += len(avoided)
+      
+    if len(missing_keys) and self.memcache_flag:
+      tombstones = dict([(NEGATIVE_PREFIX+key,1) for key in missing_keys])
+      _memcache_client.set_multi_async(tombstones,self.negative_ttl)
+  
+  def _format(self,models):
+    if self.result_type == LIST:
+      result = []
+      #Restore the order of entities   
+      for key in self.keys:
+        try:
+          result.append(models[key])
+        except KeyError:
+          result.append(None)   
+      #Normalized result
+      if len(result) > 1:
+        return result
+      return result[0]
+    elif self.result_type == DICT:
+      return models
+    else:
+      result = {}
+      for k,v in models.iteritems():
+        result[_id_or_name(k)] = v
+      return result
+      
 class pdb(object):
   '''Wrapper class for google.appengine.ext.db with seamless cache support'''
   
@@ -221,6 +362,7 @@ class pdb(object):
           _local_expiration = LOCAL_EXPIRATION,
           _memcache_expiration = MEMCACHE_EXPIRATION,
           _result_type=LIST,
+          _negative_ttl=None,
           **kwds):
     """Fetch the specific Model instance with the given keys from 
     given storage layers in given format. 
@@ -236,6 +378,10 @@ class pdb(object):
       _memcache_expiration: Time for memcache expiration in seconds
                               'memcache' is not in _storage parameters.
       _result_type: format of the result 
+      _negative_ttl: Time in seconds to remember keys that weren't found 
+                     in any layer. Tombstones are stored in memcache if it is
+                     in _storage parameters. pdb.put clears them only for 
+                     models whose class sets _negative_ttl, see pdb.Model.
       
       Inherited:
         keys: Key within datastore entity collection to find; or string key;
@@ -259,67 +405,67 @@ class pdb(object):
       KeyParameterError: If something other than db.Key or string repr.
         of db.Key is given
     """
+    return pdb.get_async(keys,_storage,_local_expiration,
+                         _memcache_expiration,_result_type,
+                         _negative_ttl,**kwds).get_result()
+  
+  @classmethod
+  def get_async(cls,keys,_storage = [MEMCACHE,DATASTORE],
+                _local_expiration = LOCAL_EXPIRATION,
+                _memcache_expiration = MEMCACHE_EXPIRATION,
+                _result_type=LIST,
+                _negative_ttl=None,
+                **kwds):
+    """Asynchronous version of pdb.get, takes the same arguments.
+    
+    Local cache is read right away, memcache lookup is started and
+    keys that missed every layer recently on this instance are requested 
+    from datastore in parallel with it, unless _negative_ttl is given
+    and memcache tombstones answer them. Remaining datastore reads
+    are started when the result is requested.
+    
+    Cascaded cache refresh writes to memcache are not waited for.
+    
+    Returns:
+      A _GetFuture instance, call get_result() on it to receive 
+      the result in the format pdb.get would return.
+    """
     _storage = _to_list(_storage)
     _validate_storage(_storage)
+    if _result_type not in (LIST,DICT,NAME_DICT):
+      raise ResultTypeError(_result_type)
     
     keys = map(_key_str,_to_list(keys))
-    old_keys = keys
-    local_not_found = []
-    memcache_not_found = []
-    local_flag = True if LOCAL in _storage else False
-    memcache_flag = True if MEMCACHE in _storage else False
-    models = {}
+    future = _GetFuture(keys,_storage,_local_expiration,
+                        _memcache_expiration,_result_type,
+                        _negative_ttl,kwds)
     
-    if local_flag:
-      models = dict(models,**_cachepy_get(keys))
-      keys = none_filter(models)
-      local_not_found = keys
-          
-    if memcache_flag and len(keys):
-      models = dict(models,**_memcache_get(keys))
+    if future.local_flag:
+      models = future.models
+      models.update(_cachepy_get(keys))
       keys = none_filter(models)
-      memcache_not_found = keys
+      future.local_not_found = keys
+      future.pending_keys = keys
     
+    if future.memcache_flag and len(keys):
+      rpc_keys = keys
+      if _negative_ttl:
+        rpc_keys = keys + [NEGATIVE_PREFIX+key for key in keys]
+      future.memcache_rpc = _memcache_client.get_multi_async(rpc_keys)
+      future.memcache_keys = keys
+      
     if DATASTORE in _storage and len(keys):
-      db_results = [model for model in db.get(keys) if model is not None]
-      if len(db_results):
-        models  = dict(models,**_to_dict(db_results))
-        
-    if local_flag:
-      targets = _dict_multi_get(local_not_found, models)
-      if len(targets):
-        pdb.put(targets,_storage = LOCAL,
-                _local_expiration = _local_expiration,**kwds)  
+      if future.memcache_flag and _negative_ttl:
+        prefetch_keys = []
+      elif future.memcache_flag:
+        prefetch_keys = [key for key in keys if _is_likely_miss(key)]
+      else:
+        prefetch_keys = keys
+      if len(prefetch_keys):
+        future.db_rpcs.append((prefetch_keys,db.get_async(prefetch_keys)))
     
-    if memcache_flag:
-      targets = _dict_multi_get(memcache_not_found,models)
-      if len(targets):  
-        pdb.put(targets,_storage = MEMCACHE,
-                _memcache_expiration = _memcache_expiration,**kwds)
-        
-    result = []    
-    if _result_type == LIST:
-      #Restore the order of entities   
-      for key in old_keys:
-        try:
-          result.append(models[key])
-        except KeyError:
-          result.append(None)   
-      #Normalized result
-      if len(result) > 1:
-        return result
-      return result[0]
-    elif _result_type == DICT:
-      return models
-    elif _result_type == NAME_DICT:
-      result = {}
-      for k,v in models.iteritems():
-        result[_id_or_name(k)] = v
-      return result
-    else:
-      raise ResultTypeError(_result_type)
-        
-
+    return future
+  
   @classmethod
   def put(cls,models,_storage = [MEMCACHE,DATASTORE],
                       _local_expiration = LOCAL_EXPIRATION,
@@ -359,7 +505,7 @@ class pdb(object):
     _validate_storage(_storage)
     
     try: 
-      _to_dict(models)
+      to_put = _to_dict(models)
     except db.NotSavedError:
       if DATASTORE in _storage:
         keys = _put(models)
@@ -367,17 +513,31 @@ class pdb(object):
         _storage.remove(DATASTORE)
         if len(_storage):
           return pdb.put(models,_storage,**kwds)
+        to_put = {}
       else: 
         raise IdentifierNotFoundError() 
     
+    _clear_miss_hints(to_put)
+    if LOCAL not in _storage:
+      #Drops copies that'd be stale after this write
+      _cachepy_delete(to_put)
+    if MEMCACHE in _storage or DATASTORE in _storage:
+      tombstones = [NEGATIVE_PREFIX+key for key,model in to_put.iteritems() 
+                    if getattr(model,'_negative_ttl',None)]
+      if len(tombstones):
+        _memcache_client.delete_multi_async(tombstones)
+    
     if DATASTORE in _storage:
       keys = _put(models)
       
     if LOCAL in _storage:
-      keys = _cachepy_put(models, _local_expiration)
+      _cachepy_put(to_put, _local_expiration)
 
     if MEMCACHE in _storage:
-      keys = _memcache_put(models,_memcache_expiration)
+      _memcache_put(to_put,_memcache_expiration)
+    
+    if not keys:
+      keys = [_model_key(model) for model in models]
       
     if len(keys) > 1:
       return keys
@@ -387,6 +547,12 @@ class pdb(object):
       return None
 
 
+  @classmethod
+  def negative_cache_stats(cls):
+    '''Returns tombstone hits, misses that created tombstones and
+    number of datastore reads avoided by tombstones on this instance'''
+    return dict(_negative_stats)
+    
   @classmethod
   def delete(cls,keys,_storage = ALL_LEVELS):
     """Delete one or more Model instances from given storage layers
@@ -414,9 +580,33 @@ class pdb(object):
   
   class Model(db.Model):
     '''Wrapper class for db.Model
-    Adds cached storage support to common functions'''
+    Adds cached storage support to common functions
+    
+    Classes setting _negative_ttl remember missing keys for that many
+    seconds by default when read with get methods, their puts clear 
+    the tombstones. pdb.get with _negative_ttl should only be used 
+    for keys of such classes.'''
     
     _default_delimiter = '|'
+    _negative_ttl = None
+    
+    def _memo_key(self):
+      '''Returns key of the instance, computed once the key is complete'''
+      try:
+        return self._pdb_key
+      except AttributeError:
+        key = self.key() #Raises NotSavedError for incomplete keys
+        self._pdb_key = key
+        return key
+      
+    def _key_str(self):
+      '''Memoized string form of the instance key, used as cache key'''
+      try:
+        return self._pdb_key_str
+      except AttributeError:
+        key_str = str(self._memo_key())
+        self._pdb_key_str = key_str
+        return key_str
     
     def put(self,**kwds):
       """Writes this model instance to the given storage layers.
@@ -460,6 +650,7 @@ class pdb(object):
         KindError if any of the retrieved objects are not instances of the
           type associated with call to 'get'.
       '''
+      kwds.setdefault('_negative_ttl',cls._negative_ttl)
       models = pdb.get(keys,**kwds)
       
       #Class kind check
@@ -496,16 +687,29 @@ class pdb(object):
           key_names: A single key-name or a list of key-names.
           parent: Parent of instances to get.  Can be a model or key.
       """
+      kwds.setdefault('_negative_ttl',cls._negative_ttl)
+      return pdb.get(cls._key_strings_for_names(key_names,parent),**kwds)
+    
+    @classmethod
+    def get_by_key_name_async(cls,key_names, parent=None,**kwds):
+      """Asynchronous version of get_by_key_name, see pdb.get_async
+      
+      Returns:
+        A future, call get_result() on it to receive the models
+      """
+      kwds.setdefault('_negative_ttl',cls._negative_ttl)
+      return pdb.get_async(cls._key_strings_for_names(key_names,parent),**kwds)
+    
+    @classmethod
+    def _key_strings_for_names(cls,key_names,parent):
       try:
         parent = db._coerce_to_key(parent)
       except db.BadKeyError, e:
         raise db.BadArgumentError(str(e))
       
       key_names = _to_list(key_names)
-      key_strings = [_key_str(db.Key.from_path(cls.kind(), name, parent=parent))
+      return [str(db.Key.from_path(cls.kind(), name, parent=parent))
         for name in key_names]
-
-      return pdb.get(key_strings,**kwds)
     
     @classmethod
     def get_by_id(cls, ids, parent=None,**kwds):
@@ -526,6 +730,7 @@ class pdb(object):
       key_strings = [_key_str(datastore.Key.from_path(cls.kind(), id, parent=parent))
         for id in ids]
       
+      kwds.setdefault('_negative_ttl',cls._negative_ttl)
       return pdb.get(key_strings,**kwds)
     
     @classmethod
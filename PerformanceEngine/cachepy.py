@@ -15,16 +15,36 @@ Not everything are upsides. You can not use it on every case because:
 - The only way to be sure you have flushed all the GAE instances caches is doing a code upload, no code change required. 
 - The memory available depends on each GAE instance and your app. I've been able to set a 60 millions characters string which
   is like 57 MB at least. You can cache somethings but not everything. 
+
+To keep an instance from growing until it is killed, the cache is bounded by an entry and/or an estimated byte
+budget (MAX_ENTRIES, MAX_BYTES). When a set goes over budget, entries are evicted using the selected POLICY:
+
+- LRU: least recently used entry first.
+- LFU: least frequently used entry first, ties broken by recency.
+- TTL: entry closest to its expiry first, entries without expiry are evicted in LRU order after those.
+
+get/set/delete are O(1) for LRU and LFU. Expired entries are still dropped lazily when read, and every set also
+sweeps at most SWEEP_BUDGET already expired entries, so keys that are never read again don't pile up.
 """
 
 import time
+import heapq
 import logging
 import os
+import sys
+
+""" Eviction policies """
+LRU = 'lru'
+LFU = 'lfu'
+TTL = 'ttl'
 
 CACHE = {}
 STATS_HITS = 0
 STATS_MISSES = 0
 STATS_KEYS_COUNT = 0
+STATS_EVICTIONS = 0
+STATS_EXPIRATIONS = 0
+STATS_SIZE = 0
 
 """ Flag to deactivate it on local environment. """
 ACTIVE = True#False if os.environ.get('SERVER_SOFTWARE').startswith('Devel') else True
@@ -35,6 +55,17 @@ Value in seconds.
 """
 DEFAULT_CACHING_TIME = None
 
+"""
+Cache budget, None means no limit for that dimension.
+Sizes are estimates in bytes, see estimate_size.
+"""
+MAX_ENTRIES = None
+MAX_BYTES = 32 * 1024 * 1024
+POLICY = LRU
+
+""" Max number of expired entries removed on each set call """
+SWEEP_BUDGET = 20
+
 URL_KEY = 'URL_%s'
 
 """
@@ -42,83 +73,316 @@ Curious thing: A dictionary in the global scope can be referenced and changed in
 but it can not be redefined.
 """
 
+""" Expiry index shared by the sweeper and the TTL policy, items are (expiry, key) tuples """
+EXPIRY_HEAP = []
+
+_getsizeof = getattr(sys, 'getsizeof', None) # Not available before python 2.6
+_CONTAINER_TYPES = (list, tuple, set, frozenset) # set is redefined below
+_NOT_GIVEN = object()
+
+class _Node(object):
+    """ Cache entry, also a link of the policy lists """
+    __slots__ = ('prev', 'next', 'key', 'value', 'expiry', 'size', 'freq')
+
+    def __init__(self, key=None, value=None, expiry=None, size=0):
+        self.prev = self.next = self
+        self.key = key
+        self.value = value
+        self.expiry = expiry
+        self.size = size
+        self.freq = 1
+
+class _LinkedList(object):
+    """ Circular doubly linked list with a sentinel, oldest node first """
+
+    def __init__(self):
+        self.root = _Node()
+        self.length = 0
+
+    def append(self, node):
+        last = self.root.prev
+        node.prev, node.next = last, self.root
+        last.next = self.root.prev = node
+        self.length += 1
+
+    def remove(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = node.next = node
+        self.length -= 1
+
+    def first(self):
+        if self.length:
+            return self.root.next
+        return None
+
+class _LRUPolicy(object):
+
+    def __init__(self):
+        self.order = _LinkedList()
+
+    def add(self, node):
+        self.order.append(node)
+
+    def touch(self, node):
+        self.order.remove(node)
+        self.order.append(node)
+
+    def remove(self, node):
+        self.order.remove(node)
+
+    def victim(self):
+        return self.order.first()
+
+class _LFUPolicy(object):
+    """ O(1) LFU: one recency list per use count """
+
+    def __init__(self):
+        self.buckets = {}
+        self.min_freq = 0
+
+    def _bucket(self, freq):
+        bucket = self.buckets.get(freq)
+        if bucket is None:
+            bucket = self.buckets[freq] = _LinkedList()
+        return bucket
+
+    def _unlink(self, node):
+        bucket = self.buckets[node.freq]
+        bucket.remove(node)
+        if not bucket.length:
+            del self.buckets[node.freq]
+
+    def add(self, node):
+        node.freq = 1
+        self._bucket(1).append(node)
+        self.min_freq = 1
+
+    def touch(self, node):
+        self._unlink(node)
+        if node.freq == self.min_freq and node.freq not in self.buckets:
+            self.min_freq += 1
+        node.freq += 1
+        self._bucket(node.freq).append(node)
+
+    def remove(self, node):
+        self._unlink(node)
+
+    def victim(self):
+        if not self.buckets:
+            return None
+        if self.min_freq not in self.buckets:
+            # Only happens after a removal emptied the lowest bucket
+            self.min_freq = min(self.buckets)
+        return self.buckets[self.min_freq].first()
+
+class _TTLPolicy(_LRUPolicy):
+    """ Evicts the entry that would expire first, falls back to LRU for entries without expiry """
+
+    def victim(self):
+        while EXPIRY_HEAP:
+            expiry, key = EXPIRY_HEAP[0]
+            node = CACHE.get(key)
+            if node is not None and node.expiry == expiry:
+                return node
+            heapq.heappop(EXPIRY_HEAP) # Stale index item
+        return self.order.first()
+
+_POLICIES = {LRU: _LRUPolicy, LFU: _LFUPolicy, TTL: _TTLPolicy}
+_policy = _POLICIES[POLICY]()
+
+def estimate_size( value, depth = 3 ):
+    """ 
+    Rough estimate of the memory used by value in bytes.
+    Containers and object attributes are followed up to depth levels, 
+    so the cost is bounded by the size of the value and not by the cache size.
+    """
+    if _getsizeof is not None:
+        try:
+            size = _getsizeof( value )
+        except TypeError:
+            size = 64
+    elif isinstance( value, basestring ):
+        size = 40 + len( value )
+    else:
+        size = 64
+        
+    if depth <= 0 or isinstance( value, basestring ):
+        return size
+    
+    depth -= 1
+    if isinstance( value, _CONTAINER_TYPES ):
+        for item in value:
+            size += estimate_size( item, depth )
+    elif isinstance( value, dict ):
+        for k, v in value.iteritems():
+            size += estimate_size( k, depth ) + estimate_size( v, depth )
+    elif hasattr( value, '__dict__' ):
+        size += estimate_size( value.__dict__, depth )
+    return size
+
 def get( key ):
     """ Gets the data associated to the key or a None """
     if ACTIVE is False:
         return None
         
-    global CACHE, STATS_MISSES, STATS_HITS
+    global STATS_MISSES, STATS_HITS, STATS_EXPIRATIONS
         
     """ Return a key stored in the python instance cache or a None if it has expired or it doesn't exist """
-    if key not in CACHE:
+    node = CACHE.get( key )
+    if node is None:
         STATS_MISSES += 1
         return None
     
-    value, expiry = CACHE[key]
-    current_timestamp = time.time()
-    if expiry == None or current_timestamp < expiry:
+    if node.expiry == None or time.time() < node.expiry:
         STATS_HITS += 1
-        return value
+        _policy.touch( node )
+        return node.value
     else:
         STATS_MISSES += 1
+        STATS_EXPIRATIONS += 1
         delete( key )
         return None
 
-def set( key, value, expiry = DEFAULT_CACHING_TIME ):
+def set( key, value, expiry = DEFAULT_CACHING_TIME, size = None ):
     """
     Sets a key in the current instance
     key, value, expiry seconds till it expires 
+    size is the estimated size in bytes of value, it is computed with estimate_size if not given
     """
     if ACTIVE is False:
         return None
     
-    global CACHE, STATS_KEYS_COUNT
-    if key not in CACHE:
-        STATS_KEYS_COUNT += 1
+    global STATS_KEYS_COUNT, STATS_SIZE
+    now = time.time()
     if expiry != None:
-        expiry = time.time() + int( expiry )
+        expiry = now + int( expiry )
+    if size is None:
+        size = estimate_size( value )
+        
+    delete( key )
+    if MAX_BYTES is not None and size > MAX_BYTES:
+        logging.info( "%s value for key '%s' is larger than cache budget: %d bytes" % ( __name__, key, size ) )
+        return None
     
     try:
-        CACHE[key] = ( value, expiry )
+        node = _Node( key, value, expiry, size )
+        CACHE[key] = node
+        _policy.add( node )
+        if expiry != None:
+            heapq.heappush( EXPIRY_HEAP, ( expiry, key ) )
     except MemoryError:
         """ It doesn't seems to catch the exception, something in the GAE's python runtime probably """
         logging.info( "%s memory error setting key '%s'" % ( __name__, key ) )
+        return None
+    
+    STATS_KEYS_COUNT += 1
+    STATS_SIZE += size
+    _sweep( now, SWEEP_BUDGET )
+    _evict()
  
 def delete( key ):
     """ 
     Deletes the key stored in the cache of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing, use expiry when setting a value instead.
     """
-    global CACHE, STATS_KEYS_COUNT
-    if key in CACHE:
+    global STATS_KEYS_COUNT, STATS_SIZE
+    node = CACHE.pop( key, None )
+    if node is not None:
+        _policy.remove( node )
         STATS_KEYS_COUNT -= 1
-        del CACHE[key]
+        STATS_SIZE -= node.size
+
+def _over_budget():
+    return ( MAX_ENTRIES is not None and STATS_KEYS_COUNT > MAX_ENTRIES ) or \
+           ( MAX_BYTES is not None and STATS_SIZE > MAX_BYTES )
+
+def _evict():
+    """ Removes entries chosen by the eviction policy until cache is within budget """
+    global STATS_EVICTIONS
+    while _over_budget():
+        node = _policy.victim()
+        if node is None:
+            break
+        delete( node.key )
+        STATS_EVICTIONS += 1
+
+def _sweep( now, budget ):
+    """ Drops at most budget expired entries, oldest expiry first """
+    global STATS_EXPIRATIONS
+    while EXPIRY_HEAP and budget > 0 and EXPIRY_HEAP[0][0] <= now:
+        expiry, key = heapq.heappop( EXPIRY_HEAP )
+        node = CACHE.get( key )
+        if node is not None and node.expiry == expiry:
+            delete( key )
+            STATS_EXPIRATIONS += 1
+            budget -= 1
+    
+    # Overwritten keys leave stale items behind, rebuild index when they dominate it
+    if len( EXPIRY_HEAP ) > 2 * STATS_KEYS_COUNT + 64:
+        EXPIRY_HEAP[:] = [( node.expiry, key ) for key, node in CACHE.iteritems() 
+                          if node.expiry != None]
+        heapq.heapify( EXPIRY_HEAP )
+
+def configure( policy = None, max_entries = _NOT_GIVEN, max_bytes = _NOT_GIVEN, sweep_budget = None ):
+    """
+    Changes eviction policy and cache budget of the current instance.
+    Existing entries are kept, they are evicted right away if they don't fit the new budget.
+    """
+    global POLICY, MAX_ENTRIES, MAX_BYTES, SWEEP_BUDGET, _policy
+    if max_entries is not _NOT_GIVEN:
+        MAX_ENTRIES = max_entries
+    if max_bytes is not _NOT_GIVEN:
+        MAX_BYTES = max_bytes
+    if sweep_budget is not None:
+        SWEEP_BUDGET = sweep_budget
+    if policy is not None and policy != POLICY:
+        if policy not in _POLICIES:
+            raise ValueError( "Invalid cache policy: %s" % policy )
+        POLICY = policy
+        _policy = _POLICIES[policy]()
+        for node in CACHE.itervalues():
+            _policy.add( node )
+    _evict()
 
 def dump():
     """
     Returns the cache dictionary with all the data of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing.
     """
-    global CACHE
-    return CACHE
+    result = {}
+    for key, node in CACHE.iteritems():
+        result[key] = ( node.value, node.expiry )
+    return result
 
 def flush():
     """
     Resets the cache of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing.
     """
-    global CACHE, STATS_KEYS_COUNT
+    global CACHE, STATS_KEYS_COUNT, STATS_SIZE, _policy
     CACHE = {}
+    EXPIRY_HEAP[:] = []
+    _policy = _POLICIES[POLICY]()
     STATS_KEYS_COUNT = 0
+    STATS_SIZE = 0
     
 def stats():
-    """ Return the hits and misses stats, the number of keys and the cache memory address of the current instance, not all the instances."""
-    global CACHE, STATS_MISSES, STATS_HITS, STATS_KEYS_COUNT
+    """ 
+    Return the hits and misses stats, the number of keys and the cache memory address of the current instance, not all the instances.
+    Also includes eviction counts and estimated resident size in bytes.
+    """
     memory_address = "0x" + str("%X" % id( CACHE )).zfill(16)
     return {'cache_memory_address': memory_address,
             'hits': STATS_HITS,
             'misses': STATS_MISSES ,
             'keys_count': STATS_KEYS_COUNT,
+            'evictions': STATS_EVICTIONS,
+            'expirations': STATS_EXPIRATIONS,
+            'size': STATS_SIZE,
+            'policy': POLICY,
+            'max_entries': MAX_ENTRIES,
+            'max_bytes': MAX_BYTES,
             }
     
 def cacheit( keyformat, expiry=DEFAULT_CACHING_TIME ):
@@ -132,4 +396,4 @@ def cacheit( keyformat, expiry=DEFAULT_CACHING_TIME ):
                 set( key, data, expiry )
             return data
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
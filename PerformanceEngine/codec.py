@@ -0,0 +1,229 @@
+'''
+Codecs used by PerformanceEngine for writing models into memcache.
+
+Every codec has encode(models) and decode(data) methods, models being
+a single db.Model instance or a list of them. The codec used for encoding
+is selected with set_codec, decoding detects the format so values written
+by another codec are still readable.
+
+ProtobufCodec
+  Encodes every model with db.model_to_protobuf, lists are stored as
+  a list of encoded strings. This was the only format before codecs were added.
+
+PackedCodec
+  Schema aware format. Property names of each kind are written once in a header,
+  each model is written as a (kind index, key, property values, saved) tuple and 
+  the whole result, list or not, is stored as a single string. Results larger than
+  compress_threshold bytes are compressed with zlib.
+  Expando models are encoded with ProtobufCodec, dynamic properties are not 
+  part of the kind schema. Values of properties removed from a model class 
+  since encoding are dropped on decode.
+'''
+from google.appengine.ext import db
+from google.appengine.datastore import entity_pb
+
+import zlib
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+PROTOBUF = 'protobuf'
+PACKED = 'packed'
+
+class ProtobufCodec(object):
+
+  def encode(self,models):
+    if models is None:
+      return None
+    elif isinstance(models, db.Model):
+      # Just one instance
+      return db.model_to_protobuf(models).Encode()
+    else:
+      # A list
+      return [db.model_to_protobuf(x).Encode() for x in models]
+
+  def decode(self,data):
+    if data is None:
+      return None
+    elif isinstance(data, str):
+      # Just one instance
+      return db.model_from_protobuf(entity_pb.EntityProto(data))
+    else:
+      return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
+
+class PackedCodec(object):
+
+  MAGIC = 'PE1'
+  RAW = 'r'
+  COMPRESSED = 'z'
+
+  def __init__(self,compress_threshold=1024,compress_level=1):
+    self.compress_threshold = compress_threshold
+    self.compress_level = compress_level
+    self._schemas = {} #model class => (property names,properties,key flags)
+
+  def _schema(self,klass):
+    try:
+      return self._schemas[klass]
+    except KeyError:
+      names = sorted(klass.properties().keys())
+      props = [klass.properties()[name] for name in names]
+      key_flags = [_is_key_property(prop) for prop in props]
+      schema = self._schemas[klass] = (tuple(names),props,key_flags)
+      return schema
+
+  def encode(self,models):
+    if models is None:
+      return None
+
+    is_list = not isinstance(models,db.Model)
+    if not is_list:
+      if isinstance(models,db.Expando):
+        return CODECS[PROTOBUF].encode(models)
+      models = [models]
+    else:
+      for model in models:
+        if isinstance(model,db.Expando):
+          return CODECS[PROTOBUF].encode(models)
+
+    headers = [] # (kind,property names) per kind
+    kind_indexes = {}
+    rows = []
+    for model in models:
+      klass = model.__class__
+      names,props,key_flags = self._schema(klass)
+      try:
+        kind_index = kind_indexes[klass]
+      except KeyError:
+        kind_index = kind_indexes[klass] = len(headers)
+        headers.append((klass.kind(),names))
+
+      values = []
+      for prop,is_key in zip(props,key_flags):
+        value = prop.get_value_for_datastore(model)
+        if is_key:
+          value = _key_to_str(value)
+        elif isinstance(value,basestring):
+          value = _plain_string(value)
+        values.append(value)
+
+      key = model.key()
+      parent = key.parent()
+      if parent is not None:
+        parent = str(parent)
+      rows.append((kind_index,key.name() or key.id(),parent,tuple(values),
+                   model.is_saved()))
+
+    data = pickle.dumps((is_list,headers,rows),pickle.HIGHEST_PROTOCOL)
+    if len(data) > self.compress_threshold:
+      return self.MAGIC+self.COMPRESSED+zlib.compress(data,self.compress_level)
+    return self.MAGIC+self.RAW+data
+
+  def decode(self,data):
+    if data is None:
+      return None
+
+    magic_length = len(self.MAGIC)
+    flag = data[magic_length]
+    data = data[magic_length+1:]
+    if flag == self.COMPRESSED:
+      data = zlib.decompress(data)
+    is_list,headers,rows = pickle.loads(data)
+
+    schemas = []
+    for kind,names in headers:
+      klass = db.class_for_kind(kind)
+      properties = klass.properties()
+      #Properties removed since encoding are skipped
+      props = [properties.get(name) for name in names]
+      schemas.append((kind,klass,names,props,
+                      [prop is not None and _is_key_property(prop) 
+                       for prop in props]))
+
+    result = []
+    for kind_index,id_or_name,parent,values,saved in rows:
+      kind,klass,names,props,key_flags = schemas[kind_index]
+      if parent is not None:
+        parent = db.Key(parent)
+      kwds = {}
+      for name,prop,is_key,value in zip(names,props,key_flags,values):
+        if prop is None:
+          continue
+        if is_key:
+          value = _str_to_key(value)
+        kwds[name] = prop.make_value_from_datastore(value)
+      model = klass(key=db.Key.from_path(kind,id_or_name,parent=parent),**kwds)
+      if saved:
+        #Models read from or written to datastore have an entity
+        model._populate_internal_entity()
+      result.append(model)
+
+    if is_list:
+      return result
+    return result[0]
+
+  @classmethod
+  def is_packed(cls,data):
+    return isinstance(data,str) and data.startswith(cls.MAGIC)
+
+def _is_key_property(prop):
+  return isinstance(prop,db.ReferenceProperty) or \
+    (isinstance(prop,db.ListProperty) and prop.item_type is db.Key)
+
+def _key_to_str(value):
+  if value is None:
+    return None
+  elif isinstance(value,list):
+    return [str(key) for key in value]
+  return str(value)
+
+def _str_to_key(value):
+  if value is None:
+    return None
+  elif isinstance(value,list):
+    return [db.Key(key) for key in value]
+  return db.Key(value)
+
+def _plain_string(value):
+  '''db.Link,db.Text etc. are pickled with their class name otherwise,
+  properties convert them back on assignment'''
+  if isinstance(value,unicode):
+    if type(value) is not unicode:
+      return unicode(value)
+  elif type(value) is not str:
+    return str(value)
+  return value
+
+CODECS = {
+  PROTOBUF: ProtobufCodec(),
+  PACKED: PackedCodec(),
+}
+
+_codec = CODECS[PACKED]
+
+def set_codec(name):
+  '''Select the codec used for encoding, see CODECS'''
+  global _codec
+  try:
+    _codec = CODECS[name]
+  except KeyError:
+    raise CodecError(name)
+
+def get_codec():
+  return _codec
+
+def encode(models):
+  return _codec.encode(models)
+
+def decode(data):
+  if PackedCodec.is_packed(data):
+    return CODECS[PACKED].decode(data)
+  return CODECS[PROTOBUF].decode(data)
+
+class CodecError(Exception):
+  def __init__(self,name):
+    self.name = name
+  def __str__(self):
+    return  'Codec name invalid: %s. Valid values are %s' %(self.name,', '.join(CODECS.keys()))
@@ -0,0 +1,134 @@
+'''
+Bounded retry policies for transient API errors.
+
+A RetryPolicy retries a call while it raises one of retry_on exceptions,
+sleeping with exponential backoff and full jitter between attempts.
+It gives up and re-raises the last error when max_attempts is reached
+or when the next sleep would go over time_budget seconds.
+
+  TASKQUEUE_RETRY = RetryPolicy('taskqueue',retry_on=taskqueue.TransientError)
+
+  @TASKQUEUE_RETRY
+  def enqueue(task):
+    queue.add(task)
+
+  keys = DATASTORE_RETRY.run(db.put,models)
+
+  future = DATASTORE_RETRY.run_async(db.put_async,models)
+  keys = future.get_result()
+
+Calls, retries, give ups and time spent sleeping are counted
+per call site in the current instance, see stats().
+'''
+import logging
+import random
+import time
+
+_stats = {} #call site => counter dict
+
+class RetryPolicy(object):
+
+  def __init__(self,name,retry_on = (Exception,),
+               max_attempts = 5,
+               initial_delay = 0.1,
+               max_delay = 2.0,
+               multiplier = 2,
+               jitter = True,
+               time_budget = 10):
+    self.name = name
+    if not isinstance(retry_on,tuple):
+      retry_on = (retry_on,)
+    self.retry_on = retry_on
+    self.max_attempts = max_attempts
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.multiplier = multiplier
+    self.jitter = jitter
+    self.time_budget = time_budget
+
+  def __call__(self,fn):
+    '''Decorator, metrics are kept under policy name.function name'''
+    site = '%s.%s' %(self.name,fn.__name__)
+    def retrying(*args,**kwargs):
+      return self._run(site,fn,args,kwargs)
+    retrying.__name__ = fn.__name__
+    retrying.__doc__ = fn.__doc__
+    return retrying
+
+  def run(self,fn,*args,**kwargs):
+    return self._run(self.name,fn,args,kwargs)
+
+  def run_async(self,fn,*args,**kwargs):
+    '''fn returns an object with get_result (RPC, future),
+    the call is repeated when get_result raises a retryable error'''
+    return RetryFuture(self,fn,args,kwargs)
+
+  def delay(self,attempt):
+    '''Seconds to wait after given failed attempt, starting from 1'''
+    delay = min(self.max_delay,
+                self.initial_delay * self.multiplier ** (attempt-1))
+    if self.jitter:
+      delay = random.uniform(0,delay)
+    return delay
+
+  def _run(self,site,fn,args,kwargs):
+    start = time.time()
+    attempt = 1
+    _record(site,'calls')
+    while True:
+      try:
+        return fn(*args,**kwargs)
+      except self.retry_on, e:
+        delay = self._backoff(site,start,attempt,e)
+        time.sleep(delay)
+        attempt += 1
+
+  def _backoff(self,site,start,attempt,error):
+    '''Returns seconds to sleep before next attempt,
+    re-raises error if the policy is exhausted'''
+    delay = self.delay(attempt)
+    if attempt >= self.max_attempts or \
+       time.time() - start + delay > self.time_budget:
+      _record(site,'failures')
+      logging.warning('%s failed after %s attempts: %r' %(site,attempt,error))
+      raise
+    _record(site,'retries')
+    _record(site,'sleep',delay)
+    return delay
+
+class RetryFuture(object):
+  '''Pending result of RetryPolicy.run_async'''
+
+  def __init__(self,policy,fn,args,kwargs):
+    self.policy = policy
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs
+    self.start = time.time()
+    _record(policy.name,'calls')
+    self.rpc = fn(*args,**kwargs)
+
+  def get_result(self):
+    attempt = 1
+    while True:
+      try:
+        return self.rpc.get_result()
+      except self.policy.retry_on, e:
+        delay = self.policy._backoff(self.policy.name,self.start,attempt,e)
+        time.sleep(delay)
+        attempt += 1
+        self.rpc = self.fn(*self.args,**self.kwargs)
+
+def _record(site,name,value = 1):
+  try:
+    counters = _stats[site]
+  except KeyError:
+    counters = _stats[site] = {'calls':0,'retries':0,'failures':0,'sleep':0}
+  counters[name] += value
+
+def stats():
+  '''Returns call site => {'calls','retries','failures','sleep'} dictionary'''
+  return dict([(site,dict(counters)) for site,counters in _stats.iteritems()])
+
+def reset_stats():
+  _stats.clear()
@@ -9,6 +9,7 @@ import tweepy_bucket
 from tweepy.api import API
 from tweepy_bucket.models import SimpleStatus
 from tweepy_bucket.stream import BucketListener
+from tweepy_bucket.upload import UploadPipeline
 
 
 
@@ -16,8 +17,12 @@ def main():
     # Prompt for login credentials and setup stream object
     username = ''
     password = ''
+    #pipeline = UploadPipeline('http://localhost:8000/task/')
+    pipeline = UploadPipeline('http://tweethitapp.appspot.com/task/')
     stream = tweepy.Stream(username, password, 
-                    BucketListener(ban_list_path = 'banned_users.txt'),
+                    BucketListener(pipeline = pipeline,
+                                   ban_list_path = 'banned_users.txt',
+                                   ban_filter_url = 'http://tweethitapp.appspot.com/banlist/users/'),
                     timeout=None)
 
 
@@ -53,6 +58,8 @@ def main():
     except KeyboardInterrupt:
         print 'Disconnecting stream'
         stream.disconnect()
+        print 'Uploading remaining batches'
+        pipeline.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
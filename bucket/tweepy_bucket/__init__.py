@@ -1 +1,9 @@
+import os
+import sys
+
+#Payload wire format is shared with the app, see tweethit/utils/payload_codec.py
+_app_root = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if _app_root not in sys.path:
+    sys.path.append(_app_root)
+
 from tweepy_bucket.models import SimpleStatus
\ No newline at end of file
@@ -0,0 +1,76 @@
+import re
+import urlparse
+
+URL_PATTERN = re.compile("http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+")
+
+#Punctuation that ends a sentence rather than a url
+TRAILING_CHARS = '.,;:!?)]}\'"'
+
+#Hosts that never redirect to a product page
+SKIP_DOMAINS = frozenset([
+    'twitter.com', 'twitpic.com', 'yfrog.com', 'plixi.com', 'lockerz.com',
+    'instagr.am', 'instagram.com', 'youtube.com', 'youtu.be',
+    'facebook.com', 'fb.me', 'foursquare.com', '4sq.com',
+    'tumblr.com', 'flickr.com', 'flic.kr', 'twitvid.com', 'tweetphoto.com',
+])
+
+class UrlExtractor(object):
+    """Extracts normalized, unique urls from tweet text
+
+    Urls are taken from tweet entities when the status has them,
+    otherwise text without 'http' is rejected before the pattern runs.
+    Urls on skip_domains or their subdomains are dropped.
+    """
+    def __init__(self, skip_domains=SKIP_DOMAINS):
+        self.skip_domains = skip_domains
+
+    def extract(self, text, entities=None):
+        """Returns urls in order of appearance, empty list if none
+
+        entities is the entities dictionary of the status, if any
+        """
+        if entities is not None and 'urls' in entities:
+            urls = [entity.get('expanded_url') or entity.get('url')
+                    for entity in entities['urls']]
+        elif 'http' in text:
+            urls = URL_PATTERN.findall(text)
+        else:
+            return []
+        result = []
+        seen = set()
+        for url in urls:
+            if not url:
+                continue
+            url = self.normalize(url)
+            if url is None or url in seen:
+                continue
+            seen.add(url)
+            result.append(url)
+        return result
+
+    def normalize(self, url):
+        """Returns url with lower case scheme and host, without fragment,
+        default port and trailing punctuation. None for skipped urls"""
+        url = url.rstrip(TRAILING_CHARS)
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        scheme = scheme.lower()
+        host = netloc.lower()
+        if ':' in host:
+            host, port = host.split(':', 1)
+            if (scheme, port) not in (('http', '80'), ('https', '443')):
+                host = host + ':' + port
+        if not host or self.is_skipped(host):
+            return None
+        return urlparse.urlunsplit((scheme, host, path or '/', query, ''))
+
+    def is_skipped(self, host):
+        if host.startswith('www.'):
+            host = host[4:]
+        if host in self.skip_domains:
+            return True
+        dot = host.find('.')
+        while dot != -1:
+            if host[dot + 1:] in self.skip_domains:
+                return True
+            dot = host.find('.', dot + 1)
+        return False
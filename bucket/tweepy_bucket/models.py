@@ -2,6 +2,15 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+
+import httplib
+import logging
+import threading
+import time
+import urllib2
+
+from tweethit.utils import payload_codec
+from tweethit.utils.bloom import BloomFilter, BloomFilterError
     
 class SimpleStatus(object):
     
@@ -18,58 +27,204 @@ class SimpleUrl(dict):
         #self['screen_name'] = author.screen_name
     
 class BanList(object):
+    """Bloom filters of banned user ids
+
+    Ids in file_path are loaded into a local filter. If filter_url is
+    given, the filter published by the app is downloaded in a background
+    thread every refresh_interval seconds with conditional GETs, so bans
+    added on the server reach the client.
 
-    def __init__(self,file_path = None):
+    Filters may report a few users that aren't banned, the app checks
+    its own ban list again for mentions that pass.
+    """
+    def __init__(self,file_path = None,filter_url = None,
+                 refresh_interval = 600,timeout = 10,error_rate = 0.001):
         print 'BanList initializing'
-        if file_path is None:
-            print 'Creating empty filter'
-            self.ban_list = set()
-            return
+        self.local_filter = None
+        self.remote_filter = None
+        self.filter_url = filter_url
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.etag = None
         
-        print 'BanList initializing'
-        print 'Opening file'
-        file = open(file_path,'r')
-        print 'Creating ban filter'
-        array = [line for line in file]
-        self.ban_list = set(map(lambda line: line.rstrip(), array))
-        print 'Created ban filter with %s elements' %len(self.ban_list)
-
+        if file_path is not None:
+            print 'Opening file'
+            file = open(file_path,'r')
+            ids = [line.rstrip() for line in file if line.strip()]
+            file.close()
+            self.local_filter = BloomFilter.from_items(ids,error_rate)
+            print 'Created ban filter with %s elements' %len(ids)
+            
+        if filter_url is not None:
+            self.refresh()
+            thread = threading.Thread(target=self._refresh_loop)
+            thread.setDaemon(True)
+            thread.start()
 
     def check_ban(self,user_id):
-        if str(user_id) in self.ban_list:
-            return True
-        else:
-            return False    
+        user_id = str(user_id)
+        for ban_filter in (self.local_filter,self.remote_filter):
+            if ban_filter is not None and user_id in ban_filter:
+                return True
+        return False
+
+    def refresh(self):
+        """Downloads the published filter if it changed, returns True if replaced"""
+        request = urllib2.Request(self.filter_url)
+        if self.etag is not None:
+            request.add_header('If-None-Match',self.etag)
+        try:
+            response = urllib2.urlopen(request,timeout=self.timeout)
+            data = response.read()
+        except urllib2.HTTPError, e:
+            if e.code != 304:
+                logging.error('Ban filter download failed: %s' %e.code)
+            return False
+        except (httplib.HTTPException, IOError), e:
+            logging.error('Ban filter download failed: %r' %e)
+            return False
+        
+        try:
+            self.remote_filter = BloomFilter.from_bytes(data)
+        except BloomFilterError, e:
+            logging.error('Invalid ban filter: %s' %e)
+            return False
+        self.etag = response.info().getheader('ETag')
+        print 'Downloaded ban filter of %s bytes' %len(data)
+        return True
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+
+class LRU(object):
+    """Bounded mapping that evicts least recently used keys"""
+
+    def __init__(self,max_size):
+        self.max_size = max_size
+        self._map = {} #key => [prev,next,key,value]
+        self._root = root = []
+        root[:] = [root,root,None,None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def get(self,key,default = None):
+        try:
+            node = self._map[key]
+        except KeyError:
+            return default
+        self._move_to_end(node)
+        return node[3]
+
+    def put(self,key,value):
+        """Returns evicted (key,value) or None"""
+        try:
+            node = self._map[key]
+            node[3] = value
+            self._move_to_end(node)
+            return None
+        except KeyError:
+            pass
+        root = self._root
+        last = root[0]
+        node = [last,root,key,value]
+        last[1] = root[0] = self._map[key] = node
+        if len(self._map) > self.max_size:
+            oldest = root[1]
+            self._unlink(oldest)
+            del self._map[oldest[2]]
+            return oldest[2],oldest[3]
+        return None
+
+    def items(self):
+        """Items from least to most recently used"""
+        result = []
+        node = self._root[1]
+        while node is not self._root:
+            result.append((node[2],node[3]))
+            node = node[1]
+        return result
+
+    def clear(self):
+        self._map.clear()
+        self._root[:] = [self._root,self._root,None,None]
+
+    def _unlink(self,node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _move_to_end(self,node):
+        self._unlink(node)
+        root = self._root
+        last = root[0]
+        node[0] = last
+        node[1] = root
+        last[1] = root[0] = node
 
 
 class Bucket(object):
-    def __init__(self,bucket_size = 1000):
+    """Aggregates url mentions until it is poured
+
+    Mentions of a url by the same user become a single (url,user_id,count)
+    item. Urls are kept in an LRU of max_urls, so memory stays bounded
+    while viral urls keep being aggregated; evicted urls are sent with 
+    the next pour. The bucket is full after bucket_size distinct items.
+    """
+    def __init__(self,bucket_size = 1000,max_urls = 10000):
         self.bucket_size = bucket_size
-        self._items = []
+        self._urls = LRU(max_urls) #url => {user_id: count}
+        self._evicted = [] #items of urls evicted from LRU
+        self._size = 0 #distinct (url,user_id) items
+        self.mentions = 0
         self.is_full = False
         
     def get_items(self):
-        return self._items
+        items = list(self._evicted)
+        for url,users in self._urls.items():
+            items.extend(_url_items(url,users))
+        return items
     
     def set_items(self,val):
         pass
         
-    def add_item(self,status):
-        self._items.append(status)
-        if len(self._items) == self.bucket_size:
+    def add_item(self,simple_url):
+        url = simple_url['url']
+        user_id = simple_url['user_id']
+        users = self._urls.get(url)
+        if users is None:
+            users = {}
+            evicted = self._urls.put(url,users)
+            if evicted is not None:
+                self._evicted.extend(_url_items(*evicted))
+        if user_id in users:
+            users[user_id] += 1
+        else:
+            users[user_id] = 1
+            self._size += 1
+        self.mentions += 1
+        if self._size >= self.bucket_size:
             self.is_full = True
         
     def pour(self):
-        print "Pouring bucket with length %d" % len(self._items)
+        items = self.get_items()
+        print "Pouring bucket with %d items for %d mentions" % (len(items),self.mentions)
         
-        seq = self._items[0:self.bucket_size]
-        
-        del self._items[0:self.bucket_size]
+        self._urls.clear()
+        self._evicted = []
+        self._size = 0
+        self.mentions = 0
         self.is_full = False
-        return repr(seq)
+        return payload_codec.to_param(payload_codec.encode(items))
         
         
     def test_arr(self):
         arr = ['a','b','c','d','e']
         return pickle.dumps(arr)
     items = property(get_items,set_items)
+
+def _url_items(url,users):
+    return [{'url':url,'user_id':user_id,'count':count} 
+            for user_id,count in users.iteritems()]
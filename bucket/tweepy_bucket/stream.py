@@ -1,6 +1,8 @@
 from tweepy import StreamListener
 from tweepy.api import API
 from models import *
+from upload import UploadPipeline
+from extract import UrlExtractor
 import logging
 import sys
 
@@ -10,16 +12,15 @@ class BucketListener(StreamListener):
     logging.basicConfig(filename=LOG_FILENAME,level=logging.DEBUG)
     
     
-    def __init__(self,api = None,bucket = None,ban_list_path = None):
+    def __init__(self,api = None,pipeline = None,ban_list_path = None,
+                 ban_filter_url = None):
         self.api = api or API()
-        self.bucket = bucket or Bucket(bucket_size = 20)
+        self.pipeline = pipeline or UploadPipeline('http://tweethitapp.appspot.com/task/')
+        self.extractor = UrlExtractor()
         self.count = 0
         
        
-        if ban_list_path is None:
-            self.ban_list = BanList()
-        else:
-            self.ban_list = BanList(ban_list_path)
+        self.ban_list = BanList(ban_list_path,ban_filter_url)
        
     def on_status(self,status):
         try:
@@ -31,49 +32,11 @@ class BucketListener(StreamListener):
                 #print 'Filtered tweet from: %s' %status.author.screen_name
                 return
 
-            status.text.encode("utf-8")
-            urls = self.extract_urls(status.text)
-            urls = set(urls) #Eliminate duplicates
-            
-            for url in urls:
+            for url in self.extractor.extract(status.text,
+                                              getattr(status, 'entities', None)):
                 simple_url = SimpleUrl(url,status.author)
-                self.bucket.add_item(simple_url)
-   
-            if self.bucket.is_full:
-                print '\n'
-                print "BUCKET FULL"
-                data = self.bucket.pour()
-                self.post_data(data)
-                print '\n'
-
+                self.pipeline.add(simple_url)
                   
-        except:
-            # Catch any unicode errors while printing to console
-            # and just ignore them to avoid breaking application.
-            pass
-
-    def extract_urls(self,text):
-        import re
-        url_list =re.findall("http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",text)
-        
-        if len(url_list) == 0:
-            return None
-        
-        return url_list
-    
-    
-    def post_data(self,str):
-        import urllib
-        import urllib2
-        
-        #url = 'http://localhost:8000/task/'
-        url = 'http://tweethitapp.appspot.com/task/'
-        values = {'data' : str}
-
-        print "posting to url: %s" %url
-        data = urllib.urlencode(values)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req)
-        #the_page = response.read()
-        
-        
\ No newline at end of file
+        except Exception:
+            # Don't let a single bad status break the stream
+            logging.exception('Could not process status')
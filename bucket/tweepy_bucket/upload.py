@@ -0,0 +1,234 @@
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from Queue import Queue, Empty, Full
+
+from models import Bucket
+
+class UploadPipeline(object):
+    """Uploads bucket contents to the app in background threads
+
+    The stream thread only adds items. A batch is poured when the bucket
+    is full or flush_interval seconds after its first item, so repeated
+    mentions in that window are aggregated by the bucket. It is put
+    into a bounded queue consumed by upload workers, each keeping its
+    own keep-alive connection.
+
+    If the queue stays full for put_timeout seconds or an upload fails,
+    the batch is written to spill_dir. Spilled batches are uploaded
+    again when workers are idle and the server is reachable.
+    """
+    STOP = None
+
+    def __init__(self, url, workers=2, bucket_size=200, max_batches=100,
+                 flush_interval=10.0, put_timeout=1.0, timeout=10,
+                 spill_dir='spill', retry_delay=30):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts[0]
+        self.host = parts[1]
+        self.path = parts[2] or '/'
+        self.bucket = Bucket(bucket_size=bucket_size)
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.timeout = timeout
+        self.spill_dir = spill_dir
+        self.retry_delay = retry_delay
+
+        self._queue = Queue(max_batches)
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._first_item_time = None
+        self._down_until = 0
+        self._spill_count = 0
+        self._running = True
+
+        if not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        for name in os.listdir(spill_dir):
+            if name.endswith('.sending'): #Upload interrupted by exit
+                path = os.path.join(spill_dir, name)
+                os.rename(path, path[:-len('.sending')])
+
+        self._threads = [threading.Thread(target=self._upload_loop)
+                         for i in range(workers)]
+        self._threads.append(threading.Thread(target=self._timer_loop))
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def add(self, item):
+        """Adds an item, called from the stream thread"""
+        self._lock.acquire()
+        try:
+            if self._first_item_time is None:
+                self._first_item_time = time.time()
+            self.bucket.add_item(item)
+            data = None
+            if self.bucket.is_full:
+                data = self._pour()
+        finally:
+            self._lock.release()
+        if data is not None:
+            self._enqueue(data)
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            data = None
+            if self.bucket.mentions:
+                data = self._pour()
+        finally:
+            self._lock.release()
+        if data is not None:
+            self._enqueue(data)
+
+    def stop(self):
+        """Flushes the bucket and waits for queued batches to be uploaded"""
+        self.flush()
+        self._running = False
+        for thread in self._threads[:-1]:
+            self._queue.put(self.STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _pour(self):
+        self._first_item_time = None
+        return self.bucket.pour()
+
+    def _enqueue(self, data):
+        try:
+            self._queue.put(data, True, self.put_timeout)
+        except Full:
+            logging.warning('Upload queue full, spilling batch to disk')
+            self._spill(data)
+
+    def _timer_loop(self):
+        while self._running:
+            time.sleep(min(1.0, self.flush_interval))
+            first_item_time = self._first_item_time
+            if first_item_time is not None and \
+               time.time() - first_item_time >= self.flush_interval:
+                self.flush()
+
+    def _upload_loop(self):
+        connection = None
+        while True:
+            try:
+                data = self._queue.get(True, 1.0)
+            except Empty:
+                if self._running and time.time() >= self._down_until:
+                    connection = self._replay_spilled(connection)
+                continue
+            if data is self.STOP:
+                break
+            ok, connection = self._post(connection, data)
+            if not ok:
+                self._spill(data)
+        if connection is not None:
+            connection.close()
+
+    def _post(self, connection, data):
+        """Returns (uploaded, connection to reuse)
+
+        The server may close an idle keep-alive connection, so a request
+        on a reused connection that fails before the server could have
+        handled it is sent once more on a new one, see _is_stale.
+        Other failures mark the server down.
+        """
+        body = urllib.urlencode({'data': data})
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self._connect()
+            sent = False
+            try:
+                connection.request('POST', self.path, body,
+                                   {'Content-Type': 'application/x-www-form-urlencoded',
+                                    'Connection': 'keep-alive'})
+                sent = True
+                response = connection.getresponse()
+                response.read()
+                break
+            except (httplib.HTTPException, socket.error, IOError), e:
+                connection.close()
+                connection = None
+                if reused and self._is_stale(e, sent):
+                    reused = False
+                    continue
+                logging.error('Upload to %s failed: %s' % (self.host, e))
+                self._down_until = time.time() + self.retry_delay
+                return False, None
+
+        if response.status >= 500:
+            logging.error('Upload rejected by server: %s' % response.status)
+            self._down_until = time.time() + self.retry_delay
+            return False, connection
+        if response.status >= 400:
+            #Server can't parse the batch, retrying won't help
+            logging.error('Upload dropped by server: %s' % response.status)
+        return True, connection
+
+    def _is_stale(self, error, sent):
+        """True if error shows a closed keep-alive connection, so the batch
+        wasn't handled and can be sent again without counting it twice
+
+        Timeouts are never retried, the server may still be handling
+        the request. Once the body is written, only BadStatusLine, raised
+        when the connection is closed without a response, is retried.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if sent:
+            return isinstance(error, httplib.BadStatusLine)
+        return True
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _spill(self, data):
+        self._spill_lock.acquire()
+        try:
+            self._spill_count += 1
+            name = '%d-%06d.batch' % (time.time() * 1000, self._spill_count)
+        finally:
+            self._spill_lock.release()
+        path = os.path.join(self.spill_dir, name)
+        spill_file = open(path + '.tmp', 'wb')
+        try:
+            spill_file.write(data)
+        finally:
+            spill_file.close()
+        os.rename(path + '.tmp', path)
+
+    def _replay_spilled(self, connection):
+        """Uploads oldest spilled batch, if any"""
+        self._spill_lock.acquire()
+        try:
+            names = sorted([name for name in os.listdir(self.spill_dir)
+                            if name.endswith('.batch')])
+            if not len(names):
+                return connection
+            path = os.path.join(self.spill_dir, names[0])
+            claimed = path + '.sending'
+            os.rename(path, claimed)
+        finally:
+            self._spill_lock.release()
+
+        spill_file = open(claimed, 'rb')
+        try:
+            data = spill_file.read()
+        finally:
+            spill_file.close()
+        ok, connection = self._post(connection, data)
+        if ok:
+            os.remove(claimed)
+        else:
+            os.rename(claimed, path)
+        return connection
@@ -7,11 +7,64 @@ DEBUG_MODE = True if os.environ.get('SERVER_SOFTWARE').startswith('Devel') else
 PRODUCT_COUNTER_MIN_COUNT = 5
 USER_COUNTER_MIN_COUNT = 15
 
+'''Max memcache shards for a hot product counter'''
+PRODUCT_COUNTER_SHARDS = 4
+
+'''Dirty counter index partitions, in seconds and max partitions kept'''
+COUNTER_INDEX_BUCKET_SECONDS = 60
+COUNTER_INDEX_MAX_BUCKETS = 120
+
+'''Counter flush batch size and seconds spent before continuing in a new task'''
+COUNTER_FLUSH_BATCH_SIZE = 100
+COUNTER_FLUSH_TIME_BUDGET = 20
+
 "Template Limits"
 TEMPLATE_PRODUCT_COUNT = 100
 
 '''Product ban filter limit'''
 MAX_PRODUCT_INFO_RETRIES = 5
 
+'''Products looked up by one product info task, ItemLookup accepts at most 10'''
+PRODUCT_INFO_BATCH_SIZE = 10
+
 '''User ban filter limit'''
-SPAM_COUNT_LIMIT = 30
\ No newline at end of file
+SPAM_COUNT_LIMIT = 30
+
+'''Negative cache lifetimes in seconds for lookups of missing entities'''
+RENDERER_NEGATIVE_TTL = 600
+URL_NEGATIVE_TTL = 60
+'''Max mentions in a counter task built by merging buffered counter payloads'''
+COUNTER_PAYLOAD_MERGE_LIMIT = 500
+
+'''Counter ingestion: 'push' runs a fastqueue task per counter payload,
+'pull' writes payloads to counterpull queue, consumed in leased batches by cron'''
+COUNTER_INGESTION_MODE = 'push'
+COUNTER_LEASE_BATCH_SIZE = 1000
+COUNTER_LEASE_SECONDS = 60
+COUNTER_CONSUME_TIME_BUDGET = 20
+'''Seconds a leased task remembers the counter kinds it was applied to, 
+so a task leased again after a failed batch isn't counted twice'''
+COUNTER_APPLIED_EXPIRATION = 3600
+'''Use an in memory stand-in for counterpull queue, for running pull mode offline'''
+COUNTER_PULL_QUEUE_LOCAL = False
+
+'''Short url resolution cache, see Url model. 
+Only product urls are written to datastore tier, remove DATASTORE to keep cache only'''
+URL_CACHE_STORAGE = ['local','memcache','datastore']
+URL_PRODUCT_EXPIRATION = 7*86400
+URL_EXPIRATION = 86400
+URL_FAILED_EXPIRATION = 600
+
+'''Url resolver limits, see UrlResolver'''
+URL_RESOLVER_CONCURRENCY = 10
+URL_RESOLVER_HOST_LIMIT = 4
+URL_RESOLVER_MAX_REDIRECTS = 5
+
+'''Ban list shards per list, seconds between version checks and 
+max entities read when building an empty ban list'''
+BANLIST_SHARDS = 32
+BANLIST_VERSION_CHECK = 30
+BANLIST_BOOTSTRAP_LIMIT = 10000
+
+'''False positive rate of ban list filters published to bucket client'''
+BANLIST_FILTER_ERROR_RATE = 0.001
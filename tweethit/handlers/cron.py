@@ -2,36 +2,52 @@ import helipad
 import logging
 from datetime import timedelta
 
-from config import SPAM_COUNT_LIMIT
+from config import SPAM_COUNT_LIMIT,COUNTER_INGESTION_MODE
 
 from PerformanceEngine import pdb,DATASTORE,MEMCACHE,time_util
 from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError
 
 from tweethit.model import ProductCounter,UserCounter,ProductRenderer,\
-CounterBase,DAILY,WEEKLY,MONTHLY,TwitterUser,Product,Banlist
+DAILY,WEEKLY,MONTHLY,TwitterUser,Product,Banlist,COUNTER_INDEX,ROLLUP_INDEX
 
 from tweethit.query import USER_SPAM_COUNTERS,PRODUCT_RENDERER_BAN_TARGETS
-from tweethit.utils.task_util import enqueue_renderer_update,enqueue_cleanup
+from tweethit.utils.task_util import enqueue_renderer_update,enqueue_cleanup,\
+enqueue_counter_flush,enqueue_counter_consume,buffered_tasks,PULL
+from tweethit.utils.counter_util import CounterFlusher,CounterConsumer,\
+INDEX_CLOSE_SECONDS
   
 
 yesterday = lambda : time_util.today()-timedelta(days=1)
   
 class CounterUpdate(helipad.Handler):
-  '''Retrieves counters from memcache to update DB every 5 mins'''
+  '''Writes counters from memcache to DB every 5 mins
+  Continues in a task if closed index partitions can't be drained in time'''
   def get(self):
-    counter_keys = CounterBase.get_cached_counter_keys()
-    if not len(counter_keys):
+    try:
+      if not CounterFlusher(COUNTER_INDEX).run():
+        enqueue_counter_flush(COUNTER_INDEX)
+    except CapabilityDisabledError:
+      pass
+
+class CounterConsume(helipad.Handler):
+  '''Increments counters for payloads in counter pull queue every minute
+  when counters are ingested in pull mode'''
+  def get(self):
+    if COUNTER_INGESTION_MODE != PULL:
       return
-    logging.info('Counter keys retrieved: %s' %len(counter_keys))
-    counters = CounterBase.get(counter_keys,_storage=MEMCACHE)    
-    if len(counters):
-      try:
-        logging.info('Counters being inserted: %s' %len(counters))
-        pdb.put(counters, _storage=DATASTORE)
-        #Delete cached counter keys
-        CounterBase.set_cached_counter_keys([])
-      except CapabilityDisabledError:
-        pass
+    if not CounterConsumer().run():
+      enqueue_counter_consume()
+
+class RollupUpdate(helipad.Handler):
+  '''Writes weekly & monthly counters in rollup index to DB every 30 mins
+  Counter flushes write them as they roll daily counts up, this catches
+  counters whose write was missed'''
+  def get(self):
+    try:
+      if not CounterFlusher(ROLLUP_INDEX).run():
+        enqueue_counter_flush(ROLLUP_INDEX)
+    except CapabilityDisabledError:
+      pass
     
 class MinuteRating(helipad.Handler):
   '''Fetches  top product counters
@@ -39,30 +55,32 @@ class MinuteRating(helipad.Handler):
   
   Enqueues tasks to get product details from Amazon 
   if they're not listed already'''
+  @buffered_tasks
   def get(self):
     enqueue_renderer_update(DAILY,time_util.today())
       
 class DailyCleanup(helipad.Handler):
+  '''Weekly & monthly renderers are updated after counters of yesterday
+  are flushed and rolled up, see CounterFlushWorker'''
+  @buffered_tasks
   def get(self):
     date = yesterday()
-    enqueue_renderer_update(WEEKLY,date)
-    enqueue_renderer_update(MONTHLY,date)
+    enqueue_counter_flush(COUNTER_INDEX,countdown = INDEX_CLOSE_SECONDS,
+                          render_date = date)
     enqueue_cleanup(UserCounter.kind(), DAILY, date)
     enqueue_cleanup(ProductCounter.kind(), DAILY, date)
     enqueue_cleanup(ProductRenderer.kind(), DAILY, date)
     enqueue_cleanup(ProductRenderer.kind(), WEEKLY, date,countdown = 3600)
     enqueue_cleanup(ProductRenderer.kind(), MONTHLY, date,countdown = 3600)
     
-    #Delete banlist so it is refreshed with latest banned entities
-    banlist = Banlist.retrieve()
-    banlist.delete()
-    
 class WeeklyCleanup(helipad.Handler):
+  @buffered_tasks
   def get(self):
     date = yesterday()
     enqueue_cleanup(ProductCounter.kind(), WEEKLY, date,countdown = 3600)
     
 class MonthlyCleanup(helipad.Handler):
+  @buffered_tasks
   def get(self):
     date = yesterday()
     enqueue_cleanup(ProductCounter.kind(), MONTHLY, date,countdown = 3600)
@@ -83,9 +101,7 @@ class ProductBanSynch(helipad.Handler):
       renderer.is_ban_synched = True
     
     targets = [product.key().name() for product in products]
-    ban_list = Banlist.retrieve()
-    ban_list.products += targets
-    ban_list.put(_storage=[MEMCACHE,DATASTORE])     
+    Banlist.add_products(targets)
     pdb.put(products+renderers+product_counters,_storage = [MEMCACHE,DATASTORE])
   
 class BanSpammers(helipad.Handler):
@@ -101,15 +117,14 @@ class BanSpammers(helipad.Handler):
         users.append(TwitterUser(key_name = counter.key_root))
       
       targets = [user.key().name() for user in users]
-      ban_list = Banlist.retrieve()
-      ban_list.users += targets
-      ban_list.put(_storage=[MEMCACHE,DATASTORE])
-      #TwitterUser.update_banlist([user.key().name() for user in users])
+      Banlist.add_users(targets)
       logging.info('Banning users with keys: %s' %[user.key().name() for user in users])
       pdb.put(user_counters+users)
   
 main, application = helipad.app({
   '/cron/updatecounters/': CounterUpdate,
+  '/cron/rollup/': RollupUpdate,
+  '/cron/consumecounters/': CounterConsume,
   '/cron/rating/minute/': MinuteRating,
   '/cron/cleanup/day/': DailyCleanup,
   '/cron/cleanup/week/': WeeklyCleanup,
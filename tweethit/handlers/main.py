@@ -5,7 +5,8 @@ from PerformanceEngine import time_util
 
 from tweethit.utils.parser_util import date_to_str_tuple
 from tweethit.utils.task_util import prevent_transient_error
-from tweethit.model import Store,DAILY,WEEKLY,MONTHLY
+from tweethit.model import Store,Payload,Banlist,DAILY,WEEKLY,MONTHLY
+from tweethit.utils.payload_codec import PayloadCodecError
 from tweethit.query import get_renderer_query_for_frequency
 
 from config import DEBUG_MODE,TEMPLATE_PRODUCT_COUNT
@@ -191,9 +192,29 @@ class BucketHandler(helipad.Handler):
   @prevent_transient_error
   def post(self):
     data = self.request.get('data')
+    try:
+      Payload.deserialize(data) #Checks format before queueing
+    except PayloadCodecError, e:
+      logging.warning('Rejected bucket data: %s' %e)
+      self.error(400)
+      return
     taskqueue.add(url='/taskworker/bucket/', params={'data': data})
 
 
+class BanlistFilterHandler(helipad.Handler):
+  '''Serves banned users as a Bloom filter for the bucket client, 
+  ETag is the ban list version'''
+  def get(self):
+    etag = '"%s"' %Banlist.version(Banlist.USERS)
+    if self.request.headers.get('If-None-Match') == etag:
+      self.response.set_status(304)
+      return
+    version,data = Banlist.filter_bytes(Banlist.USERS)
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.headers['ETag'] = '"%s"' %version
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.out.write(data)
+
 class AffiliateRedirectHandler(helipad.Handler):
     pass
         
@@ -207,6 +228,7 @@ main, application = helipad.app([
   ('/([a-z]{2})/week/(\d{4})/(\d{2})/(\d{2})/',WeekHandler),
   ('/([a-z]{2})/month/(\d{4})/(\d{2})/',MonthHandler),
   ('/task/', BucketHandler),
+  ('/banlist/users/', BanlistFilterHandler),
   ('/.*',NotFoundHandler),
 
 ])
@@ -1,7 +1,7 @@
 import helipad
 import logging
 import pythonloader
-from PerformanceEngine import pdb
+from PerformanceEngine import pdb,cachepy,retry
 from tweethit.model import *
 from google.appengine.api import memcache
 
@@ -54,13 +54,33 @@ class BannedUsers(helipad.Handler):
       db_targets.append(TwitterUser(key_name = user_key.strip()))
     
     db.put(db_targets)
-    TwitterUser.update_banlist(users)
+    Banlist.add_users([user.key().name() for user in db_targets])
     logging.info('Added banned users')
                 
+class StatsHandler(helipad.Handler):
+  '''Plain text cache and retry stats, all but url lookups 
+  are stats of the instance serving the request'''
+  def get(self):
+    out = self.response.out
+    self.response.headers['Content-Type'] = 'text/plain'
+    out.write('Retries (calls, retries, failures, seconds slept):\n')
+    for site,counters in sorted(retry.stats().iteritems()):
+      out.write('  %s: %d %d %d %.2f\n' %(site,counters['calls'],
+                                          counters['retries'],
+                                          counters['failures'],
+                                          counters['sleep']))
+    for title,stats in [('Local cache',cachepy.stats()),
+                        ('Negative cache',pdb.negative_cache_stats()),
+                        ('Url lookups',Url.lookup_stats())]:
+      out.write('%s:\n' %title)
+      for name,value in sorted(stats.iteritems()):
+        out.write('  %s: %s\n' %(name,value))
+                
 main, application = helipad.app({
     '/remote/delete/(\w+)/': DeleteHandler,
     '/remote/delete/(\w+)/(\w+)/': DeleteKeyHandler,
     '/remote/bannedusers/':BannedUsers,
+    '/remote/stats/':StatsHandler,
 })
 
 if __name__ == '__main__':
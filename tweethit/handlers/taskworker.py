@@ -2,12 +2,14 @@ import helipad
 import logging
 
 from google.appengine.ext.db import Key
+from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError
 
 from PerformanceEngine import LOCAL,MEMCACHE,DATASTORE, \
 NAME_DICT,pdb,time_util
 
 from tweethit.model import DAILY,WEEKLY,MONTHLY,Url,Payload,\
-ProductCounter,UserCounter,ProductRenderer,Banlist
+CounterBase,ProductCounter,UserCounter,ProductRenderer,Banlist,COUNTER_INDEX,\
+ROLLUP_INDEX
 
 from tweethit.query import get_counter_query_for_frequency,\
 get_renderer_query_for_frequency,USER_COUNTER_CLEANUP_TARGETS
@@ -15,9 +17,13 @@ get_renderer_query_for_frequency,USER_COUNTER_CLEANUP_TARGETS
 from tweethit.utils.parser_util import AmazonURLParser,ParserException, \
 str_to_date
 from tweethit.utils.rpc import UrlFetcher,AmazonProductFetcher
+from tweethit.utils.payload_codec import PayloadCodecError
 
 from tweethit.utils.task_util import enqueue_cleanup,enqueue_counter, \
-enqueue_url_fetch,enqueue_renderer_info
+enqueue_url_fetch,enqueue_renderer_info,enqueue_counter_flush,buffered_tasks,\
+enqueue_counter_consume,enqueue_renderer_update
+from tweethit.utils.counter_util import CounterFlusher,CounterConsumer,\
+add_mention_deltas,INDEX_CLOSE_SECONDS
 
 from config import TEMPLATE_PRODUCT_COUNT,MAX_PRODUCT_INFO_RETRIES
 
@@ -28,18 +34,22 @@ class UrlBucketWorker(helipad.Handler):
   if fetched => prepare counter payload
   not fetched => prepare fetch payload
   '''
+  @buffered_tasks
   def post(self):
-    payloads = [Payload(simple_url['url'],simple_url['user_id']) for simple_url in eval(self.request.get('data'))]
+    try:
+      payloads = list(Payload.deserialize(self.request.get('data')))
+    except PayloadCodecError, e:
+      logging.error('Dropping malformed bucket data: %s' %e)
+      return
     
-    cached_urls = Url.get_by_key_name([payload.url for payload in payloads],
-                                      _storage = [LOCAL,MEMCACHE],
-                                      _result_type = NAME_DICT)
+    url_future = Url.get_resolved_async(list(set([payload.url for payload in payloads])))
     
-    user_ban_list = Banlist.retrieve(_storage=[LOCAL,MEMCACHE,DATASTORE],
-                                        _local_expiration=time_util.minute_expiration(minutes=10)).users
+    user_ban_list = Banlist.users()
+    cached_urls = url_future.get_result()
                                         
     fetch_targets = [] #Urls that are not in lookup list
     counter_targets = [] #Product urls that were fetched before
+    cache_hits = 0
     
     for payload in payloads:
       if payload.user_id in user_ban_list:
@@ -49,12 +59,14 @@ class UrlBucketWorker(helipad.Handler):
       #Look for existing cached instance with same short_url    
       cached_url = cached_urls[payload.url]
       if cached_url is not None:
+        cache_hits += 1
         if cached_url.is_product: #cached url points to a valid product page
           counter_targets.append(Payload(cached_url.product_url,
-                                                      payload.user_id))
+                                         payload.user_id,payload.count))
       else:
         fetch_targets.append(payload)                                 
     
+    Url.record_lookups(cache_hits,len(fetch_targets))
     if len(fetch_targets):
       urlfetch_payload = Payload.serialize(fetch_targets)
       enqueue_url_fetch(urlfetch_payload)
@@ -70,27 +82,26 @@ class UrlFetchWorker(helipad.Handler):
   If it finds any product urls, it enqueues counter payloads
   for processing
   '''
+  @buffered_tasks
   def post(self):
     logging.info('UrlFetchWorker started')
     payloads = Payload.deserialize(self.request.get('payload'))
-    product_ban_list = Banlist.retrieve(_storage=[LOCAL,MEMCACHE,DATASTORE],
-                                    _local_expiration=time_util.minute_expiration(minutes=10)).products 
+    product_ban_list = Banlist.products()
     
     fetch_targets = list(set([payload.url for payload in payloads]))
     result_dict = UrlFetcher.fetch_urls(fetch_targets)
-    urls = []
+    urls = {}
+    product_urls = {} #request url => product url
     counter_targets = []
     
     for payload in payloads:
       request_url = payload.url
-      final_url = result_dict[request_url]
-      user_id = payload.user_id
-      
-      urls.append(Url(key_name=request_url,
-                          final_url=final_url,
-                          user_id = user_id))
+      if request_url not in urls:
+        urls[request_url] = Url(key_name=request_url,
+                                final_url=result_dict[request_url],
+                                user_id = payload.user_id)
         
-    for url in urls:
+    for request_url,url in urls.iteritems():
       if url.final_url is not None:
         try:
           product_url = AmazonURLParser.product_url(url.final_url)
@@ -100,12 +111,17 @@ class UrlFetchWorker(helipad.Handler):
               continue #no action for banned product
           
           url.is_product = True #No exceptions for product_url => valid product reference
-          counter_targets.append(Payload(product_url,url.user_id))
+          product_urls[request_url] = product_url
         except ParserException:
           pass 
     
+    for payload in payloads:
+      product_url = product_urls.get(payload.url)
+      if product_url is not None:
+        counter_targets.append(Payload(product_url,payload.user_id,payload.count))
+    
     logging.info('UrlFetchWorker finished, counter targets: %s' %counter_targets)   
-    pdb.put(urls, _storage = [LOCAL,MEMCACHE]) #Urls are stored in cache only
+    Url.save_resolved(urls.values())
     
     if len(counter_targets):
       enqueue_counter(Payload.serialize(counter_targets))
@@ -114,51 +130,60 @@ class CounterWorker(helipad.Handler):
   '''Updates counter entities for twitter_user and product models
   
   Input Payload: Serialized payload objects with product and user key names
-  Output: Updates cached counter objects
+  Output: Increments memcache counters
   '''
   def post(self):
-    from collections import defaultdict
     payload_string = self.request.get('payload')
     counter_targets = Payload.deserialize(payload_string)
-    today = time_util.today()
     
-    product_targets = defaultdict(int)
-    user_targets = defaultdict(int)
-    
-    for payload in counter_targets:
-      daily_product_key = ProductCounter.build_key_name(payload.url, DAILY, today)
-      weekly_product_key = ProductCounter.build_key_name(payload.url, WEEKLY, today)
-      monthly_product_key = ProductCounter.build_key_name(payload.url, MONTHLY, today)
-      user_key = UserCounter.build_key_name(payload.user_id, DAILY, today)
-      product_targets[daily_product_key] += 1
-      product_targets[weekly_product_key] += 1
-      product_targets[monthly_product_key] += 1
-      user_targets[user_key] += 1
-        
-    product_counters = ProductCounter.get_by_key_name(product_targets.keys(),
-                                                      _storage = [MEMCACHE,DATASTORE],
-                                                      _result_type=NAME_DICT)
-    user_counters = UserCounter.get_by_key_name(user_targets.keys(),
-                                                _result_type=NAME_DICT)
-        
-    for key_name,delta in product_targets.iteritems():
-      try:
-        product_counters[key_name].count += delta
-      except AttributeError: #Value is None in dict
-        frequency = ProductCounter.frequency_from_key_name(key_name)
-        product_counters[key_name] = ProductCounter.new(key_name, frequency, today,
-                                                   count=delta,_build_key_name = False)
+    #Mention counts for (counter class,key root) pairs
+    root_deltas = add_mention_deltas(counter_targets,{})
+    CounterBase.increment_roots(root_deltas,time_util.today())
 
-    for key_name,delta in user_targets.iteritems():  
-      try:
-        user_counters[key_name].count += delta
-      except AttributeError: #Value is None in dict
-        user_counters[key_name] = UserCounter.new(key_name, DAILY, today,
-                                             count=delta,_build_key_name = False)
-                
-    ProductCounter.filtered_update(product_counters.values())
-    UserCounter.filtered_update(user_counters.values())
+class CounterConsumeWorker(helipad.Handler):
+  '''Continues consuming counter pull queue when it couldn't be 
+  drained before request deadline'''
+  def post(self):
+    if not CounterConsumer().run():
+      enqueue_counter_consume()
 
+class CounterFlushWorker(helipad.Handler):
+  '''Continues a counter flush that was stopped before request deadline
+  params:
+      - index : Dirty counter index being flushed (counter or rollup)
+      - render_date : Optional, date string of weekly & monthly renderers 
+        to update once the flush is done
+  
+  Daily cleanup flushes the counter index with render_date, that flush 
+  rolls the last daily counts up into the rollup index, which is flushed 
+  once its partition is closed, then renderers are updated. So rankings 
+  don't miss the counts of the last rollup period.
+  '''
+  def post(self):
+    index = self.request.get('index') or COUNTER_INDEX
+    render_date = self.request.get('render_date') or None
+    flusher = CounterFlusher(index)
+    try:
+      drained = flusher.run()
+    except CapabilityDisabledError:
+      logging.error('Datastore writes disabled, retrying %s flush later' %index)
+      enqueue_counter_flush(index,countdown = 60,render_date = render_date)
+      return
+    
+    if not drained:
+      enqueue_counter_flush(index,render_date = render_date)
+    elif render_date is None:
+      return
+    elif flusher.locked:
+      #Running flush may not reach the closed partitions, check again later
+      enqueue_counter_flush(index,countdown = 30,render_date = render_date)
+    elif index == COUNTER_INDEX:
+      enqueue_counter_flush(ROLLUP_INDEX,countdown = INDEX_CLOSE_SECONDS,
+                            render_date = render_date)
+    else:
+      date = str_to_date(render_date)
+      enqueue_renderer_update(WEEKLY,date)
+      enqueue_renderer_update(MONTHLY,date)
     
 class ProductRendererUpdater(helipad.Handler):
   '''Create & update product renderers for given parameters
@@ -167,12 +192,14 @@ class ProductRendererUpdater(helipad.Handler):
       - date_string : String representation of a datetime.date 
       - frequency : This will be used for building key names for renderers
   '''
+  @buffered_tasks
   def post(self):
     store_key_name = self.request.get('store_key_name')
     date = str_to_date(self.request.get('date_string'))
     frequency = self.request.get('frequency')
       
     renderers = []
+    missing_products = [] #(product key name,count) without renderer info
     store_key = Key.from_path('Store',store_key_name)
     query = get_counter_query_for_frequency(frequency, date, store_key)
 
@@ -192,48 +219,66 @@ class ProductRendererUpdater(helipad.Handler):
         if renderer is not None: #building from existing renderers successful
           renderers.append(renderer)
         else:
-          enqueue_renderer_info(counter.key_root, 
-                                        counter.count,
-                                        frequency,
-                                        date)
+          missing_products.append((counter.key_root,counter.count))
     if len(renderers):
       pdb.put(renderers, _storage=[MEMCACHE,DATASTORE])
+    if len(missing_products):
+      enqueue_renderer_info(missing_products,frequency,date)
 
 
 class ProductRendererInfoFetcher(helipad.Handler):
-  #Retrieve information for a product to be displayed on web page
+  '''Retrieve information for products to be displayed on web page
+  params:
+      - product_key_name, count : One value per product, all from one store
+      - date_string, frequency : Renderer key parts
+      - retries : Number of failed lookups for these products
+  '''
+  @buffered_tasks
   def post(self):
-    product_key_name = self.request.get('product_key_name')
-    count = int(self.request.get('count'))
+    product_key_names = self.request.get_all('product_key_name')
+    counts = map(int,self.request.get_all('count'))
     retries = int(self.request.get('retries'))
     date = str_to_date(self.request.get('date_string'))
     frequency = self.request.get('frequency')
     
-    logging.info('Fetching details for %s , frequency: %s' %(product_key_name,frequency))
+    logging.info('Fetching details for %s , frequency: %s' %(product_key_names,frequency))
     
-    #Create empty renderer 
-    renderer = ProductRenderer.new(product_key_name,frequency, date,count = count)
+    #Create empty renderers
+    products = {} #asin => (product key name,count)
+    renderers = {}
+    for product_key_name,count in zip(product_key_names,counts):
+      asin = AmazonURLParser.extract_asin(product_key_name)
+      products[asin] = (product_key_name,count)
+      renderers[asin] = ProductRenderer.new(product_key_name,frequency, 
+                                            date,count = count)
     
-    asin = AmazonURLParser.extract_asin(product_key_name)
-    locale = AmazonURLParser.get_locale(product_key_name)
-    renderer = AmazonProductFetcher.get_product_details(asin, renderer,locale)
+    locale = AmazonURLParser.get_locale(product_key_names[0])
+    fetched = AmazonProductFetcher.get_products_details(renderers,locale)
     
-    if renderer is not None: #If all details were fetched successfully
-      renderer.put(_storage=[MEMCACHE,DATASTORE])
+    if len(fetched): #Products whose details were fetched successfully
+      pdb.put(fetched.values(),_storage=[MEMCACHE,DATASTORE])
+    
+    failed = [product for asin,product in products.iteritems() 
+              if asin not in fetched]
+    if not len(failed):
+      return
+    if retries <  MAX_PRODUCT_INFO_RETRIES:
+      retries += 1
+      logging.error('Error saving products: %s, adding to queue again, retries: %s' %(failed,retries))
+      enqueue_renderer_info(failed,frequency,date,
+                            countdown = 60, retries = retries)
     else:
-      if retries <  MAX_PRODUCT_INFO_RETRIES:
-        retries += 1
-        logging.error('Error saving product: %s, adding to queue again, retries: %s' %(product_key_name,retries))
-        enqueue_renderer_info(product_key_name,count,frequency,date,
-                                        countdown = 60, retries = retries)
-      else:
-        logging.critical('Max retries reached for product: %s' %product_key_name)
+      logging.critical('Max retries reached for products: %s' %failed)
+      banned = []
+      for product_key_name,count in failed:
         renderer = ProductRenderer.new(product_key_name,frequency,
                                         date, count = count,is_banned=True)
         renderer.log_properties()
-        renderer.put(_storage=[MEMCACHE,DATASTORE])
+        banned.append(renderer)
+      pdb.put(banned,_storage=[MEMCACHE,DATASTORE])
       
 class CleanupWorker(helipad.Handler):
+  @buffered_tasks
   def post(self):
     model_kind = self.request.get('model_kind')
     frequency = self.request.get('frequency')
@@ -271,6 +316,8 @@ main, application = helipad.app({
     '/taskworker/bucket/': UrlBucketWorker,
     '/taskworker/url/': UrlFetchWorker,
     '/taskworker/counter/': CounterWorker,
+    '/taskworker/counterflush/': CounterFlushWorker,
+    '/taskworker/counterconsume/': CounterConsumeWorker,
     '/taskworker/rendererupdate/':ProductRendererUpdater,
     '/taskworker/rendererinfo/':ProductRendererInfoFetcher,
     '/taskworker/cleanup/': CleanupWorker,
@@ -0,0 +1,4 @@
+import os
+
+#config.py reads the server software to detect the development server
+os.environ.setdefault('SERVER_SOFTWARE','Development/tests')
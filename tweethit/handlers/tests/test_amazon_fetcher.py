@@ -0,0 +1,152 @@
+import unittest
+
+import amazonproduct
+from BeautifulSoup import BeautifulSoup
+
+from PerformanceEngine.retry import RetryPolicy
+from tweethit.utils import rpc
+from tweethit.utils import task_util
+from tweethit.utils.parser_util import AmazonURLParser
+from tweethit.utils.rpc import AmazonProductFetcher
+
+ITEM = '''<Item><ASIN>%s</ASIN>
+<SmallImage><URL>http://images/%s.jpg</URL></SmallImage>
+<MediumImage><URL>http://images/%s_m.jpg</URL></MediumImage>
+<LargeImage><URL>http://images/%s_l.jpg</URL></LargeImage>
+<ItemAttributes><Title>Title of %s</Title><ProductGroup>Book</ProductGroup></ItemAttributes>
+</Item>'''
+
+NO_TITLE = '''<Item><ASIN>%s</ASIN>
+<ItemAttributes><ProductGroup>Book</ProductGroup></ItemAttributes></Item>'''
+
+def response(items):
+  return BeautifulSoup('<ItemLookupResponse><Items>%s</Items></ItemLookupResponse>'
+                       %''.join(items))
+
+class _Renderer(object):
+  title = None
+  image_small = None
+
+class _API(object):
+  '''Stands in for amazonproduct.API, answers ItemLookups from
+  AmazonFetcherTest.items, raises the errors queued in AmazonFetcherTest.errors'''
+  test = None
+
+  def __init__(self,key,secret,locale):
+    self.locale = locale
+
+  def item_lookup(self,id,**params):
+    test = self.__class__.test
+    test.lookups.append((self.locale,id.split(','),params))
+    if len(test.errors):
+      raise test.errors.pop(0)
+    return response([test.items[asin] for asin in id.split(',')
+                     if asin in test.items])
+
+class AmazonFetcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self._api = rpc.API
+    self._retry = rpc.AMAZON_RETRY
+    _API.test = self
+    rpc.API = _API
+    rpc.AMAZON_RETRY = RetryPolicy('amazon',
+                                   retry_on = amazonproduct.TooManyRequests,
+                                   max_attempts = 3,
+                                   initial_delay = 0,
+                                   max_delay = 0)
+    self.lookups = []
+    self.errors = []
+    self.items = {}
+    for asin in ['B000000001','B000000002']:
+      self.items[asin] = ITEM %((asin,)*5)
+    self.items['B000000003'] = NO_TITLE %'B000000003'
+
+  def tearDown(self):
+    rpc.API = self._api
+    rpc.AMAZON_RETRY = self._retry
+
+  def renderers(self,asins):
+    return dict([(asin,_Renderer()) for asin in asins])
+
+  def test_single_lookup_per_batch(self):
+    renderers = self.renderers(['B000000001','B000000002'])
+    result = AmazonProductFetcher.get_products_details(renderers,'uk')
+    self.assertEqual(sorted(result.keys()),['B000000001','B000000002'])
+    self.assertEqual(len(self.lookups),1)
+    locale,asins,params = self.lookups[0]
+    self.assertEqual(locale,'uk')
+    self.assertEqual(sorted(asins),['B000000001','B000000002'])
+    self.assertEqual(params['ResponseGroup'],'Small,Images')
+
+    renderer = result['B000000001']
+    self.assertEqual(renderer.title,u'Title of B000000001')
+    self.assertEqual(renderer.product_group,u'Book')
+    self.assertEqual(renderer.image_medium,'http://images/B000000001_m.jpg')
+
+  def test_partial_result(self):
+    #B000000003 has no title, B000000004 is missing from the response
+    renderers = self.renderers(['B000000001','B000000003','B000000004'])
+    result = AmazonProductFetcher.get_products_details(renderers)
+    self.assertEqual(result.keys(),['B000000001'])
+    self.assertEqual(renderers['B000000003'].title,None)
+
+  def test_throttled_lookup_is_retried(self):
+    self.errors = [amazonproduct.TooManyRequests()]
+    result = AmazonProductFetcher.get_products_details(self.renderers(['B000000002']))
+    self.assertEqual(result.keys(),['B000000002'])
+    self.assertEqual(len(self.lookups),2)
+
+  def test_throttling_gives_up(self):
+    self.errors = [amazonproduct.TooManyRequests() for i in range(3)]
+    result = AmazonProductFetcher.get_products_details(self.renderers(['B000000002']))
+    self.assertEqual(result,{})
+    self.assertEqual(len(self.lookups),3)
+
+  def test_aws_error_is_not_retried(self):
+    self.errors = [amazonproduct.AWSError('code','message')]
+    result = AmazonProductFetcher.get_products_details(self.renderers(['B000000002']))
+    self.assertEqual(result,{})
+    self.assertEqual(len(self.lookups),1)
+
+  def test_single_product(self):
+    renderer = _Renderer()
+    self.assertTrue(AmazonProductFetcher.get_product_details('B000000001',renderer)
+                    is renderer)
+    self.assertEqual(AmazonProductFetcher.get_product_details('B000000003',_Renderer()),
+                     None)
+
+class RendererInfoBatchTest(unittest.TestCase):
+  '''enqueue_renderer_info with tasks recorded instead of added'''
+
+  def setUp(self):
+    self._new_task = task_util._new_task
+    self._add = task_util._add
+    self.tasks = []
+    task_util._new_task = lambda **kwds: kwds
+    task_util._add = lambda queue,task: self.tasks.append(task)
+
+  def tearDown(self):
+    task_util._new_task = self._new_task
+    task_util._add = self._add
+
+  def test_batches_by_locale(self):
+    products = [('http://www.amazon.com/o/ASIN/B0000000%02d' %i,i) for i in range(12)]
+    products += [('http://www.amazon.co.uk/o/ASIN/B0000001%02d' %i,i) for i in range(3)]
+    task_util.enqueue_renderer_info(products,'daily','2011-01-02')
+
+    batches = [task['params']['product_key_name'] for task in self.tasks]
+    self.assertEqual(sorted([len(batch) for batch in batches]),[2,3,10])
+    for batch in batches:
+      locales = set([AmazonURLParser.get_locale(name) for name in batch])
+      self.assertEqual(len(locales),1)
+    self.assertEqual(sorted(sum(batches,[])),sorted([name for name,count in products]))
+
+    for task in self.tasks:
+      params = task['params']
+      counts = dict(products)
+      self.assertEqual(params['count'],
+                       [counts[name] for name in params['product_key_name']])
+
+if __name__ == '__main__':
+  unittest.main()
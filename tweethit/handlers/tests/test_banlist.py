@@ -0,0 +1,187 @@
+#Benchmark: python -m tweethit.handlers.tests.test_banlist benchmark
+import sys
+import time
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import config
+from PerformanceEngine import cachepy
+from tweethit import model
+from tweethit.model import Banlist,BanlistShard,TwitterUser
+from tweethit.utils.bloom import BloomFilter
+
+BENCHMARK_SIZES = [10000,1000000]
+
+class _Clock(object):
+  def __init__(self):
+    self.now = time.time()
+
+  def time(self):
+    return self.now
+
+class BanlistTest(unittest.TestCase):
+  '''model.time is replaced with a clock moved by the tests'''
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    self.clock = _Clock()
+    self._time = model.time
+    model.time = self.clock
+
+  def tearDown(self):
+    model.time = self._time
+    cachepy.flush()
+    self.testbed.deactivate()
+
+  def shards(self,name):
+    keys = [db.Key.from_path(BanlistShard.kind(),Banlist._shard_name(name,i))
+            for i in range(config.BANLIST_SHARDS)]
+    return [shard for shard in db.get(keys) if shard is not None]
+
+  def add_elsewhere(self,name,key_names):
+    '''Adds ids like another instance would, local cache is kept'''
+    for key_name in key_names:
+      db.run_in_transaction(Banlist._add_to_shard,
+                            Banlist._shard_key_name(name,key_name),[key_name])
+    memcache.incr(Banlist._version_prefix+name)
+
+  def test_ids_are_spread_over_shards(self):
+    ids = [str(100000+i) for i in range(2000)]
+    Banlist.add_users(ids)
+    shards = self.shards(Banlist.USERS)
+    self.assertEqual(len(shards),config.BANLIST_SHARDS)
+    mean = len(ids)/config.BANLIST_SHARDS
+    members = []
+    for shard in shards:
+      self.assertTrue(mean/2 < len(shard.items) < mean*2)
+      for item in shard.items:
+        self.assertEqual(Banlist._shard_key_name(Banlist.USERS,item),
+                         shard.key().name())
+      members.extend(shard.items)
+    self.assertEqual(sorted(members),sorted(ids))
+    self.assertEqual(Banlist.users(),frozenset(ids))
+
+  def test_unicode_ids_share_shards(self):
+    key_name = u'http://www.amazon.co.jp/o/ASIN/B00000000\u30a2'
+    self.assertEqual(Banlist._shard_key_name(Banlist.PRODUCTS,key_name),
+                     Banlist._shard_key_name(Banlist.PRODUCTS,key_name.encode('utf-8')))
+
+  def test_add_bumps_version(self):
+    Banlist.add_users(['1'])
+    version = Banlist.version(Banlist.USERS)
+    self.assertEqual(Banlist.users(),frozenset(['1']))
+    Banlist.add_users(['2'])
+    self.assertNotEqual(Banlist.version(Banlist.USERS),version)
+    self.assertEqual(Banlist.users(),frozenset(['1','2']))
+
+  def test_existing_ids_keep_version(self):
+    Banlist.add_users(['1','2'])
+    version = Banlist.version(Banlist.USERS)
+    Banlist.add_users(['2'])
+    self.assertEqual(Banlist.version(Banlist.USERS),version)
+
+  def test_other_instance_change_is_seen_after_version_check(self):
+    Banlist.add_users(['1'])
+    self.assertEqual(Banlist.users(),frozenset(['1']))
+    self.add_elsewhere(Banlist.USERS,['2'])
+    self.assertEqual(Banlist.users(),frozenset(['1'])) #Not checked yet
+    self.clock.now += config.BANLIST_VERSION_CHECK + 1
+    self.assertEqual(Banlist.users(),frozenset(['1','2']))
+
+  def test_same_version_is_not_reloaded(self):
+    Banlist.add_users(['1'])
+    members = Banlist.users()
+    loads = []
+    _load = Banlist.__dict__['_load']
+    Banlist._load = classmethod(lambda cls,name: loads.append(name))
+    try:
+      self.clock.now += config.BANLIST_VERSION_CHECK + 1
+      self.assertTrue(Banlist.users() is members)
+    finally:
+      Banlist._load = _load
+    self.assertEqual(loads,[])
+
+  def test_evicted_version_reloads(self):
+    Banlist.add_users(['1'])
+    version = Banlist.version(Banlist.USERS)
+    memcache.delete(Banlist._version_prefix+Banlist.USERS)
+    self.add_elsewhere(Banlist.USERS,['2']) #incr of missing version fails
+    self.clock.now += config.BANLIST_VERSION_CHECK + 1
+    self.assertEqual(Banlist.users(),frozenset(['1','2']))
+    self.assertNotEqual(Banlist.version(Banlist.USERS),version)
+
+  def test_bootstrap_from_banned_entities(self):
+    db.put([TwitterUser(key_name = key_name) for key_name in ['a','b','c']])
+    self.assertEqual(Banlist.users(),frozenset(['a','b','c']))
+    self.assertEqual(sum([len(shard.items) for shard in self.shards(Banlist.USERS)]),3)
+
+    #Shards exist now, new entities are not listed without add
+    db.put(TwitterUser(key_name = 'd'))
+    cachepy.flush()
+    self.assertEqual(Banlist.users(),frozenset(['a','b','c']))
+
+  def test_lists_are_separate(self):
+    Banlist.add_users(['1'])
+    Banlist.add_products(['http://www.amazon.com/o/ASIN/B000000001'])
+    self.assertEqual(Banlist.users(),frozenset(['1']))
+    self.assertEqual(Banlist.products(),
+                     frozenset(['http://www.amazon.com/o/ASIN/B000000001']))
+
+def benchmark(sizes = BENCHMARK_SIZES,checks = 100000,list_checks = 100):
+  '''Prints time of loading a ban list from its shards and membership 
+  check times of the old list scan, Banlist.users() frozenset
+  and the Bloom filter published to the bucket client'''
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  try:
+    for size in sizes:
+      ids = [str(10**8+i*7) for i in xrange(size)]
+      shard_items = {}
+      for key_name in ids:
+        shard_items.setdefault(Banlist._shard_key_name(Banlist.USERS,key_name),
+                               []).append(key_name)
+      #Every shard is written, replacing shards of the previous size
+      db.put([BanlistShard(key_name = key_name,items = items) 
+              for key_name,items in shard_items.iteritems()])
+      cachepy.flush()
+      memcache.flush_all()
+      
+      start = time.time()
+      Banlist.users()
+      print '%8d load %.2fs' %(size,time.time() - start)
+      
+      #Every other id is banned
+      targets = [str(10**8+i*7+i%2) for i in xrange(checks)]
+      def scan(user_id,members = ids):
+        return user_id in members
+      def lookup(user_id):
+        return user_id in Banlist.users()
+      bloom = BloomFilter.from_items(ids,config.BANLIST_FILTER_ERROR_RATE)
+      def bloom_lookup(user_id):
+        return user_id in bloom
+      for name,check,count in [('list',scan,list_checks),
+                               ('frozenset',lookup,checks),
+                               ('bloom',bloom_lookup,checks)]:
+        start = time.time()
+        for user_id in targets[:count]:
+          check(user_id)
+        elapsed = time.time() - start
+        print '%8d %-9s %10.2fus/check' %(size,name,elapsed/count*10**6)
+  finally:
+    cachepy.flush()
+    bed.deactivate()
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
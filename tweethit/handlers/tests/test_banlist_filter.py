@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+import unittest
+from wsgiref.simple_server import make_server,WSGIRequestHandler
+
+from google.appengine.ext import testbed
+
+_bucket_root = os.path.join(os.path.dirname(__file__),'..','..','..','bucket')
+if _bucket_root not in sys.path:
+  sys.path.append(_bucket_root)
+
+from PerformanceEngine import cachepy
+from tweethit.model import Banlist
+from tweethit.handlers.main import application
+from tweepy_bucket.models import BanList
+
+class _QuietHandler(WSGIRequestHandler):
+  def log_message(self,*args):
+    pass
+
+class BanlistFilterTest(unittest.TestCase):
+  '''BanlistFilterHandler served to the bucket client BanList'''
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    
+    self.server = make_server('127.0.0.1',0,application,
+                              handler_class = _QuietHandler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.url = 'http://127.0.0.1:%d/banlist/users/' %self.server.server_port
+    
+  def tearDown(self):
+    self.server.shutdown()
+    self.testbed.deactivate()
+    cachepy.flush()
+  
+  def test_client_refreshes_on_new_version(self):
+    Banlist.add_users(['1'])
+    ban_list = BanList(filter_url = self.url,refresh_interval = 3600)
+    self.assertEqual(ban_list.etag,'"%s"' %Banlist.version(Banlist.USERS))
+    self.assertTrue(ban_list.check_ban(1))
+    self.assertFalse(ban_list.check_ban(2))
+    
+    self.assertFalse(ban_list.refresh()) #304 for the same version
+    
+    Banlist.add_users(['2'])
+    self.assertTrue(ban_list.refresh())
+    self.assertTrue(ban_list.check_ban(2))
+    self.assertEqual(ban_list.etag,'"%s"' %Banlist.version(Banlist.USERS))
+    
+  def test_filter_is_cached_per_version(self):
+    Banlist.add_users(['1'])
+    first = Banlist.filter_bytes(Banlist.USERS)
+    self.assertEqual(Banlist.filter_bytes(Banlist.USERS),first)
+    Banlist.add_users(['2'])
+    second = Banlist.filter_bytes(Banlist.USERS)
+    self.assertNotEqual(second[0],first[0])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+import BaseHTTPServer
+import os
+import sys
+import threading
+import unittest
+
+_bucket_root = os.path.join(os.path.dirname(__file__),'..','..','..','bucket')
+if _bucket_root not in sys.path:
+  sys.path.append(_bucket_root)
+
+import config
+from tweethit.utils.bloom import BloomFilter,BloomFilterError
+from tweepy_bucket.models import BanList
+
+class BloomFilterTest(unittest.TestCase):
+  
+  def test_no_false_negatives(self):
+    ids = [str(i*7919) for i in xrange(10000)]
+    bloom = BloomFilter.from_items(ids,config.BANLIST_FILTER_ERROR_RATE)
+    for user_id in ids:
+      self.assertTrue(user_id in bloom)
+      
+  def test_false_positive_rate(self):
+    bloom = BloomFilter.from_items([str(i) for i in xrange(10000)],
+                                   config.BANLIST_FILTER_ERROR_RATE)
+    false_positives = len([i for i in xrange(10000,110000) if str(i) in bloom])
+    self.assertTrue(false_positives < 100000*config.BANLIST_FILTER_ERROR_RATE*2,
+                    '%d false positives' %false_positives)
+  
+  def test_unicode_and_str_match(self):
+    bloom = BloomFilter.from_items([u'123'])
+    self.assertTrue('123' in bloom)
+    self.assertTrue(123 in bloom)
+    
+  def test_bytes_round_trip(self):
+    bloom = BloomFilter.from_items(['1','2','3'],0.001)
+    copy = BloomFilter.from_bytes(bloom.to_bytes())
+    self.assertEqual((copy.bit_count,copy.hash_count),
+                     (bloom.bit_count,bloom.hash_count))
+    self.assertEqual(copy.bits,bloom.bits)
+    
+  def test_invalid_bytes(self):
+    data = BloomFilter.from_items(['1']).to_bytes()
+    self.assertRaises(BloomFilterError,BloomFilter.from_bytes,data[:3])
+    self.assertRaises(BloomFilterError,BloomFilter.from_bytes,data[:-1])
+    self.assertRaises(BloomFilterError,BloomFilter.from_bytes,'XX'+data[2:])
+
+class _FilterServer(BaseHTTPServer.HTTPServer):
+  '''Serves a ban filter like BanlistFilterHandler, with the version as ETag'''
+  
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self,('127.0.0.1',0),_FilterRequestHandler)
+    self.version = 1
+    self.users = ['1']
+    self.requests = [] #If-None-Match header of each request
+    self.fail = False
+    
+class _FilterRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  
+  def do_GET(self):
+    server = self.server
+    etag = '"%s"' %server.version
+    server.requests.append(self.headers.get('If-None-Match'))
+    if server.fail:
+      self.send_response(500)
+      self.end_headers()
+    elif self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.end_headers()
+    else:
+      data = BloomFilter.from_items(server.users,0.001).to_bytes()
+      self.send_response(200)
+      self.send_header('ETag',etag)
+      self.send_header('Content-Length',str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+      
+  def log_message(self,*args):
+    pass
+
+class BanListTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.server = _FilterServer()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.url = 'http://127.0.0.1:%d/banlist/users/' %self.server.server_port
+    
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    
+  def test_conditional_refresh(self):
+    ban_list = BanList(filter_url = self.url,refresh_interval = 3600)
+    self.assertTrue(ban_list.check_ban(1))
+    self.assertFalse(ban_list.check_ban(2))
+    
+    self.assertFalse(ban_list.refresh()) #Not modified
+    self.server.version = 2
+    self.server.users.append('2')
+    self.assertTrue(ban_list.refresh())
+    self.assertTrue(ban_list.check_ban(2))
+    self.assertEqual(self.server.requests,[None,'"1"','"1"'])
+    
+  def test_failed_refresh_keeps_filter(self):
+    ban_list = BanList(filter_url = self.url,refresh_interval = 3600)
+    self.server.fail = True
+    self.server.version = 2
+    self.assertFalse(ban_list.refresh())
+    self.assertTrue(ban_list.check_ban(1))
+    self.assertEqual(ban_list.etag,'"1"')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#Benchmark: python -m tweethit.handlers.tests.test_bucket_extract benchmark [statuses.json]
+import os
+import random
+import re
+import sys
+import time
+import unittest
+
+_bucket_root = os.path.join(os.path.dirname(__file__),'..','..','..','bucket')
+if _bucket_root not in sys.path:
+  sys.path.append(_bucket_root)
+
+from tweepy_bucket.extract import UrlExtractor
+
+def legacy_extract(text):
+  '''BucketListener.extract_urls before UrlExtractor, with its set()'''
+  url_list = re.findall("http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",text)
+  if len(url_list) == 0:
+    return None
+  return set(url_list)
+
+def build_statuses(size,seed = 1):
+  '''Stream statuses, most without links like the sample stream'''
+  rand = random.Random(seed)
+  statuses = []
+  for i in xrange(size):
+    kind = rand.random()
+    if kind < 0.6:
+      statuses.append({'text':u'just had the best coffee \u2615 #%d' %i,
+                       'entities':{'urls':[]}})
+    elif kind < 0.9:
+      url = 'http://t.co/%x' %rand.getrandbits(32)
+      expanded = 'http://amzn.to/%x' %rand.getrandbits(32)
+      statuses.append({'text':u'Reading this now %s, great so far!' %url,
+                       'entities':{'urls':[{'url':url,'expanded_url':expanded}]}})
+    else:
+      statuses.append({'text':u'Deal http://bit.ly/%x and http://twitpic.com/%x.'
+                               %(rand.getrandbits(32),rand.getrandbits(32))})
+  return statuses
+
+def load_statuses(path):
+  '''Statuses recorded from the stream, one JSON status per line'''
+  try:
+    import json
+  except ImportError:
+    import simplejson as json
+  statuses = []
+  for line in open(path):
+    line = line.strip()
+    if line:
+      status = json.loads(line)
+      if 'text' in status:
+        statuses.append(status)
+  return statuses
+
+class UrlExtractorTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.extractor = UrlExtractor()
+    
+  def test_text_without_urls(self):
+    self.assertEqual(self.extractor.extract('no links here'),[])
+    self.assertEqual(self.extractor.extract(u'şimdi'),[])
+    self.assertEqual(self.extractor.extract('http is a protocol'),[])
+    
+  def test_pattern_fallback(self):
+    text = 'Great deal http://bit.ly/abc and https://amzn.to/x1 today'
+    self.assertEqual(self.extractor.extract(text),
+                     ['http://bit.ly/abc','https://amzn.to/x1'])
+    
+  def test_entity_urls(self):
+    entities = {'urls':[{'url':'http://t.co/1','expanded_url':'http://bit.ly/abc'},
+                        {'url':'http://t.co/2','expanded_url':None}]}
+    text = 'http://t.co/1 http://t.co/2 http://ignored.com/x'
+    self.assertEqual(self.extractor.extract(text,entities),
+                     ['http://bit.ly/abc','http://t.co/2'])
+    
+  def test_empty_entities_skip_the_pattern(self):
+    self.assertEqual(self.extractor.extract('http://bit.ly/abc',{'urls':[]}),[])
+    
+  def test_entities_without_urls_use_the_pattern(self):
+    self.assertEqual(self.extractor.extract('http://bit.ly/abc',{'hashtags':[]}),
+                     ['http://bit.ly/abc'])
+    
+  def test_trailing_punctuation(self):
+    text = 'See http://bit.ly/abc. Or (http://bit.ly/def) and "http://bit.ly/ghi"!'
+    self.assertEqual(self.extractor.extract(text),
+                     ['http://bit.ly/abc','http://bit.ly/def','http://bit.ly/ghi'])
+    
+  def test_normalization(self):
+    self.assertEqual(self.extractor.normalize('HTTP://Bit.LY:80/Abc#frag'),
+                     'http://bit.ly/Abc')
+    self.assertEqual(self.extractor.normalize('https://bit.ly:443'),
+                     'https://bit.ly/')
+    self.assertEqual(self.extractor.normalize('http://bit.ly:8080/a?b=1'),
+                     'http://bit.ly:8080/a?b=1')
+    
+  def test_deduplication(self):
+    text = 'http://bit.ly/abc http://BIT.ly/abc, http://bit.ly/abc#x http://bit.ly/def'
+    self.assertEqual(self.extractor.extract(text),
+                     ['http://bit.ly/abc','http://bit.ly/def'])
+    entities = {'urls':[{'expanded_url':'http://bit.ly/abc'},
+                        {'expanded_url':'http://bit.ly/abc/'}]}
+    self.assertEqual(self.extractor.extract('',entities),
+                     ['http://bit.ly/abc','http://bit.ly/abc/'])
+    
+  def test_skipped_domains(self):
+    text = ('http://twitpic.com/1 http://www.youtube.com/watch?v=1 '
+            'http://m.facebook.com/x http://nottwitter.com/y')
+    self.assertEqual(self.extractor.extract(text),['http://nottwitter.com/y'])
+    
+  def test_custom_skip_domains(self):
+    extractor = UrlExtractor(skip_domains = frozenset(['bit.ly']))
+    self.assertEqual(extractor.extract('http://bit.ly/a http://twitpic.com/1'),
+                     ['http://twitpic.com/1'])
+
+def benchmark(path = None,size = 20000,repeat = 5):
+  '''Prints tweets/s of the legacy pattern and UrlExtractor over 
+  a recorded corpus, or generated statuses if path is None'''
+  if path is None:
+    statuses = build_statuses(size)
+  else:
+    statuses = load_statuses(path)
+  extractor = UrlExtractor()
+  runs = [('legacy',lambda status: legacy_extract(status['text'])),
+          ('extractor',lambda status: extractor.extract(status['text'],
+                                                        status.get('entities')))]
+  for name,extract in runs:
+    start = time.time()
+    for i in range(repeat):
+      for status in statuses:
+        extract(status)
+    elapsed = max(time.time() - start,0.001)
+    print '%-9s %6d tweets %10.1f tweets/s' %(name,len(statuses),
+                                               len(statuses)*repeat/elapsed)
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    args = [arg for arg in sys.argv[1:] if arg != 'benchmark']
+    benchmark(*args[:1])
+  else:
+    unittest.main()
@@ -0,0 +1,180 @@
+import httplib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+import urlparse
+
+_bucket_root = os.path.join(os.path.dirname(__file__),'..','..','..','bucket')
+if _bucket_root not in sys.path:
+  sys.path.append(_bucket_root)
+
+from tweepy_bucket.upload import UploadPipeline
+
+class _FakeResponse(object):
+  def __init__(self,status):
+    self.status = status
+  def read(self):
+    return ''
+
+class _AfterSend(object):
+  '''Script outcome raising error after the body was written'''
+  def __init__(self,error):
+    self.error = error
+
+class _FakeConnection(object):
+  '''Takes the outcome of each request from the script of its test,
+  an int status, an exception instance to raise while sending or _AfterSend'''
+  def __init__(self,test):
+    self.test = test
+    self.closed = False
+    self.outcome = None
+    
+  def request(self,method,path,body,headers):
+    self.test.bodies.append(urlparse.parse_qs(body)['data'][0])
+    self.outcome = self.test.script.pop(0)
+    if isinstance(self.outcome,Exception):
+      raise self.outcome
+    
+  def getresponse(self):
+    if isinstance(self.outcome,_AfterSend):
+      raise self.outcome.error
+    return _FakeResponse(self.outcome)
+  
+  def close(self):
+    self.closed = True
+
+class UploadPipelineTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.spill_dir = tempfile.mkdtemp()
+    self.script = []
+    self.bodies = []
+    self.connections = []
+    self.pipeline = self._pipeline()
+    
+  def tearDown(self):
+    self.pipeline.stop()
+    shutil.rmtree(self.spill_dir)
+    
+  def _pipeline(self):
+    pipeline = UploadPipeline('http://localhost/task/',workers = 0,
+                              flush_interval = 0.05,
+                              spill_dir = self.spill_dir)
+    pipeline._connect = self._connect
+    return pipeline
+    
+  def _connect(self):
+    connection = _FakeConnection(self)
+    self.connections.append(connection)
+    return connection
+  
+  def _spilled(self,suffix = '.batch'):
+    return sorted([name for name in os.listdir(self.spill_dir) 
+                   if name.endswith(suffix)])
+  
+  def _upload(self,connection,data):
+    '''What an upload worker does with a batch'''
+    ok,connection = self.pipeline._post(connection,data)
+    if not ok:
+      self.pipeline._spill(data)
+    return ok,connection
+  
+  def test_keep_alive_connection_is_reused(self):
+    self.script = [200,200]
+    ok,connection = self._upload(None,'a')
+    ok,connection = self._upload(connection,'b')
+    self.assertTrue(ok)
+    self.assertEqual(len(self.connections),1)
+    self.assertEqual(self.bodies,['a','b'])
+  
+  def test_closed_keep_alive_connection_is_retried_once(self):
+    for error in (httplib.BadStatusLine(''),socket.error(104,'reset')):
+      self.script = [200,error,200]
+      self.connections = []
+      ok,connection = self._upload(None,'a')
+      ok,connection = self._upload(connection,'b')
+      self.assertTrue(ok)
+      self.assertEqual(len(self.connections),2)
+      self.assertTrue(self.connections[0].closed)
+      self.assertEqual(self.pipeline._down_until,0)
+      self.assertEqual(self._spilled(),[])
+    
+  def test_closed_connection_after_send_is_retried(self):
+    self.script = [200,_AfterSend(httplib.BadStatusLine('')),200]
+    ok,connection = self._upload(None,'a')
+    ok,connection = self._upload(connection,'b')
+    self.assertTrue(ok)
+    self.assertEqual(self.bodies,['a','b','b'])
+    self.assertEqual(self._spilled(),[])
+
+  def test_timeout_is_not_retried(self):
+    for error in (_AfterSend(socket.timeout('timed out')),socket.timeout('timed out')):
+      self.script = [200,error]
+      self.bodies = []
+      ok,connection = self._upload(None,'a')
+      ok,connection = self._upload(connection,'b')
+      self.assertFalse(ok)
+      self.assertEqual(self.bodies,['a','b'])
+      self.assertTrue(self.pipeline._down_until > 0)
+    self.assertEqual(len(self._spilled()),2)
+
+  def test_reset_after_send_is_not_retried(self):
+    self.script = [200,_AfterSend(socket.error(104,'reset'))]
+    ok,connection = self._upload(None,'a')
+    ok,connection = self._upload(connection,'b')
+    self.assertFalse(ok)
+    self.assertEqual(self.bodies,['a','b'])
+    self.assertEqual(len(self._spilled()),1)
+
+  def test_failure_on_new_connection_spills(self):
+    self.script = [200,httplib.BadStatusLine(''),socket.error(111,'refused')]
+    ok,connection = self._upload(None,'a')
+    ok,connection = self._upload(connection,'b')
+    self.assertFalse(ok)
+    self.assertEqual(connection,None)
+    self.assertTrue(self.pipeline._down_until > 0)
+    self.assertEqual(len(self._spilled()),1)
+  
+  def test_server_error_spills_and_replays(self):
+    self.script = [500,500,200]
+    self._upload(None,'a')
+    self._upload(None,'b')
+    self.assertTrue(self.pipeline._down_until > 0)
+    self.assertEqual(len(self._spilled()),2)
+    
+    self.pipeline._replay_spilled(None) #Oldest batch first
+    self.assertEqual(self.bodies[-1],'a')
+    self.assertEqual(len(self._spilled()),1)
+    
+  def test_failed_replay_keeps_batch(self):
+    self.pipeline._spill('a')
+    self.script = [socket.error(111,'refused')]
+    self.pipeline._replay_spilled(None)
+    self.assertEqual(len(self._spilled()),1)
+    self.assertEqual(self._spilled('.sending'),[])
+    
+  def test_bad_request_is_dropped(self):
+    self.script = [400]
+    ok,connection = self._upload(None,'a')
+    self.assertTrue(ok)
+    self.assertEqual(self._spilled(),[])
+  
+  def test_interrupted_upload_is_replayed_after_restart(self):
+    self.pipeline._spill('a')
+    name = self._spilled()[0]
+    path = os.path.join(self.spill_dir,name)
+    os.rename(path,path+'.sending')
+    
+    self.pipeline.stop()
+    self.pipeline = self._pipeline()
+    self.assertEqual(self._spilled(),[name])
+    self.script = [200]
+    self.pipeline._replay_spilled(None)
+    self.assertEqual(self.bodies,['a'])
+    self.assertEqual(self._spilled(),[])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,183 @@
+import unittest
+
+from PerformanceEngine import cachepy
+
+class _Clock(object):
+  '''Replaces time module of cachepy'''
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+class CachepyTest(unittest.TestCase):
+  '''Budget and policy are restored after each test, stats are
+  module wide so tests compare differences'''
+
+  def setUp(self):
+    self._config = (cachepy.POLICY,cachepy.MAX_ENTRIES,cachepy.MAX_BYTES,
+                    cachepy.SWEEP_BUDGET)
+    self._time = cachepy.time
+    self.clock = _Clock()
+    cachepy.time = self.clock
+    cachepy.flush()
+
+  def tearDown(self):
+    policy,max_entries,max_bytes,sweep_budget = self._config
+    cachepy.flush()
+    cachepy.configure(policy,max_entries,max_bytes,sweep_budget)
+    cachepy.time = self._time
+
+  def use(self,policy,max_entries = None,max_bytes = None):
+    cachepy.configure(policy,max_entries,max_bytes)
+
+  def keys(self):
+    return sorted(cachepy.CACHE.keys())
+
+  def test_lru_evicts_least_recently_used(self):
+    self.use(cachepy.LRU,max_entries = 3)
+    for key in 'abc':
+      cachepy.set(key,key)
+    cachepy.get('a')
+    evictions = cachepy.stats()['evictions']
+    cachepy.set('d','d')
+    self.assertEqual(self.keys(),['a','c','d'])
+    cachepy.set('c','c') #Overwrite counts as use
+    cachepy.set('e','e')
+    self.assertEqual(self.keys(),['c','d','e'])
+    self.assertEqual(cachepy.stats()['evictions'],evictions + 2)
+
+  def test_lfu_evicts_least_frequently_used(self):
+    self.use(cachepy.LFU,max_entries = 3)
+    for key in 'abc':
+      cachepy.set(key,key)
+    cachepy.get('a')
+    cachepy.get('a')
+    cachepy.get('b')
+    cachepy.set('d','d')
+    self.assertEqual(self.keys(),['a','b','d'])
+    #Ties are broken by recency, d was used after b
+    cachepy.get('d')
+    cachepy.set('e','e')
+    self.assertEqual(self.keys(),['a','b','d'])
+
+  def test_lfu_min_freq(self):
+    self.use(cachepy.LFU)
+    cachepy.set('a','a')
+    cachepy.set('b','b')
+    cachepy.get('a')
+    self.assertEqual(cachepy._policy.min_freq,1)
+    cachepy.get('b')
+    self.assertEqual(cachepy._policy.min_freq,2)
+    cachepy.get('a')
+    cachepy.set('c','c')
+    self.assertEqual(cachepy._policy.min_freq,1)
+
+    #Removal empties the lowest bucket, victim finds the next one
+    cachepy.delete('c')
+    self.assertEqual(cachepy._policy.victim().key,'b')
+    cachepy.configure(max_entries = 1)
+    self.assertEqual(self.keys(),['a'])
+
+  def test_ttl_evicts_closest_expiry(self):
+    self.use(cachepy.TTL,max_entries = 4)
+    cachepy.set('a','a',10)
+    cachepy.set('b','b',100)
+    cachepy.set('c','c')
+    cachepy.set('d','d',5)
+    cachepy.set('e','e')
+    self.assertEqual(self.keys(),['a','b','c','e'])
+    cachepy.set('a','a',200) #Stale heap item of a is skipped
+    cachepy.set('f','f')
+    self.assertEqual(self.keys(),['a','c','e','f'])
+    #Entries without expiry go last, in LRU order
+    cachepy.set('g','g')
+    self.assertEqual(self.keys(),['c','e','f','g'])
+    cachepy.set('h','h')
+    self.assertEqual(self.keys(),['e','f','g','h'])
+
+  def test_expired_entry_is_dropped_on_read(self):
+    cachepy.set('a','a',10)
+    self.assertEqual(cachepy.get('a'),'a')
+    stats = cachepy.stats()
+    self.clock.now += 10
+    self.assertEqual(cachepy.get('a'),None)
+    self.assertEqual(cachepy.stats()['expirations'],stats['expirations'] + 1)
+    self.assertEqual(cachepy.stats()['misses'],stats['misses'] + 1)
+    self.assertEqual(self.keys(),[])
+
+  def test_set_sweeps_expired_entries_within_budget(self):
+    cachepy.configure(sweep_budget = 2)
+    for i in range(5):
+      cachepy.set('old%d' %i,i,10 + i)
+    cachepy.set('kept','kept',100)
+    expirations = cachepy.stats()['expirations']
+    self.clock.now += 20
+    cachepy.set('x','x')
+    #Oldest expiries are swept first
+    self.assertEqual(self.keys(),['kept','old2','old3','old4','x'])
+    cachepy.set('y','y')
+    cachepy.set('z','z')
+    self.assertEqual(self.keys(),['kept','x','y','z'])
+    self.assertEqual(cachepy.stats()['expirations'],expirations + 5)
+    self.assertEqual(cachepy.stats()['keys_count'],4)
+    self.assertEqual(cachepy.EXPIRY_HEAP,[(self.clock.now - 20 + 100,'kept')])
+
+  def test_expiry_heap_is_rebuilt(self):
+    #Every overwrite leaves a stale item, index is rebuilt from live entries
+    cachepy.set('a','a',100)
+    for i in range(200):
+      cachepy.set('b','b',100 + i)
+      self.assertTrue(len(cachepy.EXPIRY_HEAP) <= 2*2 + 64)
+    for key in 'ab':
+      self.assertTrue((cachepy.CACHE[key].expiry,key) in cachepy.EXPIRY_HEAP)
+
+  def test_estimate_size(self):
+    text = 'x'*1000
+    self.assertTrue(cachepy.estimate_size(text) >= 1000)
+    self.assertTrue(cachepy.estimate_size([text,text]) >= 2000)
+    self.assertTrue(cachepy.estimate_size({'k':text}) >= 1000)
+    class Value(object):
+      pass
+    value = Value()
+    value.text = text
+    self.assertTrue(cachepy.estimate_size(value) >= 1000)
+    #Containers are followed up to depth levels
+    self.assertTrue(cachepy.estimate_size([[text]],depth = 1) < 1000)
+    self.assertTrue(cachepy.estimate_size([[text]],depth = 2) >= 1000)
+
+  def test_byte_budget(self):
+    self.use(cachepy.LRU,max_bytes = 100)
+    cachepy.set('a','a',size = 40)
+    cachepy.set('b','b',size = 40)
+    self.assertEqual(cachepy.stats()['size'],80)
+    cachepy.set('c','c',size = 40)
+    self.assertEqual(self.keys(),['b','c'])
+    self.assertEqual(cachepy.stats()['size'],80)
+    #Values over the whole budget are not cached
+    cachepy.set('d','d',size = 101)
+    self.assertEqual(self.keys(),['b','c'])
+    #Size is estimated when not given
+    cachepy.set('e','e')
+    self.assertEqual(self.keys(),['c','e'])
+    self.assertEqual(cachepy.stats()['size'],40 + cachepy.estimate_size('e'))
+
+  def test_configure_stats(self):
+    for key in 'abc':
+      cachepy.set(key,key)
+    evictions = cachepy.stats()['evictions']
+    cachepy.configure(cachepy.LFU,max_entries = 2,max_bytes = None)
+    stats = cachepy.stats()
+    self.assertEqual((stats['policy'],stats['max_entries'],stats['max_bytes']),
+                     (cachepy.LFU,2,None))
+    self.assertEqual(stats['keys_count'],2)
+    self.assertEqual(stats['evictions'],evictions + 1)
+    #Entries kept their place in the new policy
+    self.assertEqual(self.keys(),['b','c'])
+    cachepy.configure(max_entries = None)
+    self.assertEqual(cachepy.stats()['max_entries'],None)
+    self.assertEqual(cachepy.stats()['policy'],cachepy.LFU)
+    self.assertRaises(ValueError,cachepy.configure,'fifo')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+#Benchmark: python -m tweethit.handlers.tests.test_codec benchmark
+import datetime
+import pickle
+import sys
+import time
+import unittest
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from PerformanceEngine import codec,pdb,cachepy,MEMCACHE,DATASTORE
+from PerformanceEngine.codec import PackedCodec,ProtobufCodec
+from tweethit.model import ProductRenderer,ProductCounter,DAILY
+
+BENCHMARK_SIZES = [1,20,100]
+
+class Note(db.Expando):
+  title = db.StringProperty()
+
+def build_renderers(size,date = datetime.date(2011,1,2)):
+  return [ProductRenderer.new('http://www.amazon.com/dp/B%09d' %i,DAILY,date,
+                              count = i,
+                              title = u'Product title %d \xe9' %i,
+                              product_group = 'Book',
+                              image_small = 'http://ecx.images-amazon.com/%d.jpg' %i)
+          for i in xrange(size)]
+
+def build_counters(size,date = datetime.date(2011,1,2)):
+  return [ProductCounter.new('http://www.amazon.com/dp/B%09d' %i,DAILY,date,
+                             count = i)
+          for i in xrange(size)]
+
+def add_property(data,name,value):
+  '''Returns packed data as if encoded when the kinds had one more property'''
+  flag = data[len(PackedCodec.MAGIC)]
+  data = data[len(PackedCodec.MAGIC)+1:]
+  if flag == PackedCodec.COMPRESSED:
+    data = zlib.decompress(data)
+  is_list,headers,rows = pickle.loads(data)
+  headers = [(kind,names+(name,)) for kind,names in headers]
+  rows = [row[:3]+(row[3]+(value,),)+row[4:] for row in rows]
+  return PackedCodec.MAGIC+PackedCodec.RAW+pickle.dumps((is_list,headers,rows))
+
+class PackedCodecTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.codec = PackedCodec(compress_threshold = 256)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def assertSameModels(self,expected,models):
+    self.assertEqual([model.key() for model in expected],
+                     [model.key() for model in models])
+    for original,model in zip(expected,models):
+      for name,prop in original.properties().iteritems():
+        #Datastore values, references are not fetched
+        self.assertEqual(prop.get_value_for_datastore(original),
+                         prop.get_value_for_datastore(model))
+
+  def test_list_round_trip(self):
+    renderers = build_renderers(20)
+    data = self.codec.encode(renderers)
+    self.assertTrue(PackedCodec.is_packed(data))
+    self.assertSameModels(renderers,self.codec.decode(data))
+
+  def test_single_model(self):
+    counter = build_counters(1)[0]
+    model = codec.decode(self.codec.encode(counter))
+    self.assertTrue(isinstance(model,ProductCounter))
+    self.assertSameModels([counter],[model])
+
+  def test_saved_state_is_kept(self):
+    counters = build_counters(3)
+    db.put(counters[:2])
+    models = self.codec.decode(self.codec.encode(counters))
+    self.assertEqual([model.is_saved() for model in models],[True,True,False])
+
+  def test_expando_uses_protobuf(self):
+    note = Note(key_name = 'n',title = 'title')
+    note.tag = 'dynamic'
+    note.put()
+    for value in [note,[note]]:
+      data = self.codec.encode(value)
+      self.assertFalse(PackedCodec.is_packed(data))
+      models = codec.decode(data)
+      if isinstance(value,list):
+        self.assertEqual(len(models),1)
+        models = models[0]
+      self.assertEqual(models.tag,'dynamic')
+      self.assertTrue(models.is_saved())
+
+  def test_smaller_than_protobuf(self):
+    for models in [build_renderers(100),build_counters(100)]:
+      packed = len(self.codec.encode(models))
+      protobuf = sum([len(data) for data in ProtobufCodec().encode(models)])
+      self.assertTrue(packed < protobuf)
+
+  def test_decodes_protobuf(self):
+    renderers = build_renderers(2)
+    self.assertSameModels(renderers,codec.decode(ProtobufCodec().encode(renderers)))
+
+  def test_removed_property_is_skipped(self):
+    counters = build_counters(3)
+    data = add_property(self.codec.encode(counters),'removed',u'value')
+    models = self.codec.decode(data)
+    self.assertSameModels(counters,models)
+    self.assertFalse(hasattr(models[0],'removed'))
+
+  def test_undecodable_cache_entry_is_a_miss(self):
+    counter = build_counters(1)[0]
+    key = pdb.put(counter,_storage = [MEMCACHE,DATASTORE])
+    memcache.set(str(key),PackedCodec.MAGIC+PackedCodec.RAW+'not a pickle')
+    cachepy.flush()
+    model = pdb.get(key,_storage = [MEMCACHE,DATASTORE])
+    self.assertSameModels([counter],[model])
+    self.assertSameModels([counter],[codec.decode(memcache.get(str(key)))])
+
+def benchmark(sizes = BENCHMARK_SIZES,repeat = 20):
+  '''Prints encode/decode times and sizes of both codecs'''
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  try:
+    codecs = [('protobuf',ProtobufCodec()),('packed',PackedCodec())]
+    for build in (build_renderers,build_counters):
+      for size in sizes:
+        models = build(size)
+        for name,instance in codecs:
+          start = time.time()
+          for i in range(repeat):
+            data = instance.encode(models)
+          encode_time = (time.time() - start)/repeat
+          start = time.time()
+          for i in range(repeat):
+            instance.decode(data)
+          decode_time = (time.time() - start)/repeat
+          if isinstance(data,list):
+            length = sum([len(item) for item in data])
+          else:
+            length = len(data)
+          print '%-16s %4d %-8s encode %.2fms decode %.2fms %7d bytes' \
+                %(models[0].kind(),size,name,encode_time*1000,
+                  decode_time*1000,length)
+  finally:
+    bed.deactivate()
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
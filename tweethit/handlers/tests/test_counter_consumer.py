@@ -0,0 +1,142 @@
+#Benchmark: python -m tweethit.handlers.tests.test_counter_consumer benchmark
+import random
+import sys
+import time
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from PerformanceEngine import cachepy,time_util
+from tweethit.model import CounterBase,ProductCounter,UserCounter,Payload
+from tweethit.utils.counter_util import CounterConsumer,add_mention_deltas
+from tweethit.utils.task_util import LocalPullQueue
+
+class _Task(object):
+  def __init__(self,name,payloads):
+    self.name = name
+    self.payload = Payload.serialize(payloads)
+
+class _Failure(Exception):
+  pass
+
+class CounterConsumerTest(unittest.TestCase):
+  '''increment_roots is replaced with a recorder, fail_on holds
+  counter classes whose next increment raises'''
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.counts = {}
+    self.fail_on = set()
+    self._increment_roots = CounterBase.__dict__['increment_roots']
+    CounterBase.increment_roots = classmethod(self.increment_roots)
+
+    self.queue = LocalPullQueue()
+    self.queue.add([_Task('a',[Payload('http://p1',1,2),Payload('http://p2',2)]),
+                    _Task('b',[Payload('http://p1',2)])])
+
+  def tearDown(self):
+    CounterBase.increment_roots = self._increment_roots
+    self.testbed.deactivate()
+
+  def increment_roots(self,cls,root_deltas,date):
+    for (klass,key_root),delta in root_deltas.iteritems():
+      if klass in self.fail_on:
+        self.fail_on.remove(klass)
+        raise _Failure()
+    for key,delta in root_deltas.iteritems():
+      self.counts[key] = self.counts.get(key,0) + delta
+
+  def consume(self):
+    return CounterConsumer(self.queue,batch_size = 10,lease_seconds = 0).run()
+
+  def expected(self):
+    return {(ProductCounter,'http://p1'):3,
+            (ProductCounter,'http://p2'):1,
+            (UserCounter,'1'):2,
+            (UserCounter,'2'):2}
+
+  def test_batch_is_counted_and_deleted(self):
+    self.assertTrue(self.consume())
+    self.assertEqual(self.counts,self.expected())
+    self.assertEqual(self.queue.lease_tasks(0,10),[])
+
+  def test_failed_batch_is_not_counted_twice(self):
+    self.fail_on = set([ProductCounter,UserCounter])
+    for i in range(3):
+      try:
+        self.consume()
+        break
+      except _Failure:
+        self.assertEqual(len(self.queue.lease_tasks(0,10)),2)
+    else:
+      self.fail('Consumer did not recover')
+    self.assertEqual(self.counts,self.expected())
+    self.assertEqual(self.queue.lease_tasks(0,10),[])
+
+  def test_new_tasks_in_release_are_counted(self):
+    self.fail_on = set([UserCounter])
+    self.assertRaises(_Failure,self.consume)
+    self.queue.add(_Task('c',[Payload('http://p2',1)]))
+    self.assertTrue(self.consume())
+    expected = self.expected()
+    expected[(ProductCounter,'http://p2')] += 1
+    expected[(UserCounter,'1')] += 1
+    self.assertEqual(self.counts,expected)
+
+  def test_malformed_payload_is_dropped(self):
+    task = _Task('d',[])
+    task.payload = 'not a payload'
+    self.queue.add(task)
+    self.assertTrue(self.consume())
+    self.assertEqual(self.counts,self.expected())
+    self.assertEqual(self.queue.lease_tasks(0,10),[])
+
+def build_tasks(count,mentions = 10,seed = 1):
+  '''Counter tasks of bucket uploads mentioning a pool of products'''
+  rand = random.Random(seed)
+  return [_Task('t%d' %i,
+                [Payload('http://www.amazon.com/dp/B%09d' %rand.randint(0,count),
+                         rand.randint(1,count*2)) for j in range(mentions)])
+          for i in xrange(count)]
+
+def benchmark(task_counts = [100,1000],mentions = 10,batch_size = 100):
+  '''Prints mentions/s of counting tasks one at a time like CounterWorker
+  and in CounterConsumer batches leased from LocalPullQueue,
+  counters are incremented in the memcache stub'''
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_memcache_stub()
+  try:
+    for count in task_counts:
+      tasks = build_tasks(count,mentions)
+      
+      memcache.flush_all()
+      cachepy.flush()
+      start = time.time()
+      for task in tasks:
+        root_deltas = add_mention_deltas(Payload.deserialize(task.payload),{})
+        CounterBase.increment_roots(root_deltas,time_util.today())
+      push_time = time.time() - start
+      
+      memcache.flush_all()
+      cachepy.flush()
+      queue = LocalPullQueue()
+      queue.add(tasks)
+      start = time.time()
+      CounterConsumer(queue,batch_size = batch_size,lease_seconds = 60).run()
+      pull_time = time.time() - start
+      
+      for name,elapsed in [('push',push_time),('pull',pull_time)]:
+        print '%5d tasks %-4s %8.2fs %10.1f mentions/s' \
+              %(count,name,elapsed,count*mentions/max(elapsed,0.001))
+  finally:
+    bed.deactivate()
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
@@ -0,0 +1,102 @@
+import datetime
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from PerformanceEngine import cachepy,DATASTORE
+from tweethit.model import CounterBase,UserCounter,ProductCounter,DAILY
+
+class CounterEvictionTest(unittest.TestCase):
+  '''Counts written by flushes while memcache is evicted'''
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    self.key_name = UserCounter.build_key_name('user',DAILY,
+                                               datetime.date(2011,1,2))
+
+  def tearDown(self):
+    cachepy.flush()
+    self.testbed.deactivate()
+
+  def increment(self,delta):
+    UserCounter.increment({self.key_name:delta})
+
+  def flush(self):
+    entities = CounterBase.build_flush_entities(
+      [UserCounter.counter_id(self.key_name)])
+    db.put(entities)
+    return UserCounter.get_by_key_name(self.key_name,_storage = DATASTORE).count
+
+  def test_counts_are_flushed(self):
+    self.increment(500)
+    self.assertEqual(self.flush(),500)
+    self.increment(20)
+    self.assertEqual(self.flush(),520)
+
+  def test_evicted_count_is_added_to_stored_count(self):
+    self.increment(500)
+    self.assertEqual(self.flush(),500)
+    memcache.flush_all()
+    self.increment(30)
+    self.assertEqual(self.flush(),530)
+    self.assertEqual(self.flush(),530)
+    self.increment(5)
+    self.assertEqual(self.flush(),535)
+
+  def test_evicted_generation_keeps_count(self):
+    self.increment(500)
+    self.assertEqual(self.flush(),500)
+    memcache.delete(UserCounter._generation_prefix+
+                    UserCounter.counter_id(self.key_name))
+    self.increment(30)
+    self.assertEqual(self.flush(),530)
+    self.increment(5)
+    self.assertEqual(self.flush(),535)
+
+  def test_entity_without_generation(self):
+    #Written before generations, memcache still holds its count
+    self.increment(500)
+    UserCounter.from_key_name(self.key_name,count = 500).put()
+    self.assertEqual(self.flush(),500)
+    self.increment(30)
+    self.assertEqual(self.flush(),530)
+    self.increment(5)
+    self.assertEqual(self.flush(),535)
+
+class RollupFlushTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+
+  def tearDown(self):
+    cachepy.flush()
+    self.testbed.deactivate()
+
+  def test_rollups_are_written_with_daily_counters(self):
+    url = 'http://www.amazon.com/o/ASIN/B000000001'
+    date = datetime.date(2011,1,5)
+    key_names = [ProductCounter.build_key_name(url,frequency,date)
+                 for frequency in [DAILY] + ProductCounter._rollup_frequencies]
+    ProductCounter.increment({key_names[0]:7})
+    entities = CounterBase.build_flush_entities(
+      [ProductCounter.counter_id(key_names[0])])
+    self.assertEqual(sorted([(entity.key().name(),entity.count) for entity in entities]),
+                     sorted([(key_name,7) for key_name in key_names]))
+
+    #Rollup index flush finds them written already
+    db.put(entities)
+    rollups = [ProductCounter.counter_id(key_name) for key_name in key_names[1:]]
+    self.assertEqual(CounterBase.build_flush_entities(rollups),[])
+
+if __name__ == '__main__':
+  unittest.main()
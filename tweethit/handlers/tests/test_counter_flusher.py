@@ -0,0 +1,144 @@
+import unittest
+
+import config
+from tweethit.model import CounterBase
+from tweethit.utils.counter_util import CounterFlusher
+
+class _Flags(object):
+  def __init__(self):
+    self.counter_index_cursor = None
+    self.counter_flush_last_key = None
+    self.saves = 0
+
+  def save(self):
+    self.saves += 1
+
+class _RPC(object):
+  def get_result(self):
+    pass
+
+class CounterFlusherTest(unittest.TestCase):
+  '''self.buckets are the closed partitions, the last one holds 
+  counter ids in self.ids, others are empty.
+  stop_after batches are built before the deadline passes'''
+
+  def setUp(self):
+    self.ids = set(['a','b','c','d','e','f'])
+    self.buckets = [1]
+    self.written = []
+    self.stop_after = None
+    self.cleared = []
+    self._saved = {}
+    for name in ['closed_index_buckets','get_cached_counter_keys',
+                 'build_flush_entities','clear_cached_counter_keys']:
+      self._saved[name] = CounterBase.__dict__[name]
+      setattr(CounterBase,name,classmethod(getattr(self,name)))
+    self.flags = _Flags()
+
+  def tearDown(self):
+    for name,method in self._saved.iteritems():
+      setattr(CounterBase,name,method)
+
+  def closed_index_buckets(self,cls,cursor):
+    return [bucket for bucket in self.buckets if cursor is None or bucket > cursor]
+
+  def get_cached_counter_keys(self,cls,bucket,index):
+    if bucket == self.buckets[-1]:
+      return list(self.ids)
+    return []
+
+  def build_flush_entities(self,cls,counter_ids):
+    self.written.extend(counter_ids)
+    if self.stop_after is not None:
+      self.stop_after -= 1
+      if not self.stop_after:
+        self.flusher.deadline = 0
+    return counter_ids
+
+  def clear_cached_counter_keys(self,cls,bucket,index):
+    self.cleared.append(bucket)
+
+  def drain(self):
+    self.flusher = CounterFlusher(batch_size = 2)
+    self.flusher._put_async = lambda entities: _RPC()
+    return self.flusher._drain(self.flags)
+
+  def test_drains_partition(self):
+    self.assertTrue(self.drain())
+    self.assertEqual(self.written,['a','b','c','d','e','f'])
+    self.assertEqual(self.cleared,[1])
+    self.assertEqual(self.flags.counter_index_cursor,1)
+    self.assertEqual(self.flags.counter_flush_last_key,None)
+
+  def test_resumes_after_last_key(self):
+    self.stop_after = 2
+    self.assertFalse(self.drain())
+    self.assertEqual(self.written,['a','b','c','d'])
+    self.assertEqual(self.flags.counter_flush_last_key,'d')
+    self.assertEqual(self.cleared,[])
+    self.assertEqual(self.flags.counter_index_cursor,None)
+
+    self.written = []
+    self.assertTrue(self.drain())
+    self.assertEqual(self.written,['e','f'])
+    self.assertEqual(self.cleared,[1])
+
+  def test_eviction_does_not_skip_counters(self):
+    self.stop_after = 1
+    self.assertFalse(self.drain())
+    self.assertEqual(self.flags.counter_flush_last_key,'b')
+
+    self.ids.remove('a') #Evicted, an offset would skip c
+    self.written = []
+    self.assertTrue(self.drain())
+    self.assertEqual(self.written,['c','d','e','f'])
+
+  def test_stop_before_first_batch_keeps_position(self):
+    self.flags.counter_flush_last_key = 'b'
+    self.flusher = CounterFlusher(batch_size = 2,time_budget = -1)
+    self.assertFalse(self.flusher._drain(self.flags))
+    self.assertEqual(self.written,[])
+    self.assertEqual(self.flags.counter_flush_last_key,'b')
+
+  def test_empty_partitions_are_cleared(self):
+    self.buckets = [1,2,3,4]
+    self.assertTrue(self.drain())
+    self.assertEqual(self.cleared,[1,2,3,4])
+    self.assertEqual(self.written,['a','b','c','d','e','f'])
+    self.assertEqual(self.flags.counter_index_cursor,4)
+    self.assertEqual(self.flags.saves,1)
+
+  def test_stop_in_empty_partitions_keeps_position(self):
+    self.buckets = [1,2,3,4]
+    self.flusher = CounterFlusher(batch_size = 2,time_budget = -1)
+    self.assertFalse(self.flusher._drain(self.flags))
+    self.assertEqual(self.cleared,[1])
+    self.assertEqual(self.flags.counter_index_cursor,1)
+    self.assertEqual(self.flags.saves,1)
+
+class ClosedIndexBucketsTest(unittest.TestCase):
+  '''Current partition is 1000'''
+
+  def setUp(self):
+    self._index_bucket = CounterBase.__dict__['index_bucket']
+    CounterBase.index_bucket = classmethod(lambda cls,timestamp = None: 1000)
+
+  def tearDown(self):
+    CounterBase.index_bucket = self._index_bucket
+
+  def test_without_cursor(self):
+    buckets = list(CounterBase.closed_index_buckets(None))
+    self.assertEqual(len(buckets),config.COUNTER_INDEX_MAX_BUCKETS)
+    self.assertEqual(buckets[-1],998)
+
+  def test_after_cursor(self):
+    self.assertEqual(list(CounterBase.closed_index_buckets(995)),[996,997,998])
+    self.assertEqual(list(CounterBase.closed_index_buckets(998)),[])
+
+  def test_long_gap_is_walked(self):
+    cursor = 998 - 3*config.COUNTER_INDEX_MAX_BUCKETS
+    self.assertEqual(list(CounterBase.closed_index_buckets(cursor)),
+                     range(cursor+1,999))
+
+if __name__ == '__main__':
+  unittest.main()
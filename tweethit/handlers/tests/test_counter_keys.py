@@ -0,0 +1,89 @@
+#Benchmark: python -m tweethit.handlers.tests.test_counter_keys benchmark
+import datetime
+import sys
+import time
+import unittest
+
+from tweethit.model import CounterBase,ProductCounter,UserCounter,Payload,\
+DAILY,WEEKLY,MONTHLY
+from tweethit.utils.counter_util import add_mention_deltas
+
+PRODUCT_URL = 'http://www.amazon.com/dp/%s'
+BENCHMARK_SIZES = [1000,10000,100000]
+
+def build_payloads(size,products = 500,users = 2000):
+  '''Returns size payloads spread over given number of products and users'''
+  return [Payload(PRODUCT_URL %('B%09d' %(i % products)),i % users,1 + i % 3)
+          for i in xrange(size)]
+
+def build_naive(payloads,date):
+  '''Per payload key building, as done before batch key building'''
+  targets = {ProductCounter:{},UserCounter:{}}
+  for payload in payloads:
+    deltas = targets[ProductCounter]
+    for frequency in ProductCounter._counter_frequencies:
+      key_name = ProductCounter.build_key_name(payload.url,frequency,date)
+      deltas[key_name] = deltas.get(key_name,0) + payload.count
+    deltas = targets[UserCounter]
+    for frequency in UserCounter._counter_frequencies:
+      key_name = UserCounter.build_key_name(payload.user_id,frequency,date)
+      deltas[key_name] = deltas.get(key_name,0) + payload.count
+  return targets
+
+def build_batch(payloads,date):
+  root_deltas = add_mention_deltas(payloads,{})
+  return CounterBase.build_key_deltas(root_deltas,date)
+
+class CounterKeyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.date = datetime.date(2011,1,2) #Iso week belongs to 2010
+
+  def test_suffixes_match_build_key_name(self):
+    suffixes = ProductCounter.build_key_suffixes(self.date)
+    for frequency in [DAILY,WEEKLY,MONTHLY]:
+      self.assertEqual(ProductCounter.build_key_name(PRODUCT_URL,frequency,self.date),
+                       PRODUCT_URL+suffixes[frequency])
+
+  def test_aggregates_mentions_per_root(self):
+    payloads = [Payload('http://a',1,2),Payload('http://a',2),
+                Payload('http://b',1)]
+    root_deltas = add_mention_deltas(payloads,{})
+    self.assertEqual(root_deltas[(ProductCounter,'http://a')],3)
+    self.assertEqual(root_deltas[(ProductCounter,'http://b')],1)
+    self.assertEqual(root_deltas[(UserCounter,'1')],3)
+    self.assertEqual(root_deltas[(UserCounter,'2')],1)
+
+  def test_batch_matches_naive(self):
+    payloads = build_payloads(3000)
+    self.assertEqual(build_batch(payloads,self.date),
+                     build_naive(payloads,self.date))
+
+  def test_only_counter_frequencies(self):
+    targets = build_batch([Payload('http://a',1)],self.date)
+    self.assertEqual(targets[ProductCounter].keys(),
+                     [ProductCounter.build_key_name('http://a',DAILY,self.date)])
+
+def benchmark(sizes = BENCHMARK_SIZES,repeat = 3):
+  '''Prints best of repeat timings of naive and batch key building'''
+  date = datetime.date.today()
+  for size in sizes:
+    payloads = build_payloads(size)
+    timings = []
+    for build in (build_naive,build_batch):
+      best = None
+      for i in range(repeat):
+        start = time.time()
+        build(payloads,date)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+          best = elapsed
+      timings.append(best)
+    print '%7d payloads: naive %.3fs batch %.3fs (%.1fx)' \
+          %(size,timings[0],timings[1],timings[0]/max(timings[1],1e-6))
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from PerformanceEngine import pdb,cachepy,MEMCACHE,DATASTORE,MISS_HINT_PREFIX
+
+class Note(pdb.Model):
+  title = db.StringProperty()
+  _negative_ttl = 60
+
+class NegativeCacheTest(unittest.TestCase):
+  '''db.get_async is wrapped to record requested datastore keys'''
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    self.requested = []
+    self._get_async = db.get_async
+    def get_async(keys,**kwds):
+      self.requested.append(keys)
+      return self._get_async(keys,**kwds)
+    db.get_async = get_async
+
+  def tearDown(self):
+    db.get_async = self._get_async
+    cachepy.flush()
+    self.testbed.deactivate()
+
+  def avoided(self):
+    return pdb.negative_cache_stats()['datastore_reads_avoided']
+
+  def test_tombstoned_key_is_not_read(self):
+    key = str(db.Key.from_path('Note','missing'))
+    avoided = self.avoided()
+    self.assertEqual(Note.get_by_key_name('missing'),None)
+    self.assertEqual(len(self.requested),1)
+    self.assertEqual(cachepy.get(MISS_HINT_PREFIX+key),None)
+
+    self.requested = []
+    self.assertEqual(Note.get_by_key_name('missing'),None)
+    self.assertEqual(self.requested,[])
+    self.assertEqual(self.avoided(),avoided + 1)
+
+  def test_put_clears_tombstone(self):
+    self.assertEqual(Note.get_by_key_name('n'),None)
+    Note(key_name = 'n',title = 'a').put()
+    cachepy.flush()
+    self.assertEqual(Note.get_by_key_name('n').title,'a')
+
+  def test_miss_hint_without_negative_ttl(self):
+    key = str(db.Key.from_path('Note','missing'))
+    for i in range(2):
+      self.assertEqual(pdb.get(key,_storage = [MEMCACHE,DATASTORE]),None)
+    #Second read was prefetched in parallel with memcache
+    self.assertEqual(len(self.requested),2)
+    self.assertTrue(cachepy.get(MISS_HINT_PREFIX+key))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,219 @@
+#Benchmark: python -m tweethit.handlers.tests.test_parser_util benchmark
+import re
+import sys
+import time
+import unittest
+
+from tweethit.utils.parser_util import AmazonURLParser,ParserException
+
+class _LegacyParser(object):
+  '''AmazonURLParser before the single pass rewrite, 
+  kept as reference for well formed urls'''
+  ROOT_LOCALES = {'http://www.amazon.com':'us','http://www.amazon.co.uk':'uk',
+                  'http://www.amazon.ca':'ca','http://www.amazon.de':'de',
+                  'http://www.amazon.fr':'fr','http://www.amazon.co.jp':'jp'}
+  KEY_PREFIX_SET = ['/dp/','/gp/product/','/o/ASIN/','/exec/obidos/ASIN/']
+  
+  @classmethod
+  def root_url(cls,url):
+    end_slash_index = url.find('/',7)
+    if end_slash_index > 0:
+      url = url[:end_slash_index]
+    return url
+  
+  @classmethod
+  def get_locale(cls,url):
+    return cls.ROOT_LOCALES.get(cls.root_url(url))
+  
+  @classmethod
+  def extract_asin(cls,url):
+    param_index = url.find('?')
+    if param_index != -1:
+      url = url[:param_index]
+    for prefix in cls.KEY_PREFIX_SET:
+      prefix_index = url.find(prefix)
+      if prefix_index == -1:
+        continue
+      key_start_index = prefix_index + len(prefix)
+      percent_index = url.find('%',key_start_index)
+      key_end_index = url.find('/',key_start_index)
+      if key_end_index == -1:
+        if percent_index == -1:
+          key_end_index = len(url)
+        else:
+          key_end_index = percent_index
+      result = url[key_start_index:key_end_index]
+      while re.match('([A-Z0-9])',result) is None:
+        if key_end_index == -1:
+          result = ''
+          break
+        key_start_index = key_end_index+1
+        key_end_index = url.find('/',key_end_index+1)
+        result = url[key_start_index:key_end_index]
+      if len(result):
+        return result
+    raise ParserException(url)
+  
+  @classmethod
+  def product_url(cls,url):
+    return cls.root_url(url) + '/o/ASIN/' + cls.extract_asin(url)
+
+ROOTS = ['http://www.amazon.com','http://www.amazon.co.uk','http://www.amazon.ca',
+         'http://www.amazon.de','http://www.amazon.fr','http://www.amazon.co.jp']
+ASINS = ['B004HO6I4M','0316015849','B003DZ1Y8Q','B0047E0EII','B00005JNOG','030758836X']
+PRODUCT_FORMS = [
+  '%(root)s/dp/%(asin)s',
+  '%(root)s/dp/%(asin)s/',
+  '%(root)s/dp/%(asin)s/ref=sr_1_1?ie=UTF8&qid=1298&sr=8-1',
+  '%(root)s/Kindle-Wireless-Reading-Display-Globally/dp/%(asin)s/ref=amb_link_2?pf_rd_m=ATVPDKIKX0DER',
+  '%(root)s/gp/product/%(asin)s',
+  '%(root)s/gp/product/%(asin)s/ref=as_li_ss_tl?ie=UTF8&tag=x-20',
+  '%(root)s/gp/product/%(asin)s?tag=a',
+  '%(root)s/o/ASIN/%(asin)s',
+  '%(root)s/exec/obidos/ASIN/%(asin)s',
+  '%(root)s/exec/obidos/ASIN/%(asin)s/tag-20',
+  '%(root)s/Harry-Potter/dp/%(asin)s%%3FSubscriptionId%%3D1',
+  '%(root)s/dp/%(asin)s?tag=a-20&linkCode=as2',
+]
+OTHER_FORMS = [
+  '%(root)s/',
+  '%(root)s/gp/help/customer/display.html',
+  '%(root)s/s/ref=nb_sb_noss?url=search-alias%%3Daps&field-keywords=%(asin)s',
+]
+
+def _corpus(forms):
+  return [form %{'root':root,'asin':asin} 
+          for form in forms for root in ROOTS for asin in ASINS]
+
+def _parse_all(parser,url):
+  result = []
+  for method in ('root_url','get_locale','extract_asin','product_url'):
+    try:
+      result.append(getattr(parser,method)(url))
+    except ParserException:
+      result.append(ParserException)
+  return result
+
+class AmazonURLParserTest(unittest.TestCase):
+  
+  def setUp(self):
+    AmazonURLParser._memo.clear()
+    
+  def tearDown(self):
+    AmazonURLParser._memo.clear()
+    
+  def test_agrees_with_legacy_parser(self):
+    for url in _corpus(PRODUCT_FORMS) + _corpus(OTHER_FORMS):
+      self.assertEqual(_parse_all(AmazonURLParser,url),
+                       _parse_all(_LegacyParser,url),url)
+      
+  def test_parse(self):
+    result = AmazonURLParser.parse('http://www.amazon.co.uk/Some-Book/dp/0316015849/ref=x')
+    self.assertEqual((result.root,result.locale,result.asin,result.product_url),
+                     ('http://www.amazon.co.uk','uk','0316015849',
+                      'http://www.amazon.co.uk/o/ASIN/0316015849'))
+    
+  def test_url_without_product(self):
+    result = AmazonURLParser.parse('http://www.amazon.de/')
+    self.assertEqual((result.root,result.locale,result.asin,result.product_url),
+                     ('http://www.amazon.de','de',None,None))
+    self.assertRaises(ParserException,AmazonURLParser.extract_asin,'http://www.amazon.de/')
+    self.assertRaises(ParserException,AmazonURLParser.product_url,'http://www.amazon.de/')
+    
+  def _assertProduct(self,url,product_url):
+    self.assertEqual(AmazonURLParser.product_url(url),product_url)
+    
+  def test_https(self):
+    self._assertProduct('https://www.amazon.com/dp/B004HO6I4M',
+                        'http://www.amazon.com/o/ASIN/B004HO6I4M')
+    
+  def test_bare_domain_and_subdomains(self):
+    for host in ('amazon.fr','www.amazon.fr','smile.amazon.fr','WWW.Amazon.FR:80'):
+      self._assertProduct('http://%s/dp/B004HO6I4M' %host,
+                          'http://www.amazon.fr/o/ASIN/B004HO6I4M')
+    
+  def test_mobile(self):
+    self._assertProduct('http://m.amazon.co.jp/gp/aw/d/B004HO6I4M/ref=mp_s_a_1',
+                        'http://www.amazon.co.jp/o/ASIN/B004HO6I4M')
+    
+  def test_short_links(self):
+    self._assertProduct('http://amzn.com/B004HO6I4M',
+                        'http://www.amazon.com/o/ASIN/B004HO6I4M')
+    self.assertRaises(ParserException,AmazonURLParser.extract_asin,'http://amzn.com/about')
+    self.assertFalse(AmazonURLParser.is_valid('http://amzn.to/gF1abc'))
+    
+  def test_fragment(self):
+    self.assertEqual(AmazonURLParser.extract_asin('http://www.amazon.com/dp/B004HO6I4M#reviews'),
+                     'B004HO6I4M')
+    
+  def test_skipped_parts_and_percent(self):
+    self.assertEqual(AmazonURLParser.extract_asin(
+                     'http://www.amazon.com/dp/system-requirements/B004HO6I4M'),'B004HO6I4M')
+    self.assertEqual(AmazonURLParser.extract_asin(
+                     'http://www.amazon.com/dp/B004HO6I4M%3FSub/ref=x'),'B004HO6I4M')
+    
+  def test_leftmost_prefix_wins(self):
+    self.assertEqual(AmazonURLParser.extract_asin(
+                     'http://www.amazon.com/gp/product/B00000000A/dp/B00000000B'),'B00000000A')
+    self.assertEqual(AmazonURLParser.extract_asin(
+                     'http://www.amazon.com/gp/product/ref=x/dp/B00000000B'),'B00000000B')
+    
+  def test_invalid_hosts(self):
+    for url in ('http://www.amazon.it/dp/B004HO6I4M','http://notamazon.com/dp/B004HO6I4M',
+                'http://amazon.com.example.org/dp/B004HO6I4M','ftp://www.amazon.com/dp/B0',
+                'www.amazon.com/dp/B004HO6I4M','http://bit.ly/dp/B004HO6I4M'):
+      self.assertFalse(AmazonURLParser.is_valid(url),url)
+      self.assertRaises(ParserException,AmazonURLParser.parse,url)
+      
+  def test_locales(self):
+    for locale,root in AmazonURLParser.STORES:
+      self.assertEqual(AmazonURLParser.get_locale(root+'/dp/B004HO6I4M'),locale)
+      
+  def test_memo(self):
+    url = 'http://www.amazon.com/dp/B004HO6I4M'
+    self.assertTrue(AmazonURLParser.parse(url) is AmazonURLParser.parse(url))
+    self.assertEqual(AmazonURLParser._memo.keys(),[url])
+    
+  def test_memo_is_cleared_when_full(self):
+    original = AmazonURLParser.MEMO_SIZE
+    AmazonURLParser.MEMO_SIZE = 3
+    try:
+      urls = ['http://www.amazon.com/dp/B00000000%d' %i for i in range(4)]
+      for url in urls[:3]:
+        AmazonURLParser.parse(url)
+      self.assertEqual(len(AmazonURLParser._memo),3)
+      AmazonURLParser.parse(urls[3])
+      self.assertEqual(AmazonURLParser._memo.keys(),[urls[3]])
+    finally:
+      AmazonURLParser.MEMO_SIZE = original
+      
+  def test_invalid_urls_are_not_memoized(self):
+    self.assertRaises(ParserException,AmazonURLParser.parse,'http://bit.ly/a')
+    self.assertEqual(AmazonURLParser._memo,{})
+
+def benchmark(repeat = 50):
+  '''Prints time of parsing the test corpus with the legacy parser and 
+  AmazonURLParser, with memo cleared before each pass and kept'''
+  urls = _corpus(PRODUCT_FORMS) + _corpus(OTHER_FORMS)
+  def cold(url):
+    AmazonURLParser._memo.clear()
+    return _parse_all(AmazonURLParser,url)
+  runs = [('legacy',lambda url: _parse_all(_LegacyParser,url)),
+          ('new',cold),
+          ('new+memo',lambda url: _parse_all(AmazonURLParser,url))]
+  for name,parse in runs:
+    AmazonURLParser._memo.clear()
+    start = time.time()
+    for i in range(repeat):
+      for url in urls:
+        parse(url)
+    elapsed = (time.time() - start)/repeat
+    print '%-8s %d urls %7.2fms %6.2fus/url' %(name,len(urls),elapsed*1000,
+                                             elapsed/len(urls)*10**6)
+  AmazonURLParser._memo.clear()
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
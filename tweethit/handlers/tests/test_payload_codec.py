@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#Benchmark: python -m tweethit.handlers.tests.test_payload_codec benchmark
+import random
+import sys
+import time
+import unittest
+
+from tweethit.utils import payload_codec
+from tweethit.utils.payload_codec import PayloadCodecError
+
+def _encode_v1(pairs):
+  '''Version 1 encoding of (url,user_id) pairs, without counts'''
+  users = []
+  urls = []
+  out = [payload_codec.MAGIC,chr(1)]
+  for url,user_id in pairs:
+    if user_id not in users:
+      users.append(user_id)
+    if url not in urls:
+      urls.append(url)
+  for table in (users,urls):
+    payload_codec._write_varint(out,len(table))
+    for value in table:
+      value = value.encode('utf-8')
+      payload_codec._write_varint(out,len(value))
+      out.append(value)
+  payload_codec._write_varint(out,len(pairs))
+  for url,user_id in pairs:
+    payload_codec._write_varint(out,urls.index(url))
+    payload_codec._write_varint(out,users.index(user_id))
+  return ''.join(out)
+
+BENCHMARK_SIZES = [100,1000,10000]
+
+def build_items(size,seed = 1):
+  '''Mentions with repeated urls and users like a bucket upload'''
+  rand = random.Random(seed)
+  return [{'url':'http://www.amazon.com/dp/B%09d' %rand.randint(0,size/4),
+           'user_id':str(rand.randint(10**6,10**6+size/2))}
+          for i in xrange(size)]
+
+class PayloadCodecTest(unittest.TestCase):
+  
+  def test_round_trip(self):
+    items = [{'url':'http://bit.ly/a','user_id':'1'},
+             {'url':u'http://bit.ly/ü','user_id':'2','count':3},
+             {'url':'http://bit.ly/a','user_id':'2'}]
+    data = payload_codec.encode(items)
+    self.assertEqual(list(payload_codec.decode(data)),
+                     [(u'http://bit.ly/a',u'1',1),
+                      (u'http://bit.ly/ü',u'2',3),
+                      (u'http://bit.ly/a',u'2',1)])
+    
+  def test_repeated_mentions_are_aggregated(self):
+    items = [{'url':'http://bit.ly/a','user_id':'1'}]*3
+    reader = payload_codec.decode(payload_codec.encode(items))
+    self.assertEqual(len(reader),1)
+    self.assertEqual(list(reader),[(u'http://bit.ly/a',u'1',3)])
+    
+  def test_reader_can_be_iterated_again(self):
+    data = payload_codec.encode([{'url':'http://bit.ly/a','user_id':'1'}])
+    reader = payload_codec.decode(data)
+    self.assertEqual(list(reader),list(reader))
+    
+  def test_factory(self):
+    data = payload_codec.encode([{'url':'http://bit.ly/a','user_id':'1','count':2}])
+    self.assertEqual(list(payload_codec.decode(data,lambda *args:args)),
+                     [(u'http://bit.ly/a',u'1',2)])
+    
+  def test_version_1(self):
+    data = _encode_v1([('http://bit.ly/a','1'),('http://bit.ly/b','1')])
+    reader = payload_codec.decode(data)
+    self.assertEqual(reader.version,1)
+    self.assertEqual(list(reader),[(u'http://bit.ly/a',u'1',1),
+                                   (u'http://bit.ly/b',u'1',1)])
+    
+  def test_merge(self):
+    first = payload_codec.encode([{'url':'http://bit.ly/a','user_id':'1'},
+                                  {'url':'http://bit.ly/b','user_id':'2'}])
+    second = _encode_v1([('http://bit.ly/a','1'),('http://bit.ly/c','3')])
+    merged = payload_codec.decode(payload_codec.merge([first,second]))
+    self.assertEqual(merged.version,payload_codec.VERSION)
+    self.assertEqual(list(merged),[(u'http://bit.ly/a',u'1',2),
+                                   (u'http://bit.ly/b',u'2',1),
+                                   (u'http://bit.ly/c',u'3',1)])
+    
+  def test_param_round_trip(self):
+    data = payload_codec.encode([{'url':'http://bit.ly/a','user_id':'1'}])
+    self.assertEqual(payload_codec.from_param(payload_codec.to_param(data)),data)
+    
+  def test_invalid_param(self):
+    self.assertRaises(PayloadCodecError,payload_codec.from_param,'a')
+    self.assertRaises(PayloadCodecError,payload_codec.from_param,u'ü')
+    
+  def test_unknown_format(self):
+    self.assertRaises(PayloadCodecError,payload_codec.decode,"[{'url':'x'}]")
+    self.assertRaises(PayloadCodecError,payload_codec.decode,u'TP\x02')
+    self.assertRaises(PayloadCodecError,payload_codec.decode,'TP')
+    self.assertRaises(PayloadCodecError,payload_codec.decode,'TP\x09')
+    
+  def test_truncated(self):
+    data = payload_codec.encode([{'url':'http://bit.ly/a','user_id':'1'},
+                                 {'url':'http://bit.ly/b','user_id':'2'}])
+    for end in range(len(payload_codec.MAGIC)+1,len(data)):
+      try:
+        list(payload_codec.decode(data[:end]))
+      except PayloadCodecError:
+        continue
+      self.fail('Truncated payload of %d bytes was decoded' %end)
+    
+  def test_missing_table_entry(self):
+    out = [payload_codec.MAGIC,chr(2),'\x00','\x00','\x01','\x00','\x00','\x01']
+    self.assertRaises(PayloadCodecError,list,payload_codec.decode(''.join(out)))
+    
+  def test_invalid_utf8(self):
+    data = payload_codec.encode([{'url':'http://bit.ly/a','user_id':'1'}])
+    data = data.replace('bit.ly','bit\xff\xfe')
+    self.assertRaises(PayloadCodecError,payload_codec.decode,data)
+
+def benchmark(sizes = BENCHMARK_SIZES,repeat = 10):
+  '''Prints encode/decode times and sizes of repr/eval payloads
+  and payload_codec task parameters'''
+  def codec_encode(items):
+    return payload_codec.to_param(payload_codec.encode(items))
+  def codec_decode(data):
+    return list(payload_codec.decode(payload_codec.from_param(data)))
+  formats = [('repr',repr,eval),('codec',codec_encode,codec_decode)]
+  for size in sizes:
+    items = build_items(size)
+    for name,encode,decode in formats:
+      start = time.time()
+      for i in range(repeat):
+        data = encode(items)
+      encode_time = (time.time() - start)/repeat
+      start = time.time()
+      for i in range(repeat):
+        decode(data)
+      decode_time = (time.time() - start)/repeat
+      print '%6d %-6s encode %7.2fms decode %7.2fms %8d bytes' \
+            %(size,name,encode_time*1000,decode_time*1000,len(data))
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
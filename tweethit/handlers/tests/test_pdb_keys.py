@@ -0,0 +1,122 @@
+#Benchmark: python -m tweethit.handlers.tests.test_pdb_keys benchmark
+import sys
+import time
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from PerformanceEngine import pdb,cachepy,LOCAL,MEMCACHE,DATASTORE,_to_dict
+from tweethit.model import Url
+
+BENCHMARK_SIZES = [100,500]
+
+class Note(pdb.Model):
+  title = db.StringProperty()
+
+class PlainNote(db.Model):
+  title = db.StringProperty()
+
+class MemoizedKeyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+
+  def tearDown(self):
+    cachepy.flush()
+    self.testbed.deactivate()
+
+  def test_incomplete_key_is_not_memoized(self):
+    note = Note(title = 'a')
+    self.assertRaises(db.NotSavedError,note._key_str)
+    self.assertRaises(db.NotSavedError,note._key_str) #Nothing was memoized
+    self.assertFalse(hasattr(note,'_pdb_key'))
+
+    note.put()
+    self.assertTrue(note.key().id() is not None)
+    self.assertEqual(note._memo_key(),note.key())
+    self.assertEqual(note._key_str(),str(note.key()))
+
+  def test_saved_model_is_cached_under_its_key(self):
+    note = Note(title = 'a')
+    self.assertRaises(db.NotSavedError,note._key_str)
+    key = pdb.put(note,_storage = [MEMCACHE,DATASTORE])
+    self.assertEqual(key,note.key())
+    self.assertTrue(memcache.get(note._key_str()) is not None)
+    cached = pdb.get(key,_storage = [MEMCACHE])
+    self.assertEqual(cached.title,'a')
+
+  def test_key_name_is_memoized_before_put(self):
+    note = Note(key_name = 'n',title = 'a')
+    key_str = note._key_str()
+    self.assertEqual(key_str,str(db.Key.from_path('Note','n')))
+    note.put()
+    self.assertTrue(note._key_str() is key_str)
+    self.assertEqual(pdb.get(key_str,_storage = [MEMCACHE]).title,'a')
+
+  def test_dict_of_mixed_models(self):
+    note = Note(key_name = 'n')
+    plain = PlainNote(key_name = 'p')
+    self.assertEqual(_to_dict([note,plain]),{str(note.key()):note,
+                                             str(plain.key()):plain})
+
+def build_urls(size):
+  return [Url(key_name = 'http://bit.ly/%x' %i,
+              final_url = 'http://www.amazon.com/dp/B%09d' %i,
+              user_id = str(i),is_valid = True,is_product = True)
+          for i in xrange(size)]
+
+class _Unmemoized(object):
+  '''Key methods of pdb.Model without the memo, as before it was added'''
+  def _memo_key(self):
+    return self.key()
+
+  def _key_str(self):
+    return str(self.key())
+
+def benchmark(sizes = BENCHMARK_SIZES,repeat = 20):
+  '''Prints per entity time of building cache keys and of pdb.put 
+  to LOCAL and MEMCACHE, with and without memoized keys'''
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  methods = dict([(name,pdb.Model.__dict__[name]) 
+                  for name in ('_memo_key','_key_str')])
+  try:
+    for size in sizes:
+      for name in ('no memo','memo'):
+        for method in methods:
+          if name == 'memo':
+            setattr(pdb.Model,method,methods[method])
+          else:
+            setattr(pdb.Model,method,_Unmemoized.__dict__[method])
+        key_time = put_time = 0
+        for i in range(repeat):
+          urls = build_urls(size)
+          start = time.time()
+          _to_dict(urls)
+          key_time += time.time() - start
+          urls = build_urls(size)
+          start = time.time()
+          pdb.put(urls,_storage = [LOCAL,MEMCACHE])
+          put_time += time.time() - start
+        count = float(size*repeat)
+        print '%4d Url %-7s keys %6.2fus/entity put %7.2fus/entity' \
+              %(size,name,key_time/count*10**6,put_time/count*10**6)
+  finally:
+    for method,function in methods.iteritems():
+      setattr(pdb.Model,method,function)
+    cachepy.flush()
+    bed.deactivate()
+
+if __name__ == '__main__':
+  if 'benchmark' in sys.argv[1:]:
+    benchmark()
+  else:
+    unittest.main()
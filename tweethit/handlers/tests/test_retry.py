@@ -0,0 +1,123 @@
+import unittest
+
+from PerformanceEngine import retry
+from PerformanceEngine.retry import RetryPolicy
+
+class _Transient(Exception):
+  pass
+
+class _Clock(object):
+  '''Replaces time.time and time.sleep of retry module'''
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+
+  def time(self):
+    return self.now
+
+  def sleep(self,seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+class _RPC(object):
+  '''Calls fn when the result is requested'''
+  def __init__(self,fn):
+    self.fn = fn
+
+  def get_result(self):
+    return self.fn()
+
+class RetryPolicyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = _Clock()
+    self._time = retry.time
+    retry.time = self.clock
+    retry.reset_stats()
+    self.calls = 0
+
+  def tearDown(self):
+    retry.time = self._time
+    retry.reset_stats()
+
+  def failing(self,failures,duration = 0):
+    '''Returns a function that raises _Transient failures times,
+    each call takes duration seconds'''
+    def fn():
+      self.calls += 1
+      self.clock.now += duration
+      if self.calls <= failures:
+        raise _Transient()
+      return 'ok'
+    return fn
+
+  def policy(self,**kwds):
+    kwds.setdefault('retry_on',_Transient)
+    kwds.setdefault('jitter',False)
+    return RetryPolicy('test',**kwds)
+
+  def test_exponential_backoff(self):
+    policy = self.policy(initial_delay = 0.1,max_delay = 0.5,max_attempts = 6)
+    self.assertEqual(policy.run(self.failing(5)),'ok')
+    self.assertEqual(self.clock.sleeps,[0.1,0.2,0.4,0.5,0.5])
+
+  def test_jitter_stays_below_delay(self):
+    policy = self.policy(initial_delay = 0.1,max_delay = 0.5,jitter = True)
+    for attempt in range(1,10):
+      delay = policy.delay(attempt)
+      self.assertTrue(0 <= delay <= min(0.5,0.1*2**(attempt-1)))
+
+  def test_max_attempts(self):
+    policy = self.policy(max_attempts = 3)
+    self.assertRaises(_Transient,policy.run,self.failing(5))
+    self.assertEqual(self.calls,3)
+    self.assertEqual(len(self.clock.sleeps),2)
+
+  def test_time_budget(self):
+    #Calls take a second, the third sleep would end after the budget
+    policy = self.policy(initial_delay = 1,multiplier = 1,
+                         max_attempts = 10,time_budget = 5)
+    self.assertRaises(_Transient,policy.run,self.failing(10,duration = 1))
+    self.assertEqual(self.calls,3)
+    self.assertEqual(self.clock.sleeps,[1,1])
+
+  def test_other_errors_are_not_retried(self):
+    policy = self.policy()
+    def fn():
+      self.calls += 1
+      raise ValueError()
+    self.assertRaises(ValueError,policy.run,fn)
+    self.assertEqual(self.calls,1)
+    self.assertEqual(self.clock.sleeps,[])
+
+  def test_stats_per_call_site(self):
+    policy = self.policy(initial_delay = 0.1,multiplier = 1,max_attempts = 2)
+    fn = self.failing(3)
+    @policy
+    def flaky():
+      return fn()
+    self.assertRaises(_Transient,flaky)
+    self.assertEqual(flaky(),'ok')
+    self.assertEqual(retry.stats(),{'test.flaky':{'calls':2,'retries':2,
+                                                  'failures':1,'sleep':0.2}})
+
+  def test_async_call_is_repeated(self):
+    policy = self.policy(initial_delay = 0.1,max_attempts = 4)
+    fn = self.failing(2)
+    future = policy.run_async(lambda: _RPC(fn))
+    self.assertEqual(self.calls,0) #RPC is started, not waited for
+    self.assertEqual(future.get_result(),'ok')
+    self.assertEqual(self.calls,3)
+    self.assertEqual(self.clock.sleeps,[0.1,0.2])
+    self.assertEqual(retry.stats(),{'test':{'calls':1,'retries':2,
+                                            'failures':0,'sleep':0.1+0.2}})
+
+  def test_async_gives_up(self):
+    policy = self.policy(max_attempts = 2)
+    future = policy.run_async(lambda fn: _RPC(fn),self.failing(5))
+    self.assertRaises(_Transient,future.get_result)
+    self.assertEqual(self.calls,2)
+    self.assertEqual(retry.stats()['test']['failures'],1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from google.appengine.api import taskqueue
+
+from tweethit.model import Payload
+from tweethit.utils import payload_codec
+from tweethit.utils import task_util
+from tweethit.utils.task_util import TaskBuffer
+
+class _Task(object):
+  def __init__(self,name):
+    self.name = name
+    self.was_enqueued = False
+
+class _Queue(object):
+  '''Adds tasks by name, the first add enqueues add_first tasks and
+  then fails with TransientError'''
+  def __init__(self,add_first = None):
+    self.names = []
+    self.add_first = add_first
+    self.calls = 0
+
+  def add(self,tasks):
+    self.calls += 1
+    exists = False
+    for i,task in enumerate(tasks):
+      if self.add_first is not None and i == self.add_first:
+        self.add_first = None
+        raise taskqueue.TransientError()
+      if task.name in self.names:
+        exists = True
+        continue
+      self.names.append(task.name)
+      task.was_enqueued = True
+    if exists:
+      raise taskqueue.TaskAlreadyExistsError()
+
+def _payload(mentions,url = 'http://a'):
+  return Payload.serialize([Payload(url,1,mentions)])
+
+class AddBatchTest(unittest.TestCase):
+
+  def test_retry_skips_enqueued_tasks(self):
+    queue = _Queue(add_first = 2)
+    tasks = [_Task(str(i)) for i in range(5)]
+    task_util._add_batch(queue,tasks)
+    self.assertEqual(queue.calls,2)
+    self.assertEqual(queue.names,[str(i) for i in range(5)])
+
+  def test_existing_task_is_success(self):
+    queue = _Queue()
+    queue.names.append('1')
+    tasks = [_Task(str(i)) for i in range(3)]
+    task_util._add_batch(queue,tasks)
+    self.assertEqual(queue.calls,1)
+    self.assertEqual(sorted(queue.names),['0','1','2'])
+
+  def test_single_task(self):
+    queue = _Queue()
+    task_util._add_batch(queue,_Task('a'))
+    self.assertEqual(queue.names,['a'])
+
+class MergeTest(unittest.TestCase):
+
+  def mentions(self,param):
+    return sum([count for url,user_id,count in
+                payload_codec.decode(payload_codec.from_param(param))])
+
+  def test_limit_counts_mentions(self):
+    buffer = TaskBuffer(merge_limit = 10)
+    payloads = [_payload(4,'http://%d' %i) for i in range(5)]
+    merged = buffer._merge(payloads)
+    self.assertEqual([self.mentions(param) for param in merged],[8,8,4])
+
+  def test_large_payload_is_kept(self):
+    buffer = TaskBuffer(merge_limit = 10)
+    merged = buffer._merge([_payload(2),_payload(30,'http://b'),_payload(3)])
+    self.assertEqual([self.mentions(param) for param in merged],[2,30,3])
+
+  def test_single_payload_untouched(self):
+    payload = _payload(50)
+    self.assertEqual(TaskBuffer(merge_limit = 10)._merge([payload]),[payload])
+
+if __name__ == '__main__':
+  unittest.main()
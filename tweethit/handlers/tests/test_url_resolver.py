@@ -0,0 +1,116 @@
+import unittest
+
+from google.appengine.api.urlfetch import DownloadError
+
+from tweethit.utils import rpc
+from tweethit.utils.rpc import UrlResolver
+
+PRODUCT_URL = 'http://www.amazon.com/dp/B004HO6I4M/ref=x'
+
+class _Response(object):
+  def __init__(self,status_code,location = None):
+    self.status_code = status_code
+    self.headers = {}
+    if location is not None:
+      self.headers['location'] = location
+
+class _RPC(object):
+  def __init__(self,test):
+    self.test = test
+    self.url = None
+    
+  def get_result(self):
+    response = self.test.routes.get(self.url)
+    if response is None:
+      raise DownloadError(self.url)
+    return response
+
+class UrlResolverTest(unittest.TestCase):
+  '''Requests are answered from routes, url => _Response, 
+  urls without a route fail with DownloadError'''
+  
+  def setUp(self):
+    self.routes = {}
+    self.fetched = []
+    self.in_flight = {} #host => requests in flight
+    self.max_in_flight = {}
+    self._originals = (rpc.urlfetch.create_rpc,rpc.urlfetch.make_fetch_call,
+                       rpc.apiproxy_stub_map.UserRPC.wait_any)
+    rpc.urlfetch.create_rpc = self._create_rpc
+    rpc.urlfetch.make_fetch_call = self._make_fetch_call
+    rpc.apiproxy_stub_map.UserRPC.wait_any = staticmethod(self._wait_any)
+    
+  def tearDown(self):
+    rpc.urlfetch.create_rpc,rpc.urlfetch.make_fetch_call,wait_any = self._originals
+    rpc.apiproxy_stub_map.UserRPC.wait_any = staticmethod(wait_any)
+    
+  def _create_rpc(self,deadline = None):
+    return _RPC(self)
+  
+  def _make_fetch_call(self,fetch_rpc,url,method = None,follow_redirects = True):
+    self.assertFalse(follow_redirects)
+    fetch_rpc.url = url
+    self.fetched.append(url)
+    host = rpc._host(url)
+    self.in_flight[host] = self.in_flight.get(host,0) + 1
+    self.max_in_flight[host] = max(self.max_in_flight.get(host,0),
+                                   self.in_flight[host])
+    
+  def _wait_any(self,rpcs):
+    done = sorted(rpcs,key = lambda fetch_rpc:fetch_rpc.url)[0]
+    self.in_flight[rpc._host(done.url)] -= 1
+    return done
+  
+  def test_direct_product_url_is_not_fetched(self):
+    result = UrlResolver().resolve_chains([PRODUCT_URL])
+    self.assertEqual(result,{PRODUCT_URL:(PRODUCT_URL,[PRODUCT_URL])})
+    self.assertEqual(self.fetched,[])
+    
+  def test_chain_stops_at_product_url(self):
+    self.routes['http://bit.ly/a'] = _Response(301,'http://amzn.to/b')
+    self.routes['http://amzn.to/b'] = _Response(302,PRODUCT_URL)
+    result = UrlResolver().resolve_chains(['http://bit.ly/a'])
+    self.assertEqual(result['http://bit.ly/a'],
+                     (PRODUCT_URL,['http://bit.ly/a','http://amzn.to/b',PRODUCT_URL]))
+    self.assertEqual(self.fetched,['http://bit.ly/a','http://amzn.to/b'])
+    
+  def test_without_early_exit_chain_is_followed(self):
+    self.routes['http://bit.ly/a'] = _Response(301,PRODUCT_URL)
+    self.routes[PRODUCT_URL] = _Response(200)
+    result = UrlResolver(early_exit = False).resolve(['http://bit.ly/a'])
+    self.assertEqual(result,{'http://bit.ly/a':PRODUCT_URL})
+    self.assertEqual(self.fetched,['http://bit.ly/a',PRODUCT_URL])
+  
+  def test_final_url_and_relative_redirect(self):
+    self.routes['http://bit.ly/a'] = _Response(301,'/b')
+    self.routes['http://bit.ly/b'] = _Response(200)
+    self.assertEqual(UrlResolver().resolve(['http://bit.ly/a']),
+                     {'http://bit.ly/a':'http://bit.ly/b'})
+    
+  def test_shared_hop_is_requested_once(self):
+    self.routes['http://bit.ly/a'] = _Response(301,'http://example.com/x')
+    self.routes['http://t.co/b'] = _Response(301,'http://example.com/x')
+    self.routes['http://example.com/x'] = _Response(200)
+    result = UrlResolver().resolve(['http://bit.ly/a','http://t.co/b'])
+    self.assertEqual(result,{'http://bit.ly/a':'http://example.com/x',
+                             'http://t.co/b':'http://example.com/x'})
+    self.assertEqual(self.fetched.count('http://example.com/x'),1)
+    
+  def test_errors_and_redirect_loops_resolve_to_none(self):
+    self.routes['http://bit.ly/loop'] = _Response(301,'http://bit.ly/loop2')
+    self.routes['http://bit.ly/loop2'] = _Response(301,'http://bit.ly/loop')
+    result = UrlResolver(max_redirects = 3).resolve(['http://bit.ly/loop',
+                                                     'http://bit.ly/missing'])
+    self.assertEqual(result,{'http://bit.ly/loop':None,
+                             'http://bit.ly/missing':None})
+    
+  def test_host_limit(self):
+    urls = ['http://bit.ly/%d' %i for i in range(5)]
+    for url in urls:
+      self.routes[url] = _Response(200)
+    result = UrlResolver(host_limit = 2).resolve(urls)
+    self.assertEqual(result,dict([(url,url) for url in urls]))
+    self.assertEqual(self.max_in_flight['bit.ly'],2)
+
+if __name__ == '__main__':
+  unittest.main()
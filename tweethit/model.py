@@ -1,15 +1,26 @@
-from PerformanceEngine import pdb,MEMCACHE,DATASTORE
+from PerformanceEngine import pdb,cachepy,MEMCACHE,DATASTORE,NAME_DICT,\
+LOCAL_EXPIRATION
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
-from tweethit.utils.parser_util import AmazonURLParser
+from tweethit.utils.parser_util import AmazonURLParser,str_to_date
+from tweethit.utils import payload_codec
+from tweethit.utils.bloom import BloomFilter
 
 import config
+import logging
+import random
+import time
+import zlib
 
 DAILY='daily'
 WEEKLY='weekly'
 MONTHLY='monthly'
 
+'''Dirty counter indexes'''
+COUNTER_INDEX = 'counter'
+ROLLUP_INDEX = 'rollup'
+
 class FrequencyBase(pdb.Model):
   '''Base model including methods for building key names 
   using date and frequency'''
@@ -51,6 +62,38 @@ class FrequencyBase(pdb.Model):
     key_arr = map(str,key_arr)
     return cls._default_delimiter.join(key_arr)
   
+  @classmethod
+  def build_key_suffixes(cls,date):
+    '''Returns frequency - key name suffix dictionary for given date
+    
+    Key name of a key root is key_root + suffix, same as build_key_name,
+    so suffixes can be computed once for a batch of key roots'''
+    delim = cls._default_delimiter
+    year = str(date.year)
+    return {
+      DAILY: delim.join(['',DAILY,str(date)]),
+      WEEKLY: delim.join(['',WEEKLY,year,str(date.isocalendar()[1])]),
+      MONTHLY: delim.join(['',MONTHLY,year,str(date.month)]),
+    }
+  
+  @classmethod
+  def from_key_name(cls,key_name,**kwds):
+    '''Creates an entity with period properties parsed from a key name
+    built by build_key_name'''
+    key_arr = key_name.split(cls._default_delimiter)
+    frequency = key_arr[1]
+    if frequency == DAILY:
+      kwds['day'] = str_to_date(key_arr[2])
+    elif frequency == WEEKLY:
+      kwds['year'] = int(key_arr[2])
+      kwds['week'] = int(key_arr[3])
+    elif frequency == MONTHLY:
+      kwds['year'] = int(key_arr[2])
+      kwds['month'] = int(key_arr[3])
+    else:
+      raise FrequencyError(frequency)
+    return cls(key_name=key_name,**kwds)
+  
   @classmethod
   def new(cls,key_root,frequency,date,_build_key_name=True,**kwds):
     if _build_key_name:
@@ -82,6 +125,15 @@ class OperationFlags(pdb.Model):
   _key_name = 'OperationFlags'
   _storage = [MEMCACHE,DATASTORE]
   
+  #Last counter index partition written to datastore
+  counter_index_cursor = db.IntegerProperty()
+  #Last counter id written from the partition after cursor, 
+  #counters are written in sorted order
+  counter_flush_last_key = db.StringProperty()
+  #Same as above for rollup index
+  rollup_index_cursor = db.IntegerProperty()
+  rollup_flush_last_key = db.StringProperty()
+  
   
   def save(self):
     self.put(_storage=self.__class__._storage)
@@ -107,22 +159,10 @@ class Store(pdb.Model):
         
   @classmethod
   def key_for_locale(cls,locale):
-    root = 'http://www.amazon.'
-    if locale == 'us':
-      root += 'com'
-    elif locale == 'uk':
-      root += 'co.uk'
-    elif locale == 'de':
-      root += 'de'
-    elif locale == 'ca':
-      root += 'ca'
-    elif locale == 'fr':
-      root += 'fr'
-    elif locale == 'jp':
-      root += 'co.jp'
-    else:
+    try:
+      root = AmazonURLParser.LOCALE_ROOTS[locale]
+    except KeyError:
       raise StoreException('Store not found for locale: %s' %locale)
-    
     return db.Key.from_path('Store',root)
             
 class StoreException(Exception):
@@ -133,41 +173,354 @@ class StoreException(Exception):
         return repr(self.message)
        
 class CounterBase(FrequencyBase):
-  '''Base class for counters'''
+  '''Base class for counters
+  
+  Counts are kept in memcache integer counters, incremented atomically
+  with offset_multi and written to datastore by the counter update cron.
+  Increments for hot keys are spread over _SHARDS memcache counters.
+  
+  Counters for _rollup_frequencies are not incremented for each mention,
+  daily counts are added to them while daily counters are flushed and 
+  they are written to datastore in the same flush. They are also listed 
+  in the rollup index, so the rollup cron writes any left behind.
+  
+  Memcache counts of a counter belong to a generation, a memcache key
+  next to the shards that is renewed whenever the first shard is created
+  and stored on the entity when it's flushed. Entity count is 
+  base_count + memcache count of its generation, so after an eviction 
+  the stored count becomes the base of the new generation.
+  '''
   
   _MIN_COUNT_FOR_DB_WRITE = None #Must be overridden
+  _SHARDS = 1 #Max number of memcache counters for a hot key
+  _HOT_COUNT = 100 #Keys with at least this count are sharded
+  _HOT_EXPIRATION = 3600
+  _counter_prefix = 'counter|'
+  _hot_prefix = 'hot_counter|'
+  _rolled_prefix = 'rolled_counter|' #Daily count already added to rollups
+  _generation_prefix = 'counter_generation|'
+  _ROLLED_EXPIRATION = 3*86400
+  _counter_frequencies = [DAILY] #Counters incremented for each mention
+  _rollup_frequencies = [] #Counters derived from daily counters
   
   count = db.IntegerProperty(default = 0)
   #used for omitting spam,refreshed by cron
   is_banned = db.BooleanProperty(default = False)
+  #Count before current memcache generation, see class docstring
+  base_count = db.IntegerProperty(default = 0,indexed = False)
+  generation = db.StringProperty(indexed = False)
+  
+  @classmethod
+  def counter_id(cls,key_name):
+    '''Identifier of a counter within all counter kinds'''
+    return cls.kind()+cls._default_delimiter+key_name
+  
+  @classmethod
+  def parse_counter_id(cls,counter_id):
+    '''Returns model class and key name for a counter identifier'''
+    kind,key_name = counter_id.split(cls._default_delimiter,1)
+    return db.class_for_kind(kind),key_name
+  
+  @classmethod
+  def _shard_key(cls,counter_id,shard):
+    return counter_id+cls._default_delimiter+str(shard)
+  
+  @classmethod
+  def _choose_shard(cls,counter_id):
+    if cls._SHARDS > 1 and cachepy.get(cls._hot_prefix+counter_id):
+      return random.randint(0,cls._SHARDS-1)
+    return 0
   
   @classmethod
-  def filtered_update(cls,models):
-    db_targets = [str(model.key()) for model in models 
-                        if model.count >= cls._MIN_COUNT_FOR_DB_WRITE]
-    pdb.put(models,_storage=MEMCACHE)
+  def increment(cls,deltas,index=COUNTER_INDEX):
+    '''Atomically adds deltas to counters in memcache
+    
+    Counters that reach _MIN_COUNT_FOR_DB_WRITE are added 
+    to cached counter keys to be written to datastore by cron.
+    If the class has rollups, every incremented daily counter is 
+    added so its count can be rolled up.
+    
+    Args:
+      deltas: key_name - delta dictionary
+      index: Dirty counter index to add counters to
+    '''
+    shard_deltas = {}
+    for key_name,delta in deltas.iteritems():
+      counter_id = cls.counter_id(key_name)
+      shard_deltas[cls._shard_key(counter_id,cls._choose_shard(counter_id))] = delta
+    
+    results = memcache.offset_multi(shard_deltas,
+                                    key_prefix=cls._counter_prefix,
+                                    initial_value=0)
+    index_all = len(cls._rollup_frequencies) and index == COUNTER_INDEX
+    db_targets = []
+    new_counters = {}
+    generations = {}
+    for shard_key,value in results.iteritems():
+      if value is None:
+        logging.error('Could not increment counter: %s' %shard_key)
+        continue
+      counter_id,shard = shard_key.rsplit(cls._default_delimiter,1)
+      if value >= cls._HOT_COUNT and cls._SHARDS > 1:
+        cachepy.set(cls._hot_prefix+counter_id,True,cls._HOT_EXPIRATION)
+      if index_all or value >= cls._MIN_COUNT_FOR_DB_WRITE or shard != '0':
+        db_targets.append(counter_id)
+      if value == shard_deltas[shard_key] and shard == '0':
+        generations[counter_id] = None
+        if index_all:
+          new_counters[cls._rolled_prefix+counter_id] = 0
+    
+    if len(new_counters):
+      #Missing rolled counts are treated as evicted, see _rollup
+      memcache.add_multi(new_counters,time=cls._ROLLED_EXPIRATION)
+    if len(generations):
+      generation = cls._new_generation()
+      memcache.set_multi(dict.fromkeys(generations,generation),
+                         key_prefix=cls._generation_prefix)
     if len(db_targets):
-        cls.update_cached_counter_keys(db_targets)
+      cls.update_cached_counter_keys(db_targets,index)
+  
+  @classmethod
+  def increment_roots(cls,root_deltas,date):
+    '''Increments counters of all _counter_frequencies for given key roots
+    
+    Args:
+      root_deltas: (counter class,key root) - delta dictionary
+      date: Date used for building key names
+    '''
+    targets = cls.build_key_deltas(root_deltas,date)
+    for klass,deltas in targets.iteritems():
+      klass.increment(deltas)
+  
+  @classmethod
+  def build_key_deltas(cls,root_deltas,date):
+    '''Returns counter class - (key name - delta dictionary) dictionary
+    for all _counter_frequencies of given key roots
+    
+    Args:
+      root_deltas: (counter class,key root) - delta dictionary
+      date: Date used for building key names
+    '''
+    suffixes = cls.build_key_suffixes(date)
+    targets = {}
+    for (klass,key_root),delta in root_deltas.iteritems():
+      deltas = targets.setdefault(klass,{})
+      for frequency in klass._counter_frequencies:
+        deltas[key_root+suffixes[frequency]] = delta
+    return targets
+  
+  @classmethod
+  def build_flush_entities(cls,counter_ids):
+    '''Returns entities holding memcache counts of given counters,
+    to be written into datastore
+    
+    Existing entities are updated so flags like is_banned are kept.
+    Counts of counters whose memcache generation is gone are added
+    to their stored counts, see CounterBase docstring.
+    '''
+    groups = {}
+    for counter_id in counter_ids:
+      try:
+        klass,key_name = cls.parse_counter_id(counter_id)
+      except (ValueError,db.KindError):
+        logging.error('Invalid counter id: %s' %counter_id)
+        continue
+      groups.setdefault(klass,[]).append(key_name)
+    
+    result = []
+    for klass,key_names in groups.iteritems():
+      result.extend(klass._flush_group(key_names))
+    return result
+  
+  @classmethod
+  def _flush_group(cls,key_names):
+    cache_keys = []
+    for key_name in key_names:
+      counter_id = cls.counter_id(key_name)
+      cache_keys.extend([cls._counter_prefix+cls._shard_key(counter_id,shard) 
+                         for shard in range(cls._SHARDS)])
+      cache_keys.append(cls._generation_prefix+counter_id)
+      if len(cls._rollup_frequencies):
+        cache_keys.append(cls._rolled_prefix+counter_id)
+    values = memcache.get_multi(cache_keys)
+    
+    totals = {}
+    generations = {}
+    for key_name in key_names:
+      counter_id = cls.counter_id(key_name)
+      total = 0
+      for shard in range(cls._SHARDS):
+        total += int(values.get(cls._counter_prefix+cls._shard_key(counter_id,shard),0))
+      totals[key_name] = total
+      generations[key_name] = values.get(cls._generation_prefix+counter_id)
+    
+    rollup_entities = []
+    if len(cls._rollup_frequencies):
+      rolled_up = cls._rollup(totals,values)
+      if len(rolled_up):
+        rollup_entities = cls._flush_group(rolled_up)
+    
+    db_targets = [key_name for key_name,total in totals.iteritems() 
+                  if total >= cls._MIN_COUNT_FOR_DB_WRITE]
+    if not len(db_targets):
+      return rollup_entities
+    entities = cls.get_by_key_name(db_targets,_storage=DATASTORE,
+                                   _result_type=NAME_DICT)
+    
+    to_put = rollup_entities
+    missing = {}
+    resets = 0
+    for key_name in db_targets:
+      total = totals[key_name]
+      generation = generations[key_name]
+      entity = entities.get(key_name)
+      if entity is None:
+        entity = cls.from_key_name(key_name,generation=generation)
+      elif entity.generation is not None and generation is not None and \
+           entity.generation != generation:
+        resets += 1
+        entity.base_count = entity.count
+        entity.generation = generation
+      elif entity.generation is None or entity.base_count + total < entity.count:
+        #Entity predates generations or some shards were evicted,
+        #memcache count is treated as part of stored count
+        entity.base_count = max(entity.count - total,0)
+        entity.generation = generation or entity.generation
+      elif generation is not None and entity.base_count + total == entity.count:
+        continue
+      if generation is None:
+        #Only generation key was evicted or it was never set
+        missing[key_name] = entity
+      entity.count = entity.base_count + total
+      to_put.append(entity)
+    
+    if len(missing):
+      #A generation started meanwhile isn't overwritten, 
+      #next flush sees it as a reset
+      generation = cls._new_generation()
+      markers = {}
+      for key_name,entity in missing.iteritems():
+        entity.generation = entity.generation or generation
+        markers[cls.counter_id(key_name)] = entity.generation
+      memcache.add_multi(markers,key_prefix=cls._generation_prefix)
+    if resets:
+      logging.warning('Added stored counts to %s evicted counters' %resets)
+    return to_put
+  
+  @classmethod
+  def _new_generation(cls):
+    return '%x.%x' %(int(time.time()*1000),random.getrandbits(32))
+  
+  @classmethod
+  def _rollup(cls,totals,values):
+    '''Adds daily counts that weren't rolled up yet to counters
+    of _rollup_frequencies and returns their key names
+    
+    Args:
+      totals: key_name - memcache count dictionary
+      values: memcache values including rolled counts
+    '''
+    rolled_offsets = {}
+    evicted = {}
+    rollup_deltas = {}
+    suffix_cache = {}
+    for key_name,total in totals.iteritems():
+      key_arr = key_name.split(cls._default_delimiter)
+      if key_arr[1] != DAILY:
+        continue
+      rolled_key = cls._rolled_prefix+cls.counter_id(key_name)
+      rolled = values.get(rolled_key)
+      if rolled is None:
+        #Rolled count evicted, skip what's counted so far instead of counting twice
+        evicted[rolled_key] = total
+        continue
+      delta = total - int(rolled)
+      if delta <= 0:
+        continue
+      
+      rolled_offsets[rolled_key] = delta
+      try:
+        suffixes = suffix_cache[key_arr[2]]
+      except KeyError:
+        suffixes = cls.build_key_suffixes(str_to_date(key_arr[2]))
+        suffix_cache[key_arr[2]] = suffixes
+      for frequency in cls._rollup_frequencies:
+        rollup_key_name = key_arr[0]+suffixes[frequency]
+        rollup_deltas[rollup_key_name] = rollup_deltas.get(rollup_key_name,0) + delta
+    
+    if len(evicted):
+      logging.warning('Rolled counts missing for %s counters' %len(evicted))
+      memcache.set_multi(evicted,time=cls._ROLLED_EXPIRATION)
+    if len(rolled_offsets):
+      memcache.offset_multi(rolled_offsets,initial_value=0)
+      cls.increment(rollup_deltas,ROLLUP_INDEX)
+    return rollup_deltas.keys()
 
   @classmethod
-  def update_cached_counter_keys(cls,key_array):
-    '''Update counter_keys group in memcache for cron'''
-    cached_keys = cls.get_cached_counter_keys()
-    cached_keys = list(set(cached_keys + key_array))
-    cls.set_cached_counter_keys(cached_keys)
+  def index_bucket(cls,timestamp=None):
+    '''Counter index partition for given time, current time by default'''
+    if timestamp is None:
+      timestamp = time.time()
+    return int(timestamp) // config.COUNTER_INDEX_BUCKET_SECONDS
+  
+  @classmethod
+  def update_cached_counter_keys(cls,key_array,index=COUNTER_INDEX):
+    '''Appends counter ids to current index partition in memcache for cron
+    
+    Each call reserves its own slot with an atomic incr, so concurrent
+    writers never overwrite each other'''
+    bucket = cls.index_bucket()
+    slot = memcache.incr(cls._index_length_key(index,bucket),initial_value=0)
+    if slot is None:
+      logging.error('Could not append to %s index bucket: %s' %(index,bucket))
+      return
+    memcache.set(cls._index_slot_key(index,bucket,slot),key_array)
       
   @classmethod
-  def get_cached_counter_keys(cls):
-    key_array = memcache.get('counter_keys')
-    if key_array is None:
-      key_array = []
-      memcache.set('counter_keys',key_array)
-        
-    return key_array
+  def get_cached_counter_keys(cls,bucket,index=COUNTER_INDEX):
+    '''Returns the set of counter ids appended to given index partition'''
+    length = memcache.get(cls._index_length_key(index,bucket))
+    if not length:
+      return set()
+    slots = memcache.get_multi([cls._index_slot_key(index,bucket,slot) 
+                                for slot in range(1,int(length)+1)])
+    result = set()
+    for key_array in slots.itervalues():
+      result.update(key_array)
+    return result
+  
+  @classmethod
+  def clear_cached_counter_keys(cls,bucket,index=COUNTER_INDEX):
+    length = memcache.get(cls._index_length_key(index,bucket)) or 0
+    keys = [cls._index_slot_key(index,bucket,slot) for slot in range(1,int(length)+1)]
+    keys.append(cls._index_length_key(index,bucket))
+    memcache.delete_multi(keys)
+  
+  @classmethod
+  def closed_index_buckets(cls,cursor):
+    '''Index partitions after cursor that no longer receive writes
+    
+    The partition before the current one is left open for a period
+    so writers that reserved a slot late can still fill it.
+    Without a cursor the last COUNTER_INDEX_MAX_BUCKETS partitions are
+    returned, after a longer gap every partition since cursor is, 
+    so counters indexed in them are still flushed.'''
+    last = cls.index_bucket() - 2
+    if cursor is None:
+      first = last - config.COUNTER_INDEX_MAX_BUCKETS + 1
+    else:
+      first = cursor+1
+      if last - first + 1 > config.COUNTER_INDEX_MAX_BUCKETS:
+        logging.warning('%s index partitions since last flush' %(last-first+1))
+    return xrange(first,last+1)
+  
+  @classmethod
+  def _index_length_key(cls,index,bucket):
+    return '%s_index|%d|length' %(index,bucket)
   
   @classmethod
-  def set_cached_counter_keys(cls,arr):
-    memcache.set('counter_keys',arr)
+  def _index_slot_key(cls,index,bucket,slot):
+    return '%s_index|%d|%d' %(index,bucket,slot)
 
     
 class UserCounter(CounterBase):
@@ -178,6 +531,13 @@ class UserCounter(CounterBase):
 class StoreFrequencyBase(FrequencyBase):
   store = db.ReferenceProperty(Store)
   
+  @classmethod
+  def from_key_name(cls,key_name,**kwds):
+    entity = super(StoreFrequencyBase, cls).from_key_name(key_name,**kwds)
+    store_key_name = AmazonURLParser.root_url(key_name)
+    entity.store = db.Key.from_path('Store',store_key_name)
+    return entity
+  
   @classmethod
   def new(cls,*args,**kwds):
     entity = super(StoreFrequencyBase, cls).new(*args,**kwds)
@@ -188,6 +548,8 @@ class StoreFrequencyBase(FrequencyBase):
 class ProductCounter(CounterBase,StoreFrequencyBase):
   '''Counter class that holds the number of mentions for a product, daily,weekly, monthly and yearly'''
   _MIN_COUNT_FOR_DB_WRITE = config.PRODUCT_COUNTER_MIN_COUNT
+  _SHARDS = config.PRODUCT_COUNTER_SHARDS
+  _rollup_frequencies = [WEEKLY,MONTHLY]
       
 class ProductRenderer(StoreFrequencyBase):
   '''Data model for holding product information
@@ -197,6 +559,8 @@ class ProductRenderer(StoreFrequencyBase):
   Do not do any logic operations using this class
   This is used for creating views only
   '''
+  _negative_ttl = config.RENDERER_NEGATIVE_TTL
+  
   @classmethod
   def build(cls,product_key_name,frequency, date,*args,**kwds):
     frequency_set = [DAILY,MONTHLY,WEEKLY]
@@ -251,27 +615,171 @@ class ProductRenderer(StoreFrequencyBase):
   #ProductCounter
   count = db.IntegerProperty(default = 0)
    
-class Banlist(pdb.Model):
-  _key_name = 'banlist'
-  products = db.StringListProperty(indexed=False)
-  users = db.StringListProperty(indexed=False)
-
+class BanlistShard(pdb.Model):
+  '''Part of a ban list, key_name = <list name>|<shard number>'''
+  items = db.StringListProperty(indexed=False)
+  
+class Banlist(object):
+  '''Banned product urls and user ids
+  
+  Each list is stored in config.BANLIST_SHARDS BanlistShard entities,
+  ids are assigned to shards by hash so adding ids rewrites only
+  the shards they belong to.
+  
+  Instances keep lists as frozensets in local cache along with the list
+  version, which is incremented in memcache for every change. Lists are
+  reloaded from datastore only when the version in memcache differs,
+  version is checked at most every config.BANLIST_VERSION_CHECK seconds.
+  
+  Lists are published as Bloom filters for the bucket client, 
+  see filter_bytes.
+  '''
+  PRODUCTS = 'products'
+  USERS = 'users'
+  _list_models = {PRODUCTS:'Product',USERS:'TwitterUser'}
+  _local_prefix = 'banlist|'
+  _version_prefix = 'banlist_version|'
+  _filter_prefix = 'banlist_filter|'
+  
+  @classmethod
+  def products(cls):
+    return cls.members(cls.PRODUCTS)
+  
+  @classmethod
+  def users(cls):
+    return cls.members(cls.USERS)
+  
+  @classmethod
+  def add_products(cls,key_names):
+    cls.add(cls.PRODUCTS,key_names)
+    
+  @classmethod
+  def add_users(cls,key_names):
+    cls.add(cls.USERS,key_names)
+  
+  @classmethod
+  def members(cls,name):
+    '''Returns frozenset of ids in list'''
+    return cls._versioned_members(name)[1]
+  
+  @classmethod
+  def version(cls,name):
+    '''Returns version of list returned by members'''
+    return cls._versioned_members(name)[0]
+  
+  @classmethod
+  def add(cls,name,key_names):
+    '''Adds ids to list, each changed shard is updated in a transaction'''
+    shard_items = {}
+    for key_name in key_names:
+      shard_items.setdefault(cls._shard_key_name(name,key_name),[]).append(key_name)
+    
+    changed = False
+    for shard_key_name,items in shard_items.iteritems():
+      changed = db.run_in_transaction(cls._add_to_shard,shard_key_name,items) or changed
+    if changed:
+      if memcache.incr(cls._version_prefix+name) is None:
+        cls._reset_version(name)
+      cachepy.delete(cls._local_prefix+name)
+  
+  @classmethod
+  def filter_bytes(cls,name):
+    '''Returns (version,serialized BloomFilter) of list'''
+    version,members = cls._versioned_members(name)
+    filter_key = '%s%s|%s' %(cls._filter_prefix,name,version)
+    data = memcache.get(filter_key)
+    if data is None:
+      data = BloomFilter.from_items(members,
+                                    config.BANLIST_FILTER_ERROR_RATE).to_bytes()
+      if not memcache.set(filter_key,data,time=86400):
+        logging.warning('Could not cache %s filter of %s bytes' %(name,len(data)))
+    return version,data
+  
+  @classmethod
+  def _versioned_members(cls,name):
+    local_key = cls._local_prefix+name
+    cached = cachepy.get(local_key)
+    if cached is not None:
+      version,members,checked = cached
+      if time.time() - checked < config.BANLIST_VERSION_CHECK:
+        return version,members
+      if cls._version(name) == version:
+        cachepy.set(local_key,(version,members,time.time()),None,
+                    cls._local_size(members))
+        return version,members
+    
+    version = cls._version(name)
+    members = cls._load(name)
+    cachepy.set(local_key,(version,members,time.time()),None,
+                cls._local_size(members))
+    return version,members
+  
   @classmethod
-  def retrieve(cls,**kwds):
-    entity = cls.get_by_key_name(cls._key_name,**kwds)
-    if entity:
-      return entity
-    
-    if kwds.get('_storage'):
-      if DATASTORE in kwds.get('_storage'):
-        #This should only run once
-        products = db.Query(Product, keys_only=True).order("-add_date").fetch(1000)
-        users = db.Query(TwitterUser, keys_only=True).order("-add_date").fetch(1000)
-        products = [key.name() for key in products]
-        users = [key.name() for key in users]
-        entity = cls(key_name=cls._key_name,products = products,users = users)
-        entity.put()
-        return entity
+  def _add_to_shard(cls,shard_key_name,items):
+    shard = db.get(db.Key.from_path(BanlistShard.kind(),shard_key_name))
+    if shard is None:
+      shard = BanlistShard(key_name=shard_key_name)
+    existing = set(shard.items)
+    new_items = [item for item in items if item not in existing]
+    if not len(new_items):
+      return False
+    shard.items.extend(new_items)
+    db.put(shard)
+    return True
+  
+  @classmethod
+  def _load(cls,name):
+    shards = db.get([db.Key.from_path(BanlistShard.kind(),cls._shard_name(name,i)) 
+                     for i in range(config.BANLIST_SHARDS)])
+    members = set()
+    found = False
+    for shard in shards:
+      if shard is not None:
+        found = True
+        members.update(shard.items)
+    if not found:
+      #This should only run once
+      members = cls._bootstrap(name)
+    return frozenset(members)
+  
+  @classmethod
+  def _bootstrap(cls,name):
+    '''Builds an empty list from banned entities'''
+    model = db.class_for_kind(cls._list_models[name])
+    keys = db.Query(model,keys_only=True).order("-add_date")\
+           .fetch(config.BANLIST_BOOTSTRAP_LIMIT)
+    key_names = [key.name() for key in keys]
+    cls.add(name,key_names)
+    return key_names
+  
+  @classmethod
+  def _version(cls,name):
+    version = memcache.get(cls._version_prefix+name)
+    if version is None:
+      version = cls._reset_version(name)
+    return version
+  
+  @classmethod
+  def _reset_version(cls,name):
+    '''Version was evicted, a new one makes every instance reload once'''
+    version = int(time.time()*1000)
+    if not memcache.add(cls._version_prefix+name,version):
+      version = memcache.get(cls._version_prefix+name)
+    return version
+  
+  @classmethod
+  def _shard_key_name(cls,name,key_name):
+    if isinstance(key_name,unicode):
+      key_name = key_name.encode('utf-8')
+    return cls._shard_name(name,zlib.crc32(key_name) % config.BANLIST_SHARDS)
+  
+  @classmethod
+  def _shard_name(cls,name,shard):
+    return '%s|%d' %(name,shard)
+  
+  @classmethod
+  def _local_size(cls,members):
+    return 64*len(members)+1024
     
 class Product(pdb.Model):
   add_date = db.DateProperty(auto_now_add = True)
@@ -283,11 +791,64 @@ class Url(pdb.Model):
   '''This model is used for storing shortened - final url tuples
   If final url is a valid Amazon Product page then the url is set as valid
   key_name = short_url
+  
+  Urls are cached in config.URL_CACHE_STORAGE layers, product urls
+  are kept longer and are the only ones written to datastore.
+  Failed resolutions expire quickly so they are fetched again.
   '''
   final_url = db.LinkProperty(indexed=False)
   user_id = db.StringProperty(indexed = False) #Used for creating counter payloads in bucket worker
   is_valid = db.BooleanProperty(default = False) #Has a final url that has been fetched successfully
   is_product = db.BooleanProperty(default = False) #Final url points to a valid Amazon Product page
+  
+  _negative_ttl = config.URL_NEGATIVE_TTL
+  _stats_prefix = 'url_cache|'
+  
+  @classmethod
+  def get_resolved_async(cls,short_urls):
+    '''Returns a future of short url - Url dictionary, 
+    None for urls that were not resolved before'''
+    return cls.get_by_key_name_async(short_urls,
+                                     _storage = config.URL_CACHE_STORAGE,
+                                     _memcache_expiration = config.URL_PRODUCT_EXPIRATION,
+                                     _result_type = NAME_DICT)
+  
+  @classmethod
+  def save_resolved(cls,urls):
+    '''Caches resolved urls with a lifetime depending on result'''
+    cache_storage = [storage for storage in config.URL_CACHE_STORAGE 
+                     if storage != DATASTORE]
+    groups = {}
+    for url in urls:
+      if url.is_product:
+        group = (config.URL_PRODUCT_EXPIRATION,tuple(config.URL_CACHE_STORAGE))
+      elif url.final_url is not None:
+        group = (config.URL_EXPIRATION,tuple(cache_storage))
+      else:
+        group = (config.URL_FAILED_EXPIRATION,tuple(cache_storage))
+      groups.setdefault(group,[]).append(url)
+      
+    for (expiration,storage),group in groups.iteritems():
+      pdb.put(group,_storage = list(storage),
+              _local_expiration = min(expiration,LOCAL_EXPIRATION),
+              _memcache_expiration = expiration)
+  
+  @classmethod
+  def record_lookups(cls,hits,misses):
+    '''Counts cache lookups, hits are url fetches avoided'''
+    memcache.offset_multi({'hits':hits,'misses':misses},
+                          key_prefix = cls._stats_prefix,
+                          initial_value = 0)
+    
+  @classmethod
+  def lookup_stats(cls):
+    stats = memcache.get_multi(['hits','misses'],key_prefix = cls._stats_prefix)
+    hits = int(stats.get('hits',0))
+    misses = int(stats.get('misses',0))
+    stats = {'hits':hits,'misses':misses,'hit_rate':0.0}
+    if hits + misses:
+      stats['hit_rate'] = float(hits)/(hits+misses)
+    return stats
     
   @property
   def asin(self):
@@ -302,11 +863,13 @@ class Url(pdb.Model):
     return AmazonURLParser.root_url(self.final_url)
       
 class Payload(dict):
-  '''This class is serialized and passed along taskworkers as message body'''
+  '''This class is serialized and passed along taskworkers as message body
+  count is the number of mentions of url by the user'''
   
-  def __init__(self,url,user_id):
+  def __init__(self,url,user_id,count = 1):
     self['url'] = url
     self['user_id'] = user_id
+    self['count'] = count
           
   @property
   def url(self):
@@ -315,19 +878,22 @@ class Payload(dict):
   @property
   def user_id(self):
     return str(self['user_id'])
+  
+  @property
+  def count(self):
+    return self['count']
       
   @classmethod
   def serialize(cls,array):
-      return repr(array)
+    '''Returns a task parameter string, see payload_codec'''
+    return payload_codec.to_param(payload_codec.encode(array))
   
   @classmethod
   def deserialize(cls,string):
-    arr = eval(string)
-    result = []
-    for item in arr:
-        result.append(Payload(item['url'],
-                              item['user_id']))
-    return result
+    '''Returns an iterable that builds Payload objects lazily
+    
+    Raises payload_codec.PayloadCodecError for malformed strings'''
+    return payload_codec.decode(payload_codec.from_param(string),Payload)
   
 class Response(pdb.Model):
   content = db.TextProperty()
\ No newline at end of file
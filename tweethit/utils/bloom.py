@@ -0,0 +1,95 @@
+'''
+Bloom filter used for publishing ban lists to the bucket client.
+
+Serialized format:
+
+  magic 'BF' | version byte | 4 byte bit count | 1 byte hash count | bits
+
+Bit positions of an item are derived from the md5 digest of its utf-8
+bytes with double hashing, so filters built on the server can be checked
+and extended by the client.
+
+This module has no App Engine dependencies so the bucket client can use it.
+'''
+import array
+import math
+import struct
+
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import new as md5
+
+MAGIC = 'BF'
+VERSION = 1
+_HEADER = '>2sBIB'
+MIN_BITS = 1024
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+class BloomFilter(object):
+
+  def __init__(self,bit_count,hash_count,bits = None):
+    self.bit_count = bit_count
+    self.hash_count = hash_count
+    if bits is None:
+      bits = array.array('B',[0])*((bit_count+7)//8)
+    self.bits = bits
+
+  @classmethod
+  def for_capacity(cls,capacity,error_rate = 0.01):
+    '''Filter sized for capacity items with given false positive rate'''
+    capacity = max(capacity,1)
+    bit_count = int(math.ceil(-capacity*math.log(error_rate)/(math.log(2)**2)))
+    hash_count = max(1,int(round(float(bit_count)/capacity*math.log(2))))
+    bit_count = max(bit_count,MIN_BITS) #Double hashing repeats positions in tiny filters
+    return cls(bit_count,hash_count)
+
+  @classmethod
+  def from_items(cls,items,error_rate = 0.01):
+    items = list(items)
+    result = cls.for_capacity(len(items),error_rate)
+    for item in items:
+      result.add(item)
+    return result
+
+  def add(self,item):
+    bits = self.bits
+    for position in self._positions(item):
+      bits[position >> 3] |= 1 << (position & 7)
+
+  def __contains__(self,item):
+    bits = self.bits
+    for position in self._positions(item):
+      if not bits[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+
+  def _positions(self,item):
+    if isinstance(item,unicode):
+      item = item.encode('utf-8')
+    else:
+      item = str(item)
+    first,second = struct.unpack('>QQ',md5(item).digest())
+    second |= 1
+    bit_count = self.bit_count
+    return [(first + i*second) % bit_count for i in xrange(self.hash_count)]
+
+  def to_bytes(self):
+    return struct.pack(_HEADER,MAGIC,VERSION,self.bit_count,
+                       self.hash_count) + self.bits.tostring()
+
+  @classmethod
+  def from_bytes(cls,data):
+    if len(data) < _HEADER_SIZE:
+      raise BloomFilterError('Filter truncated')
+    magic,version,bit_count,hash_count = struct.unpack(_HEADER,data[:_HEADER_SIZE])
+    if magic != MAGIC or version != VERSION:
+      raise BloomFilterError('Unknown filter format')
+    bits = array.array('B')
+    bits.fromstring(data[_HEADER_SIZE:])
+    if len(bits) != (bit_count+7)//8:
+      raise BloomFilterError('Filter truncated')
+    return cls(bit_count,hash_count,bits)
+
+class BloomFilterError(Exception):
+  pass
@@ -0,0 +1,218 @@
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+from PerformanceEngine import time_util,PUT_RETRY
+from tweethit.model import CounterBase,OperationFlags,COUNTER_INDEX,\
+ProductCounter,UserCounter,Payload
+from tweethit.utils.payload_codec import PayloadCodecError
+from tweethit.utils.task_util import counter_pull_queue
+from config import COUNTER_FLUSH_BATCH_SIZE,COUNTER_FLUSH_TIME_BUDGET,\
+COUNTER_LEASE_BATCH_SIZE,COUNTER_LEASE_SECONDS,COUNTER_CONSUME_TIME_BUDGET,\
+COUNTER_APPLIED_EXPIRATION,COUNTER_INDEX_BUCKET_SECONDS
+
+import bisect
+import time
+import logging
+
+#Seconds until the current index partition is closed,
+#see CounterBase.closed_index_buckets
+INDEX_CLOSE_SECONDS = 2*COUNTER_INDEX_BUCKET_SECONDS + 5
+
+def add_mention_deltas(payloads,root_deltas):
+  '''Adds payload mentions to (counter class,key root) - delta dictionary'''
+  for payload in payloads:
+    key = (ProductCounter,payload.url)
+    root_deltas[key] = root_deltas.get(key,0) + payload.count
+    key = (UserCounter,payload.user_id)
+    root_deltas[key] = root_deltas.get(key,0) + payload.count
+  return root_deltas
+
+class CounterConsumer(object):
+  '''Increments counters for payloads in counter pull queue
+  
+  Tasks are leased in batches, mentions of a whole batch are aggregated
+  and counters are incremented once per counter class before tasks 
+  are deleted. After each class is incremented, the tasks remember it 
+  in memcache, so if the consumer dies in between, tasks leased again 
+  only count mentions of the remaining classes.
+  '''
+  _applied_prefix = 'counter_applied|'
+  
+  def __init__(self,queue = None,
+               batch_size = COUNTER_LEASE_BATCH_SIZE,
+               lease_seconds = COUNTER_LEASE_SECONDS,
+               time_budget = COUNTER_CONSUME_TIME_BUDGET):
+    self.queue = queue or counter_pull_queue
+    self.batch_size = batch_size
+    self.lease_seconds = lease_seconds
+    self.start_time = time.time()
+    self.deadline = self.start_time + time_budget
+    self.tasks_consumed = 0
+    self.mentions = 0
+    
+  def run(self):
+    '''Returns True if the queue was drained'''
+    try:
+      while time.time() < self.deadline:
+        tasks = self.queue.lease_tasks(self.lease_seconds,self.batch_size)
+        if not len(tasks):
+          return True
+        self.consume(tasks)
+        if len(tasks) < self.batch_size:
+          return True
+      return False
+    finally:
+      self.log_throughput()
+      
+  def consume(self,tasks):
+    applied = memcache.get_multi([task.name for task in tasks],
+                                 key_prefix=self._applied_prefix)
+    class_deltas = {} #counter class => root deltas
+    class_tasks = {} #counter class => names of tasks to mark applied
+    for task in tasks:
+      try:
+        payloads = list(Payload.deserialize(task.payload))
+      except PayloadCodecError, e:
+        logging.error('Dropping malformed counter payload: %s' %e)
+        continue
+      done = applied.get(task.name,[])
+      for key,delta in add_mention_deltas(payloads,{}).iteritems():
+        klass = key[0]
+        if klass.kind() in done:
+          continue
+        root_deltas = class_deltas.setdefault(klass,{})
+        root_deltas[key] = root_deltas.get(key,0) + delta
+        class_tasks.setdefault(klass,set()).add(task.name)
+      for payload in payloads:
+        self.mentions += payload.count
+    
+    today = time_util.today()
+    for klass,root_deltas in class_deltas.iteritems():
+      CounterBase.increment_roots(root_deltas,today)
+      marks = {}
+      for name in class_tasks[klass]:
+        done = applied.setdefault(name,[])
+        done.append(klass.kind())
+        marks[name] = done
+      memcache.set_multi(marks,key_prefix=self._applied_prefix,
+                         time=COUNTER_APPLIED_EXPIRATION)
+    self.queue.delete_tasks(tasks)
+    self.tasks_consumed += len(tasks)
+    
+  def log_throughput(self):
+    elapsed = max(time.time() - self.start_time,0.001)
+    logging.info('Counter consume: %s tasks, %s mentions in %.2fs (%.1f mentions/s)' 
+                 %(self.tasks_consumed,self.mentions,elapsed,self.mentions/elapsed))
+
+class CounterFlusher(object):
+  '''Writes counters listed in closed counter index partitions to datastore
+  
+  Counters are read and written in batches, datastore put of a batch 
+  runs while the next one is being read. When time budget is used up, 
+  the last written counter id is saved in OperationFlags and run returns 
+  False so the caller can continue in a new task. Counters are written 
+  in sorted order and the next run starts after the saved id, so 
+  counters evicted from or added to the partition meanwhile don't 
+  shift its position.
+  
+  Writing a counter twice is harmless as entities hold the totals,
+  so a run that dies before saving its position is simply repeated.
+  
+  index selects the dirty counter index to drain, daily counters 
+  (COUNTER_INDEX) or counters derived from them (ROLLUP_INDEX).
+  Each index keeps its own position in OperationFlags.
+  '''
+  def __init__(self,index = COUNTER_INDEX,
+               batch_size = COUNTER_FLUSH_BATCH_SIZE,
+               time_budget = COUNTER_FLUSH_TIME_BUDGET):
+    self.index = index
+    self._lock_key = '%s_flush_lock' %index
+    self._cursor_attr = '%s_index_cursor' %index
+    self._last_key_attr = '%s_flush_last_key' %index
+    self.batch_size = batch_size
+    self.start_time = time.time()
+    self.deadline = self.start_time + time_budget
+    self.keys_read = 0
+    self.keys_written = 0
+    self.bytes_written = 0
+    self.locked = False #Another flush of the index was running
+    
+  def run(self):
+    '''Returns True if all closed partitions were drained 
+    or another flush of the index is running'''
+    if not memcache.add(self._lock_key,1,time=COUNTER_FLUSH_TIME_BUDGET*3):
+      logging.info('%s flush already running' %self.index)
+      self.locked = True
+      return True
+    try:
+      return self._drain(OperationFlags.retrieve())
+    finally:
+      memcache.delete(self._lock_key)
+      self.log_throughput()
+  
+  def _drain(self,flags):
+    cursor = getattr(flags,self._cursor_attr)
+    moved = False #Cursor passed empty partitions, flags not saved yet
+    for bucket in CounterBase.closed_index_buckets(cursor):
+      counter_ids = sorted(CounterBase.get_cached_counter_keys(bucket,self.index))
+      if not len(counter_ids):
+        #Most partitions after a gap are empty, flags are saved once for them
+        CounterBase.clear_cached_counter_keys(bucket,self.index)
+        setattr(flags,self._cursor_attr,bucket)
+        setattr(flags,self._last_key_attr,None)
+        moved = True
+        if time.time() > self.deadline:
+          flags.save()
+          return False
+        continue
+      last_key = getattr(flags,self._last_key_attr)
+      if last_key is None:
+        offset = 0
+      else:
+        offset = bisect.bisect_right(counter_ids,last_key)
+      pending = None
+      
+      while offset < len(counter_ids):
+        if time.time() > self.deadline:
+          if pending is not None:
+            pending.get_result()
+          if offset:
+            setattr(flags,self._last_key_attr,counter_ids[offset-1])
+          if offset or moved:
+            flags.save()
+          logging.info('%s flush stopped at bucket %s after %s' 
+                       %(self.index,bucket,getattr(flags,self._last_key_attr)))
+          return False
+        
+        batch = counter_ids[offset:offset+self.batch_size]
+        rpc = self._put_async(CounterBase.build_flush_entities(batch))
+        self.keys_read += len(batch)
+        if pending is not None:
+          pending.get_result()
+        pending = rpc
+        offset += len(batch)
+      
+      if pending is not None:
+        pending.get_result()
+      CounterBase.clear_cached_counter_keys(bucket,self.index)
+      setattr(flags,self._cursor_attr,bucket)
+      setattr(flags,self._last_key_attr,None)
+      flags.save()
+      moved = False
+    if moved:
+      flags.save()
+    return True
+  
+  def _put_async(self,entities):
+    if not len(entities):
+      return None
+    self.keys_written += len(entities)
+    for entity in entities:
+      self.bytes_written += db.model_to_protobuf(entity).ByteSize()
+    return PUT_RETRY.run_async(db.put_async,entities)
+  
+  def log_throughput(self):
+    elapsed = max(time.time() - self.start_time,0.001)
+    logging.info(self.index+' flush: %s keys read, %s written, %s bytes in %.2fs (%.1f keys/s)' 
+                 %(self.keys_read,self.keys_written,self.bytes_written,
+                   elapsed,self.keys_read/elapsed))
@@ -10,24 +10,56 @@ def date_to_str_tuple(date):
   year,month,day = str(date).split('-')
   return year,month,day
    
+def _store_domain(root):
+  '''http://www.amazon.com => amazon.com'''
+  host = root.split('://',1)[1]
+  if host.startswith('www.'):
+    host = host[4:]
+  return host
+
 class UrlParser(object):
+  '''Urls are matched to stores by host.
+  
+  STORES lists (locale,root) of each store. Hosts of a root without www. 
+  and all their subdomains (www., m., smile.) belong to its store, 
+  over http or https. SHORT_HOSTS maps short link hosts to a locale.
+  '''
+  STORES = []
+  SHORT_HOSTS = {}
+  LOCALE_ROOTS = {}
+  STORE_DOMAINS = {} #domain => locale
   
-  ROOT_URL_SET = []
+  _host_pattern = re.compile('https?://(?:[^/?#@]*@)?([^/?#:]*)',re.IGNORECASE)
   
   @classmethod
   def is_valid(cls,url):
-    for item in cls.ROOT_URL_SET:
-      if url.find(item,0,30):
-        return True
-    return False
+    match = cls._host_pattern.match(url)
+    return match is not None and \
+           cls.host_locale(match.group(1).lower()) is not None
+  
+  @classmethod
+  def host_locale(cls,host):
+    '''Returns locale of lower case host, None if it is not a store host'''
+    if host in cls.SHORT_HOSTS:
+      return cls.SHORT_HOSTS[host]
+    domains = cls.STORE_DOMAINS
+    dot = -1
+    while True:
+      locale = domains.get(host[dot+1:])
+      if locale is not None:
+        return locale
+      dot = host.find('.',dot+1)
+      if dot == -1:
+        return None
     
   @classmethod
   def root_url(cls,url):
-    if cls.is_valid(url):
-      end_slash_index = url.find('/',7)
-      if end_slash_index > 0:
-        url = url[:end_slash_index]
-      return url
+    '''Returns root of the store of url'''
+    match = cls._host_pattern.match(url)
+    if match is not None:
+      locale = cls.host_locale(match.group(1).lower())
+      if locale is not None:
+        return cls.LOCALE_ROOTS[locale]
     raise ParserException(ParserException.NO_PARSER_IMPLEMENTED+' :'+url)
    
   @classmethod
@@ -38,6 +70,17 @@ class UrlParser(object):
     else:
       return url
     
+class AmazonURL(object):
+  '''Parts of an Amazon url, asin and product_url are None 
+  for urls without a product'''
+  __slots__ = ('root','locale','asin','product_url')
+  
+  def __init__(self,root,locale,asin,product_url):
+    self.root = root
+    self.locale = locale
+    self.asin = asin
+    self.product_url = product_url
+
 class AmazonURLParser(UrlParser):
   US_ROOT = 'http://www.amazon.com'
   UK_ROOT = 'http://www.amazon.co.uk'
@@ -49,76 +92,94 @@ class AmazonURLParser(UrlParser):
   FR_ROOT = 'http://www.amazon.fr'
   
   DEFAULT_PREFIX = '/o/ASIN/' #used for constructing urls
-  ROOT_URL_SET = [US_ROOT,UK_ROOT,CA_ROOT,FR_ROOT,DE_ROOT,JP_ROOT]
-  KEY_PREFIX_SET = ['/dp/','/gp/product/','/o/ASIN/','/exec/obidos/ASIN/']
+  STORES = [('us',US_ROOT),('uk',UK_ROOT),('ca',CA_ROOT),
+            ('fr',FR_ROOT),('de',DE_ROOT),('jp',JP_ROOT)]
+  SHORT_HOSTS = {'amzn.com':'us'} #amzn.com/<asin>
+  ROOT_URL_SET = [root for locale,root in STORES]
+  LOCALE_ROOTS = dict(STORES)
+  STORE_DOMAINS = dict([(_store_domain(root),locale) for locale,root in STORES])
+  KEY_PREFIX_SET = ['/dp/','/gp/product/','/o/ASIN/','/exec/obidos/ASIN/',
+                    '/gp/aw/d/'] #Last one is used by mobile pages
+  
+  MEMO_SIZE = 5000 #Parsed urls kept, memo is cleared when full
+  _memo = {}
+  
+  '''We expect an ideal url in the form 
+  www.amazon.com/<key_prefix>/<asin>/
+  
+  But sometimes % is used instead of /, or the asin is preceded by
+  other parts as in amazon.com/dp/system-requirements/B0348023/...
+  So parts not looking like an asin are skipped and the asin ends
+  at the first / or %. The first key prefix followed by an asin wins.
+  '''
+  _asin_pattern = re.compile('(?:%s)(?:(?:[^A-Z0-9/][^/]*)?/)*([A-Z0-9][^/%%]*)' 
+                             %'|'.join([re.escape(prefix) for prefix in KEY_PREFIX_SET]))
+  _short_asin_pattern = re.compile('/([A-Z0-9]{10})(?:/|$)')
+  
+  @classmethod
+  def parse(cls,url):
+    '''Returns AmazonURL of url, raises ParserException for invalid urls'''
+    try:
+      return cls._memo[url]
+    except KeyError:
+      pass
+    
+    match = cls._host_pattern.match(url)
+    if match is None:
+      raise ParserException(ParserException.NO_PARSER_IMPLEMENTED+' :'+url)
+    host = match.group(1).lower()
+    locale = cls.host_locale(host)
+    if locale is None:
+      raise ParserException(ParserException.NO_PARSER_IMPLEMENTED+' :'+url)
+    
+    root = cls.LOCALE_ROOTS[locale]
+    asin = cls._find_asin(url[match.end():],host in cls.SHORT_HOSTS)
+    if asin is None:
+      product_url = None
+    else:
+      product_url = root + cls.DEFAULT_PREFIX + asin
+    result = AmazonURL(root,locale,asin,product_url)
+    
+    if len(cls._memo) >= cls.MEMO_SIZE:
+      cls._memo.clear()
+    cls._memo[url] = result
+    return result
+  
+  @classmethod
+  def root_url(cls,url):
+    return cls.parse(url).root
   
   @classmethod
   def product_url(cls,url):
-    return cls.root_url(url) + cls.DEFAULT_PREFIX + cls.extract_asin(url)
+    result = cls.parse(url)
+    if result.asin is None:
+      raise ParserException(url)
+    return result.product_url
 
   @classmethod
   def get_locale(cls,url):
-    root_url = cls.root_url(url)
-    if root_url == cls.US_ROOT:
-      return 'us'
-    elif root_url == cls.UK_ROOT:
-      return 'uk'
-    elif root_url == cls.CA_ROOT:
-      return 'ca'
-    elif root_url == cls.DE_ROOT:
-      return 'de'
-    elif root_url == cls.FR_ROOT:
-      return 'fr'
-    elif root_url == cls.JP_ROOT:
-      return 'jp'
-    else:
-      return None
+    return cls.parse(url).locale
             
   @classmethod
-  def extract_asin(cls,url):  
-    url = cls._remove_params(url)
-    for prefix in cls.KEY_PREFIX_SET:
-      prefix_index = url.find(prefix)
-      if  prefix_index != -1:
-        key_start_index = prefix_index + len(prefix)
-      
-        '''We expect an ideal url in the form 
-        www.amazon.com/<key_prefix/<asin>/
-        
-        But sometimes % is used instead of /
-        So we must check for that first
-        www.amazon.com/<key_prefix>/<asin>%..
-        '''
-        percent_index = url.find('%',key_start_index)
-        key_end_index = url.find('/',key_start_index)
-        
-        if key_end_index == -1:
-            if percent_index == -1: #no more chars after the key
-                key_end_index = len(url)
-            else: #Trailing % in url
-                key_end_index = percent_index
-                
-        result = url[key_start_index:key_end_index]
-        '''Sometimes URL is in the form 
-        amazon.com/dp/system-requirements/B0348023/...      
-        So we check the next part if current one
-        does not look like a valid ASIN
-        '''
-        while True:
-          if re.match('([A-Z0-9])',result) is None:
-            if key_end_index == -1:
-              result = ''
-              break
-            key_start_index = key_end_index+1
-            key_end_index = url.find('/',key_end_index+1)
-            result = url[key_start_index:key_end_index]
-          else:
-            break
-          
-        if len(result):
-          return result
-    
-    raise ParserException(url) #No matching key prefixes found    
+  def extract_asin(cls,url):
+    result = cls.parse(url)
+    if result.asin is None:
+      raise ParserException(url) #No matching key prefixes found
+    return result.asin
+  
+  @classmethod
+  def _find_asin(cls,path,short_link = False):
+    path = cls._remove_params(path)
+    fragment_index = path.find('#')
+    if fragment_index != -1:
+      path = path[:fragment_index]
+    if short_link:
+      match = cls._short_asin_pattern.match(path)
+    else:
+      match = cls._asin_pattern.search(path)
+    if match is None:
+      return None
+    return match.group(1)
        
 class ParserException(Exception):
 
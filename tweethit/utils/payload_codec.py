@@ -0,0 +1,188 @@
+'''
+Wire format of url mention batches passed from bucket client to
+BucketHandler and between taskworkers.
+
+Items are dict like objects with 'url', 'user_id' and optional 'count' keys 
+(Payload, SimpleUrl). Every distinct url and user id is written once in a table,
+mentions of a url by the same user are aggregated into a single item:
+
+  magic 'TP' | version byte
+  varint user count | user ids
+  varint url count  | urls
+  varint item count | (varint url index, varint user index, varint count) per item
+
+Version 1 items have no count, each one is a single mention.
+
+Strings are written as varint length followed by utf-8 bytes.
+Binary data is base64 encoded with to_param before being used as
+a request or task parameter.
+
+This module has no App Engine dependencies so the bucket client can use it.
+'''
+import base64
+
+MAGIC = 'TP'
+VERSION = 2
+VERSIONS = (1,2) #Versions that can be decoded
+
+def encode(items):
+  '''Encodes an iterable of dicts with 'url', 'user_id' and optional 'count' keys'''
+  return _encode_tuples([(item['url'],item['user_id'],item.get('count',1)) 
+                         for item in items])
+
+def merge(datas):
+  '''Encodes items of several encoded strings as one'''
+  tuples = []
+  for data in datas:
+    tuples.extend(PayloadReader(data))
+  return _encode_tuples(tuples)
+
+def _encode_tuples(url_user_counts):
+  users = {}
+  urls = {}
+  counts = {} #(url index,user index) => count
+  pairs = []
+  for url,user_id,count in url_user_counts:
+    url = _to_unicode(url)
+    user_id = _to_unicode(user_id)
+    try:
+      url_index = urls[url]
+    except KeyError:
+      url_index = urls[url] = len(urls)
+    try:
+      user_index = users[user_id]
+    except KeyError:
+      user_index = users[user_id] = len(users)
+    pair = (url_index,user_index)
+    if pair in counts:
+      counts[pair] += count
+    else:
+      counts[pair] = count
+      pairs.append(pair)
+
+  out = [MAGIC,chr(VERSION)]
+  for table in (users,urls):
+    _write_varint(out,len(table))
+    for value in _ordered(table):
+      value = value.encode('utf-8')
+      _write_varint(out,len(value))
+      out.append(value)
+
+  _write_varint(out,len(pairs))
+  for pair in pairs:
+    _write_varint(out,pair[0])
+    _write_varint(out,pair[1])
+    _write_varint(out,counts[pair])
+  return ''.join(out)
+
+def decode(data,factory = None):
+  '''Returns a PayloadReader, see PayloadReader for factory'''
+  return PayloadReader(data,factory)
+
+def to_param(data):
+  return base64.urlsafe_b64encode(data)
+
+def from_param(param):
+  try:
+    return base64.urlsafe_b64decode(str(param))
+  except (TypeError,UnicodeEncodeError):
+    raise PayloadCodecError('Payload parameter is not base64 encoded')
+
+class PayloadReader(object):
+  '''Lazily decodes items of encoded data
+
+  Tables are read on creation, items are built while iterating
+  so the reader can be iterated more than once.
+  Each item is created with factory(url,user_id,count),
+  (url,user_id,count) tuples are yielded if factory is None.
+  '''
+  def __init__(self,data,factory = None):
+    if not isinstance(data,str) or not data.startswith(MAGIC):
+      raise PayloadCodecError('Unknown payload format')
+    if len(data) <= len(MAGIC) or ord(data[len(MAGIC)]) not in VERSIONS:
+      raise PayloadCodecError('Unsupported payload version')
+
+    self.version = ord(data[len(MAGIC)])
+    self.factory = factory
+    self._data = data
+    pos = len(MAGIC)+1
+    self.users,pos = _read_table(data,pos)
+    self.urls,pos = _read_table(data,pos)
+    self.length,self._items_pos = _read_varint(data,pos)
+
+  def __len__(self):
+    return self.length
+
+  def __iter__(self):
+    data = self._data
+    pos = self._items_pos
+    urls = self.urls
+    users = self.users
+    factory = self.factory
+    has_counts = self.version > 1
+    count = 1
+    for i in xrange(self.length):
+      url_index,pos = _read_varint(data,pos)
+      user_index,pos = _read_varint(data,pos)
+      if has_counts:
+        count,pos = _read_varint(data,pos)
+      try:
+        url = urls[url_index]
+        user_id = users[user_index]
+      except IndexError:
+        raise PayloadCodecError('Payload item %d refers to missing table entry' %i)
+      if factory is None:
+        yield (url,user_id,count)
+      else:
+        yield factory(url,user_id,count)
+
+def _read_table(data,pos):
+  result = []
+  count,pos = _read_varint(data,pos)
+  for i in xrange(count):
+    length,pos = _read_varint(data,pos)
+    end = pos+length
+    if end > len(data):
+      raise PayloadCodecError('Payload truncated')
+    try:
+      result.append(data[pos:end].decode('utf-8'))
+    except UnicodeDecodeError:
+      raise PayloadCodecError('Payload string is not utf-8')
+    pos = end
+  return result,pos
+
+def _read_varint(data,pos):
+  result = 0
+  shift = 0
+  while True:
+    try:
+      byte = ord(data[pos])
+    except IndexError:
+      raise PayloadCodecError('Payload truncated')
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result,pos
+    shift += 7
+
+def _write_varint(out,value):
+  while value > 0x7f:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+
+def _ordered(table):
+  result = [None]*len(table)
+  for value,index in table.iteritems():
+    result[index] = value
+  return result
+
+def _to_unicode(value):
+  if isinstance(value,unicode):
+    return value
+  elif isinstance(value,str):
+    return value.decode('utf-8')
+  return unicode(value)
+
+class PayloadCodecError(Exception):
+  pass
@@ -4,8 +4,11 @@ from google.appengine.api import apiproxy_stub_map
 from google.appengine.api.urlfetch import DownloadError,InvalidURLError
 
 import amazonproduct
-import time
-from config import DEBUG_MODE
+import urlparse
+from config import DEBUG_MODE,URL_RESOLVER_CONCURRENCY,URL_RESOLVER_HOST_LIMIT,\
+URL_RESOLVER_MAX_REDIRECTS
+from PerformanceEngine.retry import RetryPolicy
+from tweethit.utils.parser_util import AmazonURLParser,ParserException
 
 
 from google.appengine.runtime import apiproxy_errors
@@ -18,51 +21,78 @@ if DEBUG_MODE:
     DEFAULT_THUMB_URL = "http://localhost:8000/images/default_thumb.gif"
 else:
     DEFAULT_THUMB_URL = "http://tweethitapp.appspot.com/images/default_thumb.gif"
+
+#Amazon API throttling, renderer info task is retried later if this runs out
+AMAZON_RETRY = RetryPolicy('amazon',
+                           retry_on = amazonproduct.TooManyRequests,
+                           max_attempts = 4,
+                           initial_delay = 1.0,
+                           max_delay = 4.0,
+                           time_budget = 10)
  
 class AmazonProductFetcher(object):
   """
   Fetch product information using Amazon Product API
-  Save the results into a ProductDetail instance
-  2 Fetches are Made:
-  1- Product details = title, product_group
-  2- Image details = urls for small, medium, large images
+  Save the results into ProductRenderer instances
+  Products of a locale are fetched with a single ItemLookup for
+  up to 10 asins, combining response groups:
+  1- Small = title, product_group
+  2- Images = urls for small, medium, large images
   
   This service will be called by product renderer taskworker
   """
+  RESPONSE_GROUP = 'Small,Images'
+  
   @classmethod
   def get_product_details(cls,asin,product_renderer,locale = 'us'):
-    
-    logging.info('AmazonProductFetcher.get_product_details called, asin: %s, locale: %s' %(asin,locale))
+    return cls.get_products_details({asin:product_renderer},locale).get(asin)
+  
+  @classmethod
+  def get_products_details(cls,renderers,locale = 'us'):
+    '''renderers is an asin => ProductRenderer dictionary of at most 10, 
+    returns asin => renderer dictionary of products whose details were set,
+    empty if the lookup failed'''
+    asins = renderers.keys()
+    logging.info('AmazonProductFetcher.get_products_details called, asins: %s, locale: %s' %(asins,locale))
     api = API(AWS_KEY, SECRET_KEY, locale)
-    timeout_ms = 100
-    while True:
-      try:
-        product_node = api.item_lookup(id=asin)  #title,product group
-        image_node = api.item_lookup(id=asin, ResponseGroup='Images') #Images
-        break
-      except amazonproduct.TooManyRequests:
-        time.sleep(timeout_ms)
-        timeout_ms *= 2                            
-      except AWSError:
-        logging.error('Could not retrieve info for product %s' % asin)
-        return
-      except DownloadError,e:
-        logging.error('%s retrieving URLfor product: %s in RPC'   %(e,asin))
-        return #Early quit
+    try:
+      root_node = AMAZON_RETRY.run(api.item_lookup,id=','.join(asins),
+                                   ResponseGroup=cls.RESPONSE_GROUP)
+    except amazonproduct.TooManyRequests:
+      logging.error('Amazon API throttled requests for products %s' % asins)
+      return {}
+    except AWSError:
+      logging.error('Could not retrieve info for products %s' % asins)
+      return {}
+    except DownloadError,e:
+      logging.error('%s retrieving URL for products: %s in RPC'   %(e,asins))
+      return {} #Early quit
     
-    #Extract values from BeautifulSoup nodes
+    result = {}
+    for item_node in root_node.findAll('item'):
+      try:
+        asin = str(item_node.find('asin').string)
+      except AttributeError:
+        continue
+      renderer = renderers.get(asin)
+      if renderer is not None and cls._set_details(item_node,renderer):
+        result[asin] = renderer
+    return result
+  
+  @classmethod
+  def _set_details(cls,item_node,product_renderer):
+    '''Sets details from BeautifulSoup node of an item, False if title is missing'''
     try:
-      title = product_node.find('title').string.encode('utf-8')[:500] #StringProperty upper limit
+      title = item_node.find('title').string.encode('utf-8')[:500] #StringProperty upper limit
+      product_group = item_node.find('productgroup').string.encode('utf-8')
     except AttributeError,e: #This means invalid url parsing, no valid ASIN value
       logging.error('%s setting title in RPC'   %e)
-      return #Early quit
-        
-    product_group = product_node.find('productgroup').string.encode('utf-8')
+      return False
 
     try:
-      image_small =  str(image_node.find('smallimage').find('url').string)
-      image_medium=  str(image_node.find('mediumimage').find('url').string)
-      image_large=  str(image_node.find('largeimage').find('url').string)
+      image_small =  str(item_node.find('smallimage').find('url').string)
+      image_medium=  str(item_node.find('mediumimage').find('url').string)
+      image_large=  str(item_node.find('largeimage').find('url').string)
     except AttributeError:
       image_small =  DEFAULT_THUMB_URL
       image_medium=  None
@@ -73,34 +103,159 @@ class AmazonProductFetcher(object):
     product_renderer.image_small = image_small
     product_renderer.image_medium = image_medium
     product_renderer.image_large = image_large
-    
-    return product_renderer    
+    return True
   
 class UrlFetcher(object):
   
   @classmethod
   def fetch_urls(cls,url_list):
-    rpcs = []
-    for url in url_list:
-      rpc = urlfetch.create_rpc(deadline=5.0)
-      urlfetch.make_fetch_call(rpc, url,method = urlfetch.HEAD)
-      rpcs.append(rpc)
-      
+    chains = UrlResolver().resolve_chains(url_list)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     result = {}
-    while len(rpcs) > 0:
-      rpc = apiproxy_stub_map.UserRPC.wait_any(rpcs)
-      rpcs.remove(rpc)
-      request_url = rpc.request.url()
+    for url,(final_url,chain) in chains.iteritems():
+      result[url] = final_url
+      if debug:
+        logging.debug('Redirect chain of %s: %s' %(url,' -> '.join(chain)))
+    logging.info('Returning results: %s' %result)
+    return result
+  
+class _Resolution(object):
+  '''Redirect chain of a url being resolved'''
+  def __init__(self,url):
+    self.start_url = url
+    self.url = url
+    self.hops = 0
+    self.chain = [url]
+  
+class UrlResolver(object):
+  '''Resolves urls by following their redirects with HEAD requests
+  
+  At most max_concurrent requests are in flight and at most host_limit 
+  of them go to the same host. A url reached by several redirect chains 
+  is requested once per resolve call. Redirects are followed one hop at a time.
+  
+  With early_exit, each url and redirect target is checked with 
+  AmazonURLParser and a chain stops at the first product url without 
+  requesting it, tracking redirects after it are skipped. Otherwise chains are 
+  followed to the final url like urlfetch does.
+  '''
+  REDIRECT_CODES = (301,302,303,307,308)
+  
+  def __init__(self,max_concurrent = URL_RESOLVER_CONCURRENCY,
+               host_limit = URL_RESOLVER_HOST_LIMIT,
+               max_redirects = URL_RESOLVER_MAX_REDIRECTS,
+               deadline = 5.0,
+               early_exit = True):
+    self.max_concurrent = max_concurrent
+    self.early_exit = early_exit
+    self.host_limit = host_limit
+    self.max_redirects = max_redirects
+    self.deadline = deadline
+    
+  def resolve(self,urls):
+    '''Returns url - final url dictionary, 
+    final url is None if it couldn't be resolved'''
+    return dict([(url,final_url) for url,(final_url,chain) 
+                 in self.resolve_chains(urls).iteritems()])
+    
+  def resolve_chains(self,urls):
+    '''Returns url - (final url,list of urls visited) dictionary'''
+    self._result = {}
+    self._rpcs = {} #rpc => requested url
+    self._waiting = {} #requested url => resolutions waiting for its response
+    self._responses = {} #requested url => result of _next_url
+    self._host_counts = {}
+    pending = []
+    for url in set(urls):
+      resolution = _Resolution(url)
+      if self._is_final(url): #Direct product links aren't requested
+        self._finish(resolution,url)
+      else:
+        pending.append(resolution)
+    
+    while len(pending) or len(self._rpcs):
+      pending = self._start(pending)
+      if not len(self._rpcs):
+        continue
+      rpc = apiproxy_stub_map.UserRPC.wait_any(self._rpcs.keys())
+      url = self._rpcs.pop(rpc)
+      self._host_counts[_host(url)] -= 1
+      next_url = self._responses[url] = self._next_url(rpc,url)
+      
+      for resolution in self._waiting.pop(url):
+        self._advance(resolution,url,next_url,pending)
+    return self._result
+  
+  def _advance(self,resolution,url,next_url,pending):
+    if next_url is None:
+      self._finish(resolution,url)
+    elif next_url is False:
+      self._finish(resolution,None)
+    else:
+      resolution.url = next_url
+      resolution.hops += 1
+      resolution.chain.append(next_url)
+      if self._is_final(next_url):
+        self._finish(resolution,next_url)
+      elif resolution.hops > self.max_redirects:
+        self._finish(resolution,None)
+      else:
+        pending.append(resolution)
+  
+  def _start(self,pending):
+    '''Starts requests allowed by limits, returns resolutions left waiting'''
+    result = []
+    for resolution in pending:
+      url = resolution.url
+      if url in self._responses:
+        self._advance(resolution,url,self._responses[url],result)
+        continue
+      if url in self._waiting:
+        self._waiting[url].append(resolution)
+        continue
+      host = _host(url)
+      if len(self._rpcs) >= self.max_concurrent or \
+         self._host_counts.get(host,0) >= self.host_limit:
+        result.append(resolution)
+        continue
+      
+      rpc = urlfetch.create_rpc(deadline = self.deadline)
       try:
-        final_url = rpc.get_result().final_url
-      except AttributeError:
-        final_url = request_url
-      except (DownloadError,InvalidURLError,apiproxy_errors.DeadlineExceededError):
-        final_url  = None        
-      except UnicodeDecodeError: #Funky url with very evil characters
-        final_url = unicode(rpc.get_result().final_url,'utf-8')
-        
-      result[request_url] = final_url
+        urlfetch.make_fetch_call(rpc,url,method = urlfetch.HEAD,
+                                 follow_redirects = False)
+      except (InvalidURLError,UnicodeError):
+        self._finish(resolution,None)
+        continue
+      self._rpcs[rpc] = url
+      self._waiting[url] = [resolution]
+      self._host_counts[host] = self._host_counts.get(host,0) + 1
+    return result
     
-    logging.info('Returning results: %s' %result)
-    return result
\ No newline at end of file
+  def _next_url(self,rpc,url):
+    '''Returns redirect target, None if url is final, False on errors'''
+    try:
+      response = rpc.get_result()
+    except (DownloadError,InvalidURLError,apiproxy_errors.DeadlineExceededError):
+      return False
+    
+    location = response.headers.get('location')
+    if response.status_code not in self.REDIRECT_CODES or not location:
+      return None
+    if isinstance(location,str): #Funky url with very evil characters
+      location = unicode(location,'utf-8','replace')
+    return urlparse.urljoin(url,location)
+  
+  def _is_final(self,url):
+    if not self.early_exit:
+      return False
+    try:
+      AmazonURLParser.product_url(url)
+      return True
+    except ParserException:
+      return False
+  
+  def _finish(self,resolution,final_url):
+    self._result[resolution.start_url] = (final_url,resolution.chain)
+    
+def _host(url):
+  return urlparse.urlsplit(url)[1].lower()
\ No newline at end of file
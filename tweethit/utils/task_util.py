@@ -1,39 +1,199 @@
+from PerformanceEngine.retry import RetryPolicy
 from tweethit.utils.parser_util import AmazonURLParser
+from tweethit.utils import payload_codec
 from google.appengine.api import taskqueue
+from config import COUNTER_PAYLOAD_MERGE_LIMIT,COUNTER_INGESTION_MODE,\
+COUNTER_PULL_QUEUE_LOCAL,PRODUCT_INFO_BATCH_SIZE
 import time
 import logging
+import uuid
 
 productinfo_queue = taskqueue.Queue('productinfo')
 cleanup_queue = taskqueue.Queue('cleanup')
 url_queue = taskqueue.Queue('url')
 fast_queue = taskqueue.Queue('fastqueue')
 
-def prevent_transient_error(fn):
-  def keep_trying(*args,**kwargs):
-    timeout_ms = 100
-    while True:      
-      try:
-        return fn(*args,**kwargs)    
-      except taskqueue.TransientError:
-        time.sleep(timeout_ms)
-        timeout_ms *= 2
-  return keep_trying
+PUSH = 'push'
+PULL = 'pull'
+
+MAX_TASKS_PER_ADD = 100 #Queue.add limit
+
+#Decorator retrying taskqueue calls for at most 5 seconds
+prevent_transient_error = RetryPolicy('taskqueue',
+                                      retry_on = taskqueue.TransientError,
+                                      initial_delay = 0.1,
+                                      max_delay = 1.0,
+                                      time_budget = 5)
+
+class LocalPullQueue(object):
+  '''In memory stand-in for a pull queue with the methods used by 
+  CounterConsumer, tasks live only in the current instance'''
+  def __init__(self,name = 'local'):
+    self.name = name
+    self._entries = [] #[lease expiration,task]
+    
+  def add(self,tasks):
+    if not isinstance(tasks,list):
+      tasks = [tasks]
+    for task in tasks:
+      self._entries.append([0,task])
+      
+  def lease_tasks(self,lease_seconds,max_tasks):
+    now = time.time()
+    result = []
+    for entry in self._entries:
+      if len(result) == max_tasks:
+        break
+      if entry[0] <= now:
+        entry[0] = now + lease_seconds
+        result.append(entry[1])
+    return result
+  
+  def delete_tasks(self,tasks):
+    deleted = set([id(task) for task in tasks])
+    self._entries = [entry for entry in self._entries 
+                     if id(entry[1]) not in deleted]
+    
+if COUNTER_PULL_QUEUE_LOCAL:
+  counter_pull_queue = LocalPullQueue('counterpull')
+else:
+  counter_pull_queue = taskqueue.Queue('counterpull')
+
+class TaskBuffer(object):
+  '''Collects tasks added during a request and adds them 
+  with batched Queue.add calls on flush
+  
+  Counter payloads with the same countdown are merged into
+  tasks of at most merge_limit mentions, a payload holding more
+  mentions than merge_limit is added as it is.
+  '''
+  def __init__(self,merge_limit = COUNTER_PAYLOAD_MERGE_LIMIT):
+    self.merge_limit = merge_limit
+    self._queues = {} #queue name => (queue,tasks)
+    self._counter_payloads = {} #countdown => payload strings
+    
+  def add(self,queue,task):
+    self._queues.setdefault(queue.name,(queue,[]))[1].append(task)
+    
+  def add_counter(self,payload,countdown = 0):
+    self._counter_payloads.setdefault(countdown,[]).append(payload)
+    
+  def flush(self):
+    for countdown,payloads in self._counter_payloads.iteritems():
+      for payload in self._merge(payloads):
+        self.add(*_counter_task(payload,countdown))
+    self._counter_payloads = {}
+    
+    for queue,tasks in self._queues.itervalues():
+      for i in range(0,len(tasks),MAX_TASKS_PER_ADD):
+        _add_batch(queue,tasks[i:i+MAX_TASKS_PER_ADD])
+    self._queues = {}
+    
+  def _merge(self,payloads):
+    if len(payloads) == 1:
+      return payloads
+    
+    groups = []
+    group = []
+    size = 0
+    for payload in payloads:
+      data = payload_codec.from_param(payload)
+      length = sum([count for url,user_id,count in payload_codec.decode(data)])
+      if size and size + length > self.merge_limit:
+        groups.append(group)
+        group = []
+        size = 0
+      group.append(data)
+      size += length
+    groups.append(group)
+    return [payload_codec.to_param(payload_codec.merge(group)) 
+            for group in groups]
+
+_buffer = None #TaskBuffer of current request
+
+def buffered_tasks(fn):
+  '''Handler method decorator, tasks enqueued while fn runs are 
+  added when it returns. Nothing is added if fn raises an exception,
+  so a retried task doesn't duplicate tasks of its failed run'''
+  def run_buffered(*args,**kwargs):
+    global _buffer
+    _buffer = TaskBuffer()
+    try:
+      result = fn(*args,**kwargs)
+      _buffer.flush()
+      return result
+    finally:
+      _buffer = None
+  return run_buffered
+
+def _add(queue,task):
+  if _buffer is None:
+    _add_batch(queue,task)
+  else:
+    _buffer.add(queue,task)
 
 @prevent_transient_error
+def _add_batch(queue,tasks):
+  '''Adds tasks, tasks enqueued by a failed attempt are skipped on retry
+  
+  Tasks are named when created, so a task that was enqueued by an attempt 
+  which still raised fails with TaskAlreadyExistsError when added again'''
+  if not isinstance(tasks,list):
+    tasks = [tasks]
+  tasks = [task for task in tasks if not task.was_enqueued]
+  if not len(tasks):
+    return
+  try:
+    queue.add(tasks)
+  except taskqueue.TaskAlreadyExistsError:
+    #Raised only if all other tasks were added,
+    #names are unique so existing ones were added by a previous try
+    for task in tasks:
+      if not task.was_enqueued:
+        logging.info('Task already enqueued: %s' %task.name)
+  
+def _new_task(**kwds):
+  '''Returns a task with a unique name, see _add_batch'''
+  kwds.setdefault('name',uuid.uuid4().hex)
+  return taskqueue.Task(**kwds)
+  
+def _counter_task(payload,countdown):
+  '''Returns (queue,task) for a counter payload in current ingestion mode'''
+  if COUNTER_INGESTION_MODE == PULL:
+    return counter_pull_queue,_new_task(payload = payload,
+                                        method = 'PULL',
+                                        countdown = countdown)
+  return fast_queue,_new_task(url='/taskworker/counter/', 
+                              countdown = countdown,
+                              params={'payload': payload})
+
 def enqueue_url_fetch(payload):
-  t = taskqueue.Task(url='/taskworker/url/', 
-                    params={'payload': payload})
-  url_queue.add(t)
+  t = _new_task(url='/taskworker/url/', 
+                params={'payload': payload})
+  _add(url_queue,t)
     
-@prevent_transient_error
 def enqueue_counter(payload,countdown = 0):
-  t = taskqueue.Task(url='/taskworker/counter/', 
-                     countdown = countdown,
-                     params={'payload': payload})
-  
-  fast_queue.add(t)
+  if _buffer is None:
+    _add(*_counter_task(payload,countdown))
+  else:
+    _buffer.add_counter(payload,countdown)
+    
+def enqueue_counter_flush(index = 'counter',countdown = 0,render_date = None):
+  '''render_date chains weekly & monthly renderer updates of the date
+  after the flush, see CounterFlushWorker'''
+  params = {'index': index}
+  if render_date is not None:
+    params['render_date'] = str(render_date)
+  t = _new_task(url='/taskworker/counterflush/',
+                countdown = countdown,
+                params=params)
+  _add(fast_queue,t)
+
+def enqueue_counter_consume(countdown = 0):
+  t = _new_task(url='/taskworker/counterconsume/',
+                countdown = countdown)
+  _add(fast_queue,t)
     
-@prevent_transient_error
 def enqueue_cleanup(model_kind, 
                     frequency,date,store_key_name = None,countdown = 0):
   
@@ -44,22 +204,21 @@ def enqueue_cleanup(model_kind,
       store_group = AmazonURLParser.ROOT_URL_SET    
     
     for root_url in store_group:
-      t = taskqueue.Task(url='/taskworker/cleanup/',
-                        countdown = countdown, 
-                        params={'model_kind': model_kind,
-                                 'frequency':frequency,
-                                 'date_string':str(date),
-                                 'store_key_name':root_url
-                                 })
+      t = _new_task(url='/taskworker/cleanup/',
+                    countdown = countdown, 
+                    params={'model_kind': model_kind,
+                             'frequency':frequency,
+                             'date_string':str(date),
+                             'store_key_name':root_url
+                             })
       
-      cleanup_queue.add(t)
+      _add(cleanup_queue,t)
   else:
-    t = taskqueue.Task(url='/taskworker/cleanup/',
-                       countdown = countdown, 
-                       params={'model_kind': model_kind})
-    cleanup_queue.add(t)
+    t = _new_task(url='/taskworker/cleanup/',
+                   countdown = countdown, 
+                   params={'model_kind': model_kind})
+    _add(cleanup_queue,t)
     
-@prevent_transient_error
 def enqueue_renderer_update(frequency,date, 
                             countdown = 0,store_key_name = None):
   if store_key_name:
@@ -68,25 +227,32 @@ def enqueue_renderer_update(frequency,date,
     store_group = AmazonURLParser.ROOT_URL_SET
 
   for root_url in store_group:
-    t = taskqueue.Task(url='/taskworker/rendererupdate/',
-                       countdown = countdown, 
-                      params={'store_key_name': root_url,
-                                'frequency':frequency,
-                                'date_string':str(date)})
-    fast_queue.add(t)
+    t = _new_task(url='/taskworker/rendererupdate/',
+                   countdown = countdown, 
+                  params={'store_key_name': root_url,
+                            'frequency':frequency,
+                            'date_string':str(date)})
+    _add(fast_queue,t)
     countdown += 20
    
-@prevent_transient_error     
-def enqueue_renderer_info(product_key_name,count,frequency,date,
-                                        countdown = 0,retries = 0):
-
-  t = taskqueue.Task(url='/taskworker/rendererinfo/', 
+def enqueue_renderer_info(products,frequency,date,countdown = 0,retries = 0):
+  '''products is a list of (product_key_name,count), 
+  products of each locale are split into tasks of PRODUCT_INFO_BATCH_SIZE'''
+  locale_products = {}
+  for product_key_name,count in products:
+    locale = AmazonURLParser.get_locale(product_key_name)
+    locale_products.setdefault(locale,[]).append((product_key_name,count))
+  
+  for products in locale_products.itervalues():
+    for i in range(0,len(products),PRODUCT_INFO_BATCH_SIZE):
+      batch = products[i:i+PRODUCT_INFO_BATCH_SIZE]
+      t = _new_task(url='/taskworker/rendererinfo/', 
                      countdown = countdown,
-                     params={'product_key_name': product_key_name,
-                              'count':count,
+                     params={'product_key_name': [name for name,count in batch],
+                              'count':[count for name,count in batch],
                               'date_string':str(date),
                               'frequency': frequency,
                               'retries' : retries,})
-  productinfo_queue.add(t)
+      _add(productinfo_queue,t)
       
     
\ No newline at end of file